@@ -20,9 +20,11 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import sys
-import imp
+import types
+import importlib
 
 from clay.exceptions import SchemaException, MissingDependency
+from clay.catalog import Catalog
 
 __author__ = "Massimo Gaggero, Vittorio Meloni"
 __author_email__ = "<massimo.gaggero@crs4.it>, <vittorio.meloni@crs4.it>"
@@ -32,29 +34,58 @@ MESSAGE_FACTORIES = {}
 CATALOGS = {}
 NAMED_CATALOGS = {}
 
-class CustomLoader(object):
+class LazyModule(types.ModuleType):
+    """
+    Module that imports some of its attributes from its submodules on first access. It replaces a package in
+    `sys.modules`, so that importing the package doesn't import the optional dependencies of its submodules.
 
-    DEPENDENCIES = {}
+    :type module: `module`
+    :param module: the module to replace
 
-    def find_module(self, name, path=None):
-        if name in self.DEPENDENCIES:
-            self.path = path
-            return self
-        return None
+    :type attributes: `dict`
+    :param attributes: a dictionary that maps the name of every lazy attribute to a pair with the list of the
+        relative names of the submodules that can define it, tried in order, and the name of the dependency to report
+        with :exc:`MissingDependency <clay.exceptions.MissingDependency>` when none of them can be imported
+    """
+    def __init__(self, module, attributes):
+        super(LazyModule, self).__init__(module.__name__, module.__doc__)
+        self.__dict__.update(vars(module))
+        # the replaced module must be kept alive: Python 2 clears the globals of a deallocated module
+        self._module = module
+        self._lazy_attributes = attributes
+
+    def __getattr__(self, name):
+        try:
+            submodules, dependency = self._lazy_attributes[name]
+        except KeyError:
+            raise AttributeError("'module' object has no attribute '%s'" % name)
 
-    def load_module(self, name):
-        if name in sys.modules:
-            return sys.modules[name]
+        for submodule in submodules:
+            try:
+                module = importlib.import_module(submodule, self.__name__)
+            except MissingDependency:
+                continue
+            value = getattr(module, name)
+            setattr(self, name, value)
+            return value
+        raise MissingDependency(dependency)
 
-        try:
-            module_info = imp.find_module(name.split(".")[-1], self.path)
-            module = imp.load_module(name, *module_info)
-        except ImportError:
-            raise MissingDependency(self.DEPENDENCIES[name])
-        else:
-            sys.modules[name] = module
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(self._lazy_attributes))
 
-        return module
+
+def lazy_module(name, attributes):
+    """
+    Replace the module :attr:`name` in `sys.modules` with a :class:`LazyModule`. It must be called at the end of the
+    module
+
+    :type name: `str`
+    :param name: the name of the module
+
+    :type attributes: `dict`
+    :param attributes: the lazy attributes, as described in :class:`LazyModule`
+    """
+    sys.modules[name] = LazyModule(sys.modules[name], attributes)
 
 
 class MessageFactoryMetaclass(type):
@@ -67,10 +98,28 @@ class MessageFactoryMetaclass(type):
         return _factory
 
 
+def as_catalog(catalog):
+    """
+    Return the :class:`Catalog <clay.catalog.Catalog>` corresponding to :attr:`catalog`. If it is a plain `dict`,
+    it is the :class:`Catalog <clay.catalog.Catalog>` registered by :func:`add_catalog` with the same name, if its
+    content is still equal to the `dict`, otherwise a new :class:`Catalog <clay.catalog.Catalog>` is built
+
+    :param catalog: a `dict` or a :class:`Catalog <clay.catalog.Catalog>`
+    :return: a :class:`Catalog <clay.catalog.Catalog>`
+    """
+    if isinstance(catalog, Catalog):
+        return catalog
+    registered = CATALOGS.get(catalog.get("name"))
+    if registered is not None and registered == catalog:
+        return registered
+    return Catalog(catalog)
+
+
 def add_catalog(catalog):
-    CATALOGS[catalog["name"]] = catalog
-    NAMED_CATALOGS[catalog["name"]] = dict((v["name"], (k, v)) for (k, v) in catalog.viewitems()
-                                           if isinstance(k, int))
+    catalog = as_catalog(catalog)
+    CATALOGS[catalog.name] = catalog
+    NAMED_CATALOGS[catalog.name] = catalog.named
+    return catalog
 
 
 def schema_from_name(schema_name, schema_catalog):
@@ -81,12 +130,7 @@ def schema_from_name(schema_name, schema_catalog):
     :param schema_name: The name of the schema to search
     :return: a tuple wit the ID of the schema and the schema itself
     """
-    named_catalog = dict((s["name"], (i, s)) for (i, s) in schema_catalog.viewitems()
-                         if isinstance(i, int))
-    try:
-        return named_catalog[schema_name]
-    except KeyError:
-        raise SchemaException("Schema '%s' does not exist" % schema_name)
+    return as_catalog(schema_catalog).schema_from_name(schema_name)
 
 
 def schema_from_id(schema_id, schema_domain):
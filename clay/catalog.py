@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2015, CRS4
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import copy
+import hashlib
+import json
+
+from .exceptions import SchemaException
+
+
+def schema_fingerprint(schema):
+    """
+    Return the fingerprint of the schema in input. The fingerprint is the MD5 digest of the canonical JSON
+    representation of the schema (i.e., with sorted keys and without whitespaces), so equal schemas have the same
+    fingerprint even if they come from different catalogs
+
+    :type schema: `dict`
+    :param schema: the schema
+    :rtype: `str`
+    :return: the hexadecimal fingerprint of the schema
+    """
+    return hashlib.md5(json.dumps(schema, sort_keys=True, separators=(",", ":"))).hexdigest()
+
+
+def _immutable(self, *args, **kwargs):
+    raise TypeError("Catalog objects cannot be modified")
+
+
+class Catalog(dict):
+    """
+    A catalog of schemas. It behaves like the `dict` it is built from but it also precomputes the indexes
+    used to search the schemas by name and by fingerprint, so the lookups don't depend on the catalog size.
+    Since the indexes are computed only once, a :class:`Catalog` cannot be modified after its creation: it keeps a
+    copy of the schemas, so the changes to the `dict` it is built from don't affect it.
+
+    :type catalog: `dict`
+    :param catalog: the catalog with the `name`, the `version` and the schemas
+    """
+    def __init__(self, catalog):
+        super(Catalog, self).__init__(copy.deepcopy(catalog))
+        self._named = {}
+        self._fingerprints = {}
+        self._fingerprinted = {}
+        self._compiled = {}
+        for schema_id, schema in self.iteritems():
+            if isinstance(schema_id, int):
+                fingerprint = schema_fingerprint(schema)
+                self._named[schema["name"]] = (schema_id, schema)
+                self._fingerprints[schema_id] = fingerprint
+                self._fingerprinted[fingerprint] = (schema_id, schema)
+
+    name = property(lambda self: self.get("name"), doc="The name of the catalog")
+    version = property(lambda self: self.get("version"), doc="The version of the catalog")
+    compression = property(lambda self: self.get("compression"),
+                           doc="The configuration of the compression of the payloads, if present (see "
+                               ":mod:`clay.serializer.compression`)")
+    named = property(lambda self: self._named, doc="The `dict` of the schemas indexed by name")
+
+    def schema_from_name(self, schema_name):
+        """
+        Return the id and the schema with the name :attr:`schema_name`
+
+        :param schema_name: The name of the schema to search
+        :return: a tuple with the ID of the schema and the schema itself
+        """
+        try:
+            return self._named[schema_name]
+        except KeyError:
+            raise SchemaException("Schema '%s' does not exist" % schema_name)
+
+    def schema_from_id(self, schema_id):
+        """
+        Return the schema with the id :attr:`schema_id`
+
+        :param schema_id: The ID of the schema to search
+        :return: the schema
+        """
+        try:
+            return self[schema_id]
+        except KeyError:
+            raise SchemaException("Schema id '%s' does not exist in '%s' catalog" % (schema_id, self.name))
+
+    def schema_from_fingerprint(self, fingerprint):
+        """
+        Return the id and the schema with the given fingerprint
+
+        :param fingerprint: The fingerprint of the schema, as returned by :func:`schema_fingerprint`
+        :return: a tuple with the ID of the schema and the schema itself
+        """
+        try:
+            return self._fingerprinted[fingerprint]
+        except KeyError:
+            raise SchemaException("Schema with fingerprint '%s' does not exist" % fingerprint)
+
+    def fingerprint(self, schema_id):
+        """
+        Return the fingerprint of the schema with the id :attr:`schema_id`
+
+        :param schema_id: The ID of the schema
+        :return: the fingerprint of the schema
+        """
+        try:
+            return self._fingerprints[schema_id]
+        except KeyError:
+            raise SchemaException("Schema id '%s' does not exist in '%s' catalog" % (schema_id, self.name))
+
+    def compiled(self, schema_name, compiler):
+        """
+        Return the object compiled from the schema with the name :attr:`schema_name`, e.g. the class of its
+        messages. The compiler is called with the schema on the first request and the object is kept by the catalog
+        for the next ones
+
+        :param schema_name: The name of the schema
+        :param compiler: the function that compiles the schema
+        :return: the object returned by :attr:`compiler`
+        """
+        try:
+            return self._compiled[(schema_name, compiler)]
+        except KeyError:
+            compiled = self._compiled[(schema_name, compiler)] = compiler(self.schema_from_name(schema_name)[1])
+            return compiled
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _immutable
+
+    def __reduce__(self):
+        return self.__class__, (dict(self),)
+
+# vim:tabstop=4:expandtab
@@ -80,4 +80,9 @@ class MessengerErrorNoApplicationName(MessengerError):
     def __str__(self):
         return "No application name defined"
 
+
+class MessengerErrorTimeout(MessengerError):
+    def __str__(self):
+        return "No response received before the timeout"
+
 # vim:tabstop=4:expandtab
@@ -23,6 +23,12 @@ import clay
 from .message import Message
 
 
+def _keep_serialized(message, serialized):
+    # The retrieved message reuses the data it was retrieved from as its serialization, while it's not modified
+    if isinstance(serialized, str):
+        message._serialized = serialized
+
+
 class MessageFactory(object):
     """
     Create a factory for the messages of the types included in the given catalog and that should be serialized with
@@ -31,15 +37,15 @@ class MessageFactory(object):
     :type serializer: `class`
     :param serializer: the :class:`Serializer <clay.serializer.Serializer>` class
 
-    :type catalog: `dict`
+    :type catalog: `dict` or :class:`Catalog <clay.catalog.Catalog>`
     :param catalog: the catalog with the schemas to use for the message creation and serialization/deserialization
     """
     __metaclass__ = clay.MessageFactoryMetaclass
 
     def __init__(self, serializer, catalog):
         self.serializer = serializer
-        self.catalog = catalog
-        clay.add_catalog(self.catalog)
+        self.catalog = clay.add_catalog(catalog)
+        self.serializer.prepare_catalog(self.catalog)
 
     def create(self, message_type, content=None):
         """
@@ -68,13 +74,43 @@ class MessageFactory(object):
         msg.set_content(content)
         return msg
 
-    def retrieve(self, message):
+    def create_many(self, message_type, contents):
+        """
+        Create a :class:`Message <clay.message.Message>` of the given type for every content in input.
+
+        :param message_type: the type of the messages to be created.
+        :type message_type: `str`
+
+        :param contents: the contents of the messages
+        :type contents: iterable of `dict`
+
+        :return: a `list` of :class:`Message <clay.message.Message>` instances
+        """
+        return [self.create(message_type, content) for content in contents]
+
+    def retrieve(self, message, lazy=False, fields=None, predicate=None):
         """
         Retrieve the content from the serialized message and return a populated instance of the
         :class:`Message <clay.message.Message>` class.
 
+        If :attr:`lazy` is :const:`True`, the message is backed by the serialized data and its fields are decoded
+        only when they are accessed the first time. The whole message is decoded when it is modified or its
+        content is requested. It is convenient when only a few fields of the message are read.
+
+        If :attr:`fields` or :attr:`predicate` are given, only the fields in :attr:`fields` are decoded and the
+        message is returned only if it satisfies the :attr:`predicate`, as described in
+        :meth:`Serializer.deserialize_projection <clay.serializer.Serializer.deserialize_projection>`. The other
+        fields of the message have their default value. In this case :attr:`lazy` is ignored.
+
         :param message: the serialized message to deserialize and retrieve
-        :return: a populated instance of the :class:`Message <clay.message.Message>` class
+        :param lazy: if :const:`True` the fields are decoded on access
+        :type lazy: `bool`
+        :param fields: the names of the fields to decode. If it is :const:`None` all the fields are decoded
+        :type fields: iterable of `str`
+        :param predicate: a dictionary that maps the names of primitive fields to a value or to a test function
+        :type predicate: `dict`
+        :return: a populated instance of the :class:`Message <clay.message.Message>` class, or :const:`None` if
+            the message doesn't satisfy the predicate
 
         >>> mf = MessageFactory(AvroSerializer, TEST_CATALOG)
         >>> m = mf.retrieve('\\x00\\x10\\x8e\\xd1\\x87\\x01\\x06aaa')
@@ -83,10 +119,125 @@ class MessageFactory(object):
         >>> m.name
         "aaa"
         """
-        payload, payload_id, payload_schema = self.serializer.deserialize(message, self.catalog)
+        if fields is not None or predicate is not None:
+            return self._retrieve_projection(message, fields, predicate)
+
+        serialized = message
+        if lazy:
+            source, payload_id, payload_schema = self.serializer.deserialize_lazy(serialized, self.catalog)
+            message = Message._from_source(payload_schema['name'], self.catalog, self.serializer, source)
+        else:
+            payload, payload_id, payload_schema = self.serializer.deserialize(serialized, self.catalog)
+            message = Message(payload_schema['name'], self.catalog, self.serializer)
+            message.set_content(payload)
+        _keep_serialized(message, serialized)
+
+        return message
+
+    def peek(self, message):
+        """
+        Read the schema id and the type of the serialized message without decoding its payload. It can be used to
+        route or filter the messages before retrieving them.
+
+        :param message: the serialized message
+        :return: a tuple with the id of the schema, the message type and the offset of the payload in the message
+            (:const:`None` if the serializer cannot locate it)
+
+        >>> mf = MessageFactory(AvroSerializer, TEST_CATALOG)
+        >>> mf.peek('\\x00\\x10\\x8e\\xd1\\x87\\x01\\x06aaa')
+        (0, 'TEST', 2)
+        """
+        return self.serializer.peek(message, self.catalog)
+
+    def _retrieve_projection(self, message, fields, predicate):
+        payload, payload_id, payload_schema = self.serializer.deserialize_projection(message, self.catalog,
+                                                                                     fields, predicate)
+        if payload is None:
+            return None
+        # the message is not complete, so it doesn't keep the serialized data
         message = Message(payload_schema['name'], self.catalog, self.serializer)
         message.set_content(payload)
-
         return message
 
+    def retrieve_many(self, messages, lazy=False, fields=None, predicate=None):
+        """
+        Retrieve the content from all the serialized messages in input, using the batch deserialization of the
+        :class:`Serializer <clay.serializer.Serializer>`.
+
+        :param messages: an iterable of serialized messages
+        :param lazy: if :const:`True` the fields are decoded on access, as in :meth:`retrieve`
+        :type lazy: `bool`
+        :param fields: the names of the fields to decode, as in :meth:`retrieve`
+        :type fields: iterable of `str`
+        :param predicate: the predicate that the messages must satisfy, as in :meth:`retrieve`
+        :type predicate: `dict`
+        :return: a `list` of populated instances of the :class:`Message <clay.message.Message>` class. The messages
+            that don't satisfy the predicate are not included
+        """
+        if fields is not None or predicate is not None:
+            if fields is not None:
+                fields = frozenset(fields)
+            retrieved = (self._retrieve_projection(message, fields, predicate) for message in messages)
+            return [message for message in retrieved if message is not None]
+
+        if lazy:
+            return [self.retrieve(message, True) for message in messages]
+
+        messages = list(messages)
+        retrieved = []
+        deserialized = self.serializer.deserialize_many(messages, self.catalog)
+        for serialized, (payload, payload_id, payload_schema) in zip(messages, deserialized):
+            message = Message(payload_schema['name'], self.catalog, self.serializer)
+            message.set_content(payload)
+            _keep_serialized(message, serialized)
+            retrieved.append(message)
+        return retrieved
+
+    def archive(self, fileobj, message_type, codec="null", block_size=None):
+        """
+        Open an Avro object container file to archive the messages of the given type. The file can be read back with
+        :meth:`replay`.
+
+        :param fileobj: the file to write, opened in binary mode
+        :param message_type: the type of the messages to archive
+        :type message_type: `str`
+        :param codec: the compression codec of the file, `null` or `deflate`
+        :type codec: `str`
+        :param block_size: the size in bytes of the blocks of the file
+        :type block_size: `int`
+        :return: a :class:`ContainerWriter <clay.serializer.container.ContainerWriter>`. The messages are added with
+            ``writer.append(message.content)``
+
+        >>> mf = MessageFactory(AvroSerializer, TEST_CATALOG)
+        >>> with mf.archive(open("test.avro", "wb"), "TEST", "deflate") as writer:
+        ...     writer.append(mf.create("TEST", {"id": 1, "name": "aaa"}).content)
+        """
+        from .serializer.container import ContainerWriter, DEFAULT_BLOCK_SIZE
+
+        schema_id, schema = self.catalog.schema_from_name(message_type)
+        return ContainerWriter(fileobj, schema, codec, block_size or DEFAULT_BLOCK_SIZE)
+
+    def replay(self, fileobj, start=None, end=None):
+        """
+        Read the messages archived in an Avro object container file. The file is read a block at a time.
+
+        :param fileobj: the file to read, opened in binary mode
+        :param start: if present, only the blocks starting in the byte range [start, end) are read, as in
+            :meth:`ContainerReader.read_split <clay.serializer.container.ContainerReader.read_split>`
+        :type start: `int`
+        :param end: the end of the byte range to read
+        :type end: `int`
+        :return: an iterator over the :class:`Message <clay.message.Message>` instances
+        """
+        from .serializer.container import ContainerReader
+
+        reader = ContainerReader(fileobj)
+        message_type = reader.schema["name"]
+        if start is None and end is None:
+            contents = reader
+        else:
+            contents = reader.read_split(start or 0, end if end is not None else float("inf"))
+        for content in contents:
+            yield self.create(message_type, content)
+
 # vim:tabstop=4:expandtab
\ No newline at end of file
@@ -20,11 +20,17 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 from collections import MutableMapping, Iterable
+from functools import partial
+from operator import attrgetter
 
-from . import schema_from_name
+from . import as_catalog
 from .exceptions import SchemaException, InvalidMessage, InvalidContent
 from .serializer import DummySerializer
 
+_getattr = object.__getattribute__
+_setattr = object.__setattr__
+_delattr = object.__delattr__
+
 
 def _is_primitive_type(t):
     primitive_types = ("null", "boolean", "int", "long",
@@ -38,100 +44,195 @@ def _is_primitive_type(t):
         return t in primitive_types
 
 
+def _field_type(field):
+    if isinstance(field["type"], list):
+        # We allow only two kind of types
+        # FIXME: we are taking that the list contains only two types
+        if "null" not in field["type"]:
+            raise SchemaException("The schema structure is not valid: found more than one \
+                                  field type")
+        return [t for t in field["type"] if t != "null"][0]  # the field type other than "null"
+    return field["type"]
+
+
+def _invalidate(node):
+    # Called on every change of a _Record or an _Array: it discards the serialization cached by the Message that
+    # owns the node
+    owner = node._owner
+    if owner is not None:
+        owner._serialized = None
+
+
+def _compile_record(fields_schema):
+    # Generates a _Record subclass for the fields in input. Every field is stored in a slot with the same name
+    # of the field so the reading of a value is a plain slot access
+    names, primitives, defaults, children = [], [], [], []
+    for field in fields_schema:
+        name = str(field["name"])
+        if name in _RESERVED_NAMES:
+            raise SchemaException("The schema structure is not valid: '%s' is a reserved field name" % name)
+        names.append(name)
+
+        field_type = _field_type(field)
+        if isinstance(field_type, MutableMapping):
+            if field_type["type"] == "array":
+                items = field_type["items"]
+                item_class = None if _is_primitive_type(items) else _compile_record(items["fields"])
+                children.append((name, partial(_Array, item_class)))
+            else:
+                children.append((name, _compile_record(field_type["fields"])))
+        else:
+            primitives.append(name)
+            defaults.append((name, field.get("default")))
+
+    return type("_Record", (_Record,), {
+        "__slots__": tuple(names),
+        "fields": tuple(names),
+        "schema": fields_schema,
+        "_primitives": frozenset(primitives),
+        "_complex": frozenset(name for name, _ in children),
+        "_defaults": tuple(defaults),
+        "_children": tuple(children),
+        "_default_values": dict(defaults),
+        "_factories": dict(children)
+    })
+
+
 class _Record(object):
-    def __init__(self, schema, init=False):
-        self._schema = schema
-        self.fields = tuple(field["name"] for field in self.schema)
+    # Base class of the records compiled from the schemas. The subclasses define the class attributes below.
+    # A record can be backed by a LazyPayload (the _source): its fields are decoded when they are accessed the
+    # first time, and all the remaining ones when the record is modified or its content is requested.
+    # The _owner is the Message that contains the record, notified of the changes by _invalidate
+    __slots__ = ("_none", "_source", "_owner")
+
+    fields = ()
+    schema = ()
+    _primitives = frozenset()
+    _complex = frozenset()
+    _defaults = ()
+    _children = ()
+    _default_values = {}
+    _factories = {}
+
+    def __init__(self, init=False, owner=None):
+        _setattr(self, "_none", True)
+        _setattr(self, "_source", None)
+        _setattr(self, "_owner", owner)
         if init:
             self._init_fields()
-        else:
-            self._content = None
 
-    schema = property(lambda self: self._schema)
-    content = property(lambda self: self._as_obj())
+    @classmethod
+    def _from_source(cls, source, owner=None):
+        record = cls.__new__(cls)
+        _setattr(record, "_none", False)
+        _setattr(record, "_source", source)
+        _setattr(record, "_owner", owner)
+        return record
+
+    def __getattr__(self, name):
+        # It is called only when the slot of a field is not set, i.e., the field has not been decoded yet
+        if self._source is None or name not in self.fields:
+            raise AttributeError("%r object has no attribute %r" % (self.__class__.__name__, name))
+        return self._load_field(name, self._source.field)
+
+    def _load_field(self, name, get):
+        # Sets the field with the value returned by get(name), or with its default if get raises KeyError
+        if name in self._primitives:
+            try:
+                value = get(name)
+            except KeyError:
+                value = self._default_values[name]
+        else:
+            # decoding doesn't change the message, so the serialization cached by the owner is kept
+            owner = self._owner
+            serialized = owner._serialized if owner is not None else None
+            value = self._factories[name](owner=owner)
+            try:
+                value.set_content(get(name))
+            except KeyError:
+                pass
+            if owner is not None:
+                owner._serialized = serialized
+        _setattr(self, name, value)
+        return value
+
+    def _materialize(self):
+        # Decodes all the fields not accessed yet and detaches the record from its source
+        source = self._source
+        _setattr(self, "_source", None)
+        content = source.content()
+        for name in self.fields:
+            try:
+                _getattr(self, name)
+            except AttributeError:
+                self._load_field(name, content.__getitem__)
 
     def set_content(self, content):
         if content is not None and not isinstance(content, MutableMapping):
             raise InvalidContent()
 
+        if self._source is not None:
+            self._materialize()
+        _invalidate(self)
+
         if content is None:
-            self._content = None
+            self._clear_fields()
         else:
-            if self._is_none():
+            if self._none:
                 self._init_fields()
             for k, v in content.iteritems():
-                try:
-                    setattr(self, k, v)
-                except ValueError:  # complex datatype
-                    attr = getattr(self, k)
-                    attr.set_content(v)
+                if k in self._primitives:
+                    _setattr(self, k, v)
+                elif k in self._complex:
+                    getattr(self, k).set_content(v)
+                else:
+                    raise AttributeError("%r object has no attribute %r" % (self.__class__.__name__, k))
 
     def _init_fields(self):
         # Method to reinitialize the fields. It is used on the first initialization and when the _Record was set to None
-        self._content = {}
-        for field in self.schema:
-            # self._fields_name.append(field["name"])
-            if isinstance(field["type"], list):
-                # We allow only two kind of types
-                # FIXME: we are taking that the list contains only two types
-                if "null" not in field["type"]:
-                    raise SchemaException("The schema structure is not valid: found more than one \
-                                          field type")
-                else:
-                    field_type = [t for t in field["type"] if t != "null"][0]  # the field type other than "null"
-            else:
-                field_type = field["type"]
-
-            if _is_primitive_type(field_type):
-                setattr(self, field["name"], field.get("default"))
-            elif isinstance(field_type, MutableMapping):
-                if field_type["type"] == "array":
-                    setattr(self, field["name"], _Array(field_type["items"]))
-                else:
-                    setattr(self, field["name"], _Record(field_type["fields"]))
+        for name, default in self._defaults:
+            _setattr(self, name, default)
+        for name, factory in self._children:
+            _setattr(self, name, factory(owner=self._owner))
+        _setattr(self, "_none", False)
+
+    def _clear_fields(self):
+        if not self._none:
+            for name in self.fields:
+                try:
+                    _delattr(self, name)
+                except AttributeError:
+                    pass
+            _setattr(self, "_none", True)
+            _setattr(self, "_source", None)
 
     def _is_none(self):
-        return self._content is None
+        return self._none
 
     def _as_obj(self):
-        if self._is_none():
+        if self._none:
             return None
+        if self._source is not None:
+            self._materialize()
         d = {}
-        for attr in self.fields:
-            value = getattr(self, attr)
-            try:
-                d[attr] = value.content
-            except AttributeError:
-                d[attr] = value
+        for attr in self._primitives:
+            d[attr] = getattr(self, attr)
+        for attr in self._complex:
+            d[attr] = getattr(self, attr).content
         return d
 
-    def __getattr__(self, item):
-        if item not in self.fields:
-            raise AttributeError("%r object has no attribute %r" % (self.__class__.__name__, item))
-
-        if self._is_none():
-            raise AttributeError("Cannot access to fields in a None record")
-
-        try:
-            return self._content[item]
-        except KeyError:
-            raise AttributeError
+    content = property(_as_obj)
 
     def __setattr__(self, key, value):
-        if key in ("fields", "_schema", "_content"):
-            super(_Record, self).__setattr__(key, value)
-        elif key in self.fields:
-            if self._is_none():
+        if key in self._primitives:
+            if self._none:
                 self._init_fields()
-            try:
-                to_be_set = getattr(self, key)
-            except AttributeError:
-                pass
-            else:
-                if isinstance(to_be_set, _Array) or isinstance(to_be_set, _Record):
-                    raise ValueError("Cannot assign field of complex type")
-            # super(_Record, self).__setattr__(key, value)
-            self._content[key] = value
+            elif self._source is not None:
+                self._materialize()
+            _setattr(self, key, value)
+            _invalidate(self)
+        elif key in self._complex:
+            raise ValueError("Cannot assign field of complex type")
         else:
             raise AttributeError("%r object has no attribute %r" % (self.__class__.__name__, key))
 
@@ -139,31 +240,40 @@ class _Record(object):
         return repr(self._as_obj())
 
     def __eq__(self, other):
-        return self._content == other
+        if isinstance(other, _Record):
+            other = other._as_obj()
+        return self._as_obj() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+
+_RESERVED_NAMES = frozenset(dir(_Record))
 
 
 class _Array(object):
-    def __init__(self, fields):
+    __slots__ = ("_content", "_item_class", "_owner")
+
+    def __init__(self, item_class=None, owner=None):
+        # item_class is the _Record subclass of the items or None if the items are of a primitive type
         self._content = None
-        if _is_primitive_type(fields):
-            self.fields_schema = fields
-        else:
-            self.fields_schema = fields["fields"]
+        self._item_class = item_class
+        self._owner = owner
 
     content = property(lambda self: self._as_obj())
 
     def add(self, content=None):
-        if self._is_none():
+        if self._content is None:
             self._content = []
             # raise ValueError("Cannot add an item to a None array")
-        if _is_primitive_type(self.fields_schema):
+        if self._item_class is None:
             item = content
-            self._content.append(content)
         else:
-            item = _Record(self.fields_schema)
+            item = self._item_class(owner=self._owner)
             if content:
                 item.set_content(content)
-            self._content.append(item)
+        self._content.append(item)
+        _invalidate(self)
         return item
 
     def set_content(self, content):
@@ -171,31 +281,31 @@ class _Array(object):
             raise InvalidContent()
         if content is None:
             self._content = None
+            _invalidate(self)
         else:
             self._content = []
             for item in content:
                 self.add(item)
 
     def _as_obj(self):
-        if self._is_none() or _is_primitive_type(self.fields_schema):
+        if self._content is None or self._item_class is None:
             return self._content
         else:
-            d = []
-            for item in self._content:
-                d.append(item.content)
-            return d
+            return [item.content for item in self._content]
 
     def _is_none(self):
         return self._content is None
 
     def __setitem__(self, index, item):
         self._content[index] = item
+        _invalidate(self)
 
     def __getitem__(self, index):
         return self._content[index]
 
     def __delitem__(self, index):
         del self._content[index]
+        _invalidate(self)
 
     def __iter__(self):
         for item in self._content:
@@ -208,8 +318,35 @@ class _Array(object):
         return repr(self._content)
 
     def __eq__(self, other):
+        if isinstance(other, _Array):
+            other = other._content
         return self._content == other
 
+    def __ne__(self, other):
+        return not self == other
+
+
+def _field_setter(name):
+    def _set(self, value):
+        setattr(self._struct, name, value)
+    return _set
+
+
+def _compile_message(schema):
+    # Generates the Message subclass for the schema. The fields are exposed as properties that read the
+    # corresponding slot of the root _Record. The classes are kept by the Catalog of the schema
+    record_class = _compile_record(schema["fields"])
+    namespace = {
+        "schema": schema,
+        "_message_type": schema["name"],
+        "_domain": schema["namespace"],
+        "_record_class": record_class
+    }
+    for name in record_class.fields:
+        if not hasattr(Message, name):
+            namespace[name] = property(attrgetter("_struct." + name), _field_setter(name))
+    return type("Message", (Message,), namespace)
+
 
 class Message(object):
     """
@@ -270,20 +407,25 @@ class Message(object):
 
     :type message_type: `str`
     :param message_type: The type of message. It has to be a valid message type for the :attr:`catalog`
-    :type catalog: `dict`
+    :type catalog: `dict` or :class:`Catalog <clay.catalog.Catalog>`
     :param catalog: The catalog containing the structure of the message
     :type serializer: `class`
     :param serializer: the :class:`Serializer <clay.serializer.Serializer>` class to use to serialize the message
     """
+    # The serialized message, kept until the message is modified
+    _serialized = None
+
+    def __new__(cls, message_type, catalog, serializer=DummySerializer):
+        if cls is Message:
+            catalog = as_catalog(catalog)
+            if message_type not in catalog.named:
+                raise InvalidMessage(message_type)
+            cls = catalog.compiled(message_type, _compile_message)
+        return super(Message, cls).__new__(cls)
+
     def __init__(self, message_type, catalog, serializer=DummySerializer):
-        try:
-            self.schema = schema_from_name(message_type, catalog)[1]
-        except SchemaException:
-            raise InvalidMessage(message_type)
-        self._message_type = message_type
-        self._domain = self.schema["namespace"]
         self._serializer = serializer(message_type, catalog)
-        self._struct = _Record(self.schema["fields"], init=True)
+        self._struct = self._record_class(init=True, owner=self)
 
     domain = property(lambda self: self._domain, doc="The domain of the message in the catalog")
     message_type = property(lambda self: self._message_type, doc="The message type")
@@ -292,12 +434,24 @@ class Message(object):
 
     def serialize(self):
         """
-        Serializes the message using the :class:`Serializer <clay.serializer.Serializer>`
+        Serializes the message using the :class:`Serializer <clay.serializer.Serializer>`. The result is cached and
+        returned by the next calls until the message is modified. A message retrieved by a
+        :class:`MessageFactory <clay.factory.MessageFactory>` returns the data it was retrieved from.
 
         :rtype: `str`
         :return: The serialized message
         """
-        return self._serializer.serialize(self._struct.content)
+        if self._serialized is None:
+            self._serialized = self._serializer.serialize(self._struct.content)
+        return self._serialized
+
+    @classmethod
+    def _from_source(cls, message_type, catalog, serializer, source):
+        # Creates a message whose fields are decoded from the LazyPayload source when they are accessed
+        message = cls.__new__(cls, message_type, catalog, serializer)
+        message._serializer = serializer(message_type, catalog)
+        message._struct = message._record_class._from_source(source, message)
+        return message
 
     def set_content(self, content=None):
         """
@@ -312,25 +466,13 @@ class Message(object):
         if content is not None:
             self._struct.set_content(content)
 
-    def __setattr__(self, name, value):
-        if name in ("schema", "_message_type", "_domain", "_serializer", "_struct"):
-            super(Message, self).__setattr__(name, value)
-        else:
-            try:
-                setattr(self._struct, name, value)
-            except AttributeError:
-                super(Message, self).__setattr__(name, value)
-
-    def __getattr__(self, name):
-        try:
-            return getattr(self._struct, name)
-        except:
-            raise AttributeError("%r object has no attribute %r" % (self.__class__.__name__, name))
-
     def __eq__(self, other):
         return self.schema == other.schema and \
             self.message_type == other.message_type and \
             self.domain == other.domain and \
             self.content == other.content
 
+    def __ne__(self, other):
+        return not self == other
+
 # vim:tabstop=4:expandtab
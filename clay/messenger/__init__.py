@@ -1,16 +1,77 @@
-import sys
 import logging
-from .. import CustomLoader
-from ..exceptions import MissingDependency
+import threading
+
+from .future import Future
+from .iterator import MessageIterator
+from .router import MessageRouter
+from .spool import Spool, SpoolFlusher
+from .. import lazy_module
 
 
 class Messenger(object):
+    """
+    Base class of the messengers. When a message cannot be sent because the broker is not reachable, the messengers
+    store it serialized in a :class:`Spool <clay.messenger.spool.Spool>` and a background
+    :class:`SpoolFlusher <clay.messenger.spool.SpoolFlusher>` sends it again when the broker is back.
+    By default the spool keeps the messages in memory: use :meth:`set_spool` to configure it.
+    """
     def __init__(self):
-        pass
+        self._spool = Spool()
+        self._spool_flusher = None
+        self._spool_lock = threading.Lock()
 
     def send(self, message):
         pass
 
+    def set_spool(self, directory=None, max_memory=16 * 2 ** 20, max_disk=2 ** 30, segment_size=16 * 2 ** 20):
+        """
+        Configure the spool of the messages that could not be sent. The messages already in the spool are moved
+        to the new one. If the directory contains the spool of a previous run, its messages are sent again.
+        See :class:`Spool <clay.messenger.spool.Spool>` for the description of the parameters.
+        """
+        spool = Spool(directory, max_memory, max_disk, segment_size)
+        with self._spool_lock:
+            self._stop_spool_flusher()
+            old_spool, self._spool = self._spool, spool
+            while len(old_spool):
+                spool.put(*old_spool.pop())
+            old_spool.close()
+            if len(spool):
+                self._start_spool_flusher()
+
+    def _spool_message(self, domain, message_type, body, error=None):
+        with self._spool_lock:
+            if self._spool.put(domain, message_type, body):
+                print "No connection, queuing"
+                print "There are {0} messages in the queue".format(len(self._spool))
+            else:
+                print "No connection and the queue is full: the message is dropped"
+            if error is not None:
+                print error
+            if self._spool_flusher is None:
+                self._start_spool_flusher()
+
+    def _start_spool_flusher(self):
+        self._spool_flusher = SpoolFlusher(self._spool, self._send_serialized)
+        self._spool_flusher.start()
+
+    def _stop_spool_flusher(self):
+        # the flusher is joined, so that it doesn't send again an entry moved to a new spool
+        flusher, self._spool_flusher = self._spool_flusher, None
+        if flusher is not None:
+            flusher.stop()
+            flusher.join()
+
+    def _close_spool(self):
+        with self._spool_lock:
+            self._stop_spool_flusher()
+            self._spool.close()
+
+    def _send_serialized(self, domain, message_type, body):
+        # Sends a serialized message. It is used to send the spooled messages and it must raise an exception if
+        # sending fails
+        raise NotImplementedError()
+
 
 class Dummy(Messenger):
     def __init__(self):
@@ -19,32 +80,19 @@ class Dummy(Messenger):
     def send(self, serializer):
         print("Dummy using messenger", serializer.serialize())
 
-# Imports the other Messengers
-try:
-    from .amqp_messenger import AMQPMessenger, AMQPReceiver
-except MissingDependency as md:
-    pass
-
-try:
-    from .mqtt_messenger import MQTTMessenger, MQTTReceiver
-except MissingDependency:
-    pass
-
-try:
-    from .kafka_messenger import KafkaMessenger, KafkaError
-except MissingDependency:
-    pass
-
-class _MessengerLoader(CustomLoader):
-
-    DEPENDENCIES = {
-        "clay.messenger.AMQPMessenger": "pika",
-        "clay.messenger.AMQPReceiver": "pika",
-        "clay.messenger.MQTTMessenger": "paho",
-        "clay.messenger.MQTTReceiver": "paho",
-        "clay.messenger.KafkaMessenger": "kafka",
-    }
-
-sys.meta_path.append(_MessengerLoader())
+# The loopback and socket messengers have no dependencies: they are imported after Messenger, which they subclass
+from .loopback_messenger import LoopbackMessenger, LoopbackReceiver
+from .socket_messenger import SocketMessenger, SocketReceiver
+
+# The other Messengers are imported on first access, so that their dependencies are loaded only when needed
+lazy_module(__name__, {
+    "AMQPMessenger": ((".amqp_messenger",), "pika"),
+    "AMQPReceiver": ((".amqp_messenger",), "pika"),
+    "MQTTMessenger": ((".mqtt_messenger",), "paho"),
+    "MQTTReceiver": ((".mqtt_messenger",), "paho"),
+    "KafkaMessenger": ((".kafka_messenger",), "kafka"),
+    "KafkaReceiver": ((".kafka_messenger",), "kafka"),
+    "KafkaError": ((".kafka_messenger",), "kafka"),
+})
 
 # vim:tabstop=4:expandtab
@@ -1,6 +1,12 @@
 import Queue
 import logging
 import ssl
+import threading
+import time
+import traceback
+import uuid
+from collections import deque
+from functools import partial
 
 from ..exceptions import MissingDependency
 
@@ -16,8 +22,140 @@ from pika.exceptions import AMQPConnectionError, ChannelClosed
 
 # Clay library imports
 from . import Messenger
+from .future import Future
+from .workers import WorkerPool
 from ..exceptions import MessengerError, MessengerErrorConnectionRefused, MessengerErrorNoApplicationName, \
-    MessengerErrorNoHandler, MessengerErrorNoQueue
+    MessengerErrorNoHandler, MessengerErrorNoQueue, MessengerErrorTimeout
+
+
+class _PooledChannel(object):
+    # A connection to the broker with its channel. pika connections are not thread safe, so every pooled channel
+    # has its own connection and it is used by one thread at a time
+    def __init__(self, conn_param):
+        self.connection = pika.BlockingConnection(conn_param)
+        self.channel = self.connection.channel()
+
+    def close(self):
+        try:
+            self.connection.close()
+        except Exception:
+            pass
+
+
+class _ReplyConsumer(threading.Thread):
+    # Thread that consumes the responses to the requests of a messenger from its reply queue and completes their
+    # futures, matching them by correlation id. It has its own connection, since pika connections are not thread
+    # safe, and it reads from the broker only while some responses are expected
+    def __init__(self, conn_param):
+        super(_ReplyConsumer, self).__init__(name="AMQPReplyConsumer")
+        self.daemon = True
+        self._connection = pika.BlockingConnection(conn_param)
+        channel = self._connection.channel()
+        self.queue = channel.queue_declare(exclusive=True).method.queue
+        channel.basic_consume(self._on_reply, queue=self.queue, no_ack=True)
+
+        self._futures = {}
+        self._cond = threading.Condition()
+        self._stopped = False
+
+    def add(self, correlation_id, future, deadline=None):
+        with self._cond:
+            if self._stopped:
+                return False
+            self._futures[correlation_id] = (future, deadline)
+            self._cond.notify()
+            return True
+
+    def discard(self, correlation_id):
+        with self._cond:
+            self._futures.pop(correlation_id, None)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def _on_reply(self, channel, method, properties, body):
+        with self._cond:
+            future, deadline = self._futures.pop(properties.correlation_id, (None, None))
+        if future is not None:
+            future.set_result(body)
+
+    def _expire(self):
+        now = time.time()
+        with self._cond:
+            expired = [correlation_id for correlation_id, (future, deadline) in self._futures.iteritems()
+                       if deadline is not None and deadline <= now]
+            futures = [self._futures.pop(correlation_id)[0] for correlation_id in expired]
+        for future in futures:
+            future.set_exception(MessengerErrorTimeout())
+
+    def run(self):
+        error = MessengerError()
+        try:
+            while True:
+                with self._cond:
+                    while not self._futures and not self._stopped:
+                        self._cond.wait()
+                    if self._stopped:
+                        break
+                self._connection.process_data_events()
+                self._expire()
+        except Exception:
+            # the connection was lost: the responses cannot be received anymore
+            error = MessengerError("ERROR_CONREFUSED")
+        finally:
+            with self._cond:
+                self._stopped = True
+                futures, self._futures = self._futures, {}
+            for future, deadline in futures.itervalues():
+                future.set_exception(error)
+            try:
+                self._connection.close()
+            except Exception:
+                pass
+
+
+class _Acknowledger(object):
+    # Acknowledges the deliveries of a channel in batches, with multiple=True. With a worker pool the deliveries
+    # complete out of order: a batch acknowledges the deliveries up to the last one completed successfully whose
+    # preceding deliveries are all completed. The failed deliveries are requeued immediately
+    def __init__(self, channel, batch_size, interval):
+        self._channel = channel
+        self.batch_size = batch_size
+        self.interval = interval
+        self._received = deque()
+        self._completed = {}
+        self._waiting = 0
+        self._last_flush = time.time()
+
+    def received(self, delivery_tag):
+        self._received.append(delivery_tag)
+
+    def completed(self, delivery_tag, success):
+        self._completed[delivery_tag] = success
+        if success:
+            self._waiting += 1
+            if self._waiting >= self.batch_size:
+                self.flush()
+        else:
+            self._channel.basic_nack(delivery_tag=delivery_tag, requeue=True)
+
+    def flush_if_due(self):
+        if self._waiting and time.time() - self._last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        last = None
+        received, completed = self._received, self._completed
+        while received and received[0] in completed:
+            delivery_tag = received.popleft()
+            if completed.pop(delivery_tag):
+                last = delivery_tag
+                self._waiting -= 1
+        if last is not None:
+            self._channel.basic_ack(delivery_tag=last, multiple=True)
+        self._last_flush = time.time()
 
 
 class AMQPMessenger(Messenger):
@@ -25,25 +163,38 @@ class AMQPMessenger(Messenger):
     This class implements a messenger specific for the AQMP protocol (at the moment, only the RabbitMQ broker is
     supported).
 
+    The messenger keeps the connections to the broker open between two sends. Up to :attr:`pool_size` threads can
+    send messages concurrently, each one using its own connection; the other threads wait for a connection to be
+    released. Connections closed by the broker are reopened transparently.
+
     :type host: `str`
     :param host: the AMQP broker address (the RabbitMQ server host)
 
     :type port: `int`
     :param port: the RabbitMQ server port
+
+    :type pool_size: `int`
+    :param pool_size: the maximum number of connections kept open with the broker
     """
 
-    def __init__(self, host='localhost', port=5672):
+    def __init__(self, host='localhost', port=5672, pool_size=4):
+        super(AMQPMessenger, self).__init__()
         self.host = host
         self.port = port
-
-        self._message_queue = Queue.Queue()
+        self.pool_size = pool_size
 
         self._app_name = None
         self._queues = {}
-        self._response = None
         self._credentials = None
         self._tls = None
 
+        self._pool = Queue.LifoQueue()
+        self._pool_slots = threading.BoundedSemaphore(pool_size)
+        self._declared_queues = set()
+
+        self._reply_consumer = None
+        self._reply_lock = threading.Lock()
+
     def _set_application_name(self, app_name):
         self._app_name = app_name
 
@@ -82,6 +233,7 @@ class AMQPMessenger(Messenger):
                 'ssl_version': ssl.PROTOCOL_TLSv1,
                 'ciphers':     None
             }
+        self._close_connections()
 
     def set_credentials(self, username, password):
         """
@@ -98,6 +250,7 @@ class AMQPMessenger(Messenger):
 
         """
         self._credentials = pika.PlainCredentials(username, password)
+        self._close_connections()
 
     def add_queue(self, name, durable, response):
         """
@@ -137,76 +290,177 @@ class AMQPMessenger(Messenger):
         """
         return self._send(message)
 
-    def _synchronous_callback(self, channel, method, properties, body):
-        self._response = body
+    def send_async(self, message, timeout=None):
+        """
+        Serializes and sends a message without waiting for the response. The responses are received on a reply queue
+        of the messenger and matched to the requests by correlation id, so many requests can wait for their response
+        at the same time. If the queue has 'response' :const:`False` the message is published before returning and
+        the future is already completed with :const:`None`, or with the error if the message was stored to be sent
+        again.
 
-    def _send(self, message):
-        result = None
+        :type message: :class:`Message <clay.message.Message>`
+        :param message: the message to serialize and send
+
+        :type timeout: `float`
+        :param timeout: the maximum number of seconds to wait for the response. When it expires the future fails
+            with :exc:`MessengerErrorTimeout <clay.exceptions.MessengerErrorTimeout>`. If it is :const:`None` the
+            response is waited indefinitely
 
+        :returns: a :class:`Future <clay.messenger.Future>` of the response
+
+        :raises: :exc:`MessengerErrorNoQueue <clay.exceptions.MessengerErrorNoQueue>` if the queue of the message is
+           not added, :exc:`MessengerError <clay.exceptions.MessengerError>` if the request cannot be sent
+        """
         try:
             queue = self._queues[message.domain]
         except KeyError:
             raise MessengerErrorNoQueue()
 
+        if queue['response'] is True:
+            return self._request(message, timeout)
+
+        future = Future()
+        body = message.serialize()
         try:
-            routing_key = "{}.{}".format(message.domain, message.message_type)
+            self._send_serialized(message.domain, message.message_type, body)
+        except (AMQPConnectionError, ChannelClosed) as ex:
+            self._spool_message(message.domain, message.message_type, body)
+            future.set_exception(ex)
+        else:
+            future.set_result(None)
+        return future
 
-            conn_param = pika.ConnectionParameters(
-                host=self.host,
-                port=self.port,
-                credentials=self._credentials,
-                ssl=True if self._tls is not None else None,
-                ssl_options=self._tls)
+    def close(self):
+        """
+        Close the connections kept open with the broker and stop sending the spooled messages. The messenger can
+        still be used: new connections are opened by the next sends. The requests still waiting for their response
+        fail with :exc:`MessengerError <clay.exceptions.MessengerError>`.
+        """
+        self._close_spool()
+        self._close_connections()
+
+    def _close_connections(self):
+        self._close_reply_consumer()
+        while True:
+            try:
+                pooled = self._pool.get_nowait()
+            except Queue.Empty:
+                break
+            pooled.close()
+        self._declared_queues.clear()
+
+    def _connection_parameters(self):
+        return pika.ConnectionParameters(
+            host=self.host,
+            port=self.port,
+            credentials=self._credentials,
+            ssl=True if self._tls is not None else None,
+            ssl_options=self._tls)
 
-            connection = pika.BlockingConnection(conn_param)
-            channel = connection.channel()
+    def _publish(self, pooled, domain, routing_key, body, properties):
+        channel = pooled.channel
 
-            # Checks if the queue is declared, but does not create it if not exists
-            channel.queue_declare(queue=message.domain, passive=True)
-
-            if self._queues[message.domain]['response'] is True:
-                result = channel.queue_declare(exclusive=True)
-                callback_queue = result.method.queue
-
-                channel.basic_consume(self._synchronous_callback,
-                                      queue=callback_queue,
-                                      no_ack=True)
-
-                channel.basic_publish(
-                    exchange=self._app_name,
-                    routing_key=routing_key,
-                    body=message.serialize(),
-                    mandatory=True,
-                    properties=pika.BasicProperties(
-                        reply_to=callback_queue
-                    )
-                )
-
-                # wait for the answer
-                while self._response is None:
-                    connection.process_data_events()
-                result = self._response
-                self._response = None
+        # Checks if the queue is declared, but does not create it if not exists
+        if domain not in self._declared_queues:
+            channel.queue_declare(queue=domain, passive=True)
+            self._declared_queues.add(domain)
 
-            else:
-                channel.basic_publish(
-                    exchange=self._app_name,
-                    routing_key=routing_key,
-                    body=message.serialize(),
-                    mandatory=True,
-                    properties=pika.BasicProperties(
-                        delivery_mode=2
-                    )
-                )
+        channel.basic_publish(
+            exchange=self._app_name,
+            routing_key=routing_key,
+            body=body,
+            mandatory=True,
+            properties=properties
+        )
 
-            connection.close()
+    def _deliver(self, domain, message_type, body, properties):
+        # Publishes the message using a pooled connection. It raises AMQPConnectionError or ChannelClosed
+        # if the message cannot be published
+        routing_key = "{}.{}".format(domain, message_type)
+
+        self._pool_slots.acquire()
+        try:
+            try:
+                pooled = self._pool.get_nowait()
+            except Queue.Empty:
+                pooled = None
+
+            if pooled is not None:
+                try:
+                    self._publish(pooled, domain, routing_key, body, properties)
+                except (AMQPConnectionError, ChannelClosed):
+                    # the connection was closed while it was in the pool: it will be opened again
+                    pooled.close()
+                    pooled = None
+                    self._declared_queues.discard(domain)
+                else:
+                    self._pool.put(pooled)
+                    return
+
+            try:
+                pooled = _PooledChannel(self._connection_parameters())
+                self._publish(pooled, domain, routing_key, body, properties)
+            except (AMQPConnectionError, ChannelClosed):
+                if pooled is not None:
+                    pooled.close()
+                self._declared_queues.discard(domain)
+                raise
+            self._pool.put(pooled)
+        finally:
+            self._pool_slots.release()
+
+    def _get_reply_consumer(self):
+        with self._reply_lock:
+            if self._reply_consumer is None or not self._reply_consumer.is_alive():
+                self._reply_consumer = _ReplyConsumer(self._connection_parameters())
+                self._reply_consumer.start()
+            return self._reply_consumer
+
+    def _close_reply_consumer(self):
+        with self._reply_lock:
+            consumer, self._reply_consumer = self._reply_consumer, None
+        if consumer is not None:
+            consumer.stop()
+
+    def _send_serialized(self, domain, message_type, body):
+        self._deliver(domain, message_type, body, pika.BasicProperties(delivery_mode=2))
+
+    def _request(self, message, timeout=None):
+        # Sends the message to a queue with response and returns the future of the response
+        body = message.serialize()
+        future = Future()
+        deadline = None if timeout is None else time.time() + timeout
+        correlation_id = uuid.uuid4().hex
+        consumer = None
+        try:
+            consumer = self._get_reply_consumer()
+            if not consumer.add(correlation_id, future, deadline):
+                # the consumer lost its connection after it was returned
+                raise AMQPConnectionError()
+            self._deliver(message.domain, message.message_type, body,
+                          pika.BasicProperties(reply_to=consumer.queue, correlation_id=correlation_id))
         except (AMQPConnectionError, ChannelClosed):
-            if queue['response'] is False:
-                self._message_queue.put(message)
-                print "No connection, queuing"
-                print "There are {0} messages in the queue".format(self._message_queue.qsize())
-            else:
-                raise MessengerError("ERROR_CONREFUSED")
+            if consumer is not None:
+                consumer.discard(correlation_id)
+            raise MessengerError("ERROR_CONREFUSED")
+        return future
+
+    def _send(self, message):
+        result = None
+
+        try:
+            queue = self._queues[message.domain]
+        except KeyError:
+            raise MessengerErrorNoQueue()
+
+        if queue['response'] is True:
+            return self._request(message).result()
+
+        body = message.serialize()
+        try:
+            self._send_serialized(message.domain, message.message_type, body)
+        except (AMQPConnectionError, ChannelClosed):
+            self._spool_message(message.domain, message.message_type, body)
 
         return result
 
@@ -236,6 +490,15 @@ class AMQPReceiver(object):
         self._credentials = None
         self._tls = None
 
+        self._workers = None
+        self._pool = None
+        self._completions = Queue.Queue()
+        self._prefetch = None
+        self._acknowledger = None
+        self._consumer_tag = None
+        self._running = False
+        self._consume_loop_running = False
+
     def _set_application_name(self, app_name):
         try:
             self._app_name = app_name
@@ -310,13 +573,158 @@ class AMQPReceiver(object):
         """
         self._queue = {'name': queue_name, 'durable': durable, 'response': response}
 
+    def set_workers(self, workers=4, queue_size=64, processes=False):
+        """
+        Run the handler in a :class:`WorkerPool <clay.messenger.workers.WorkerPool>` instead of the thread that
+        reads from the broker, so that slow handlers don't block the connection. The messages are acknowledged
+        manually, as with :meth:`set_prefetch`, and the prefetch count is at most :attr:`queue_size`: when the pool
+        is full the broker stops sending messages until a handler completes and its message is acknowledged.
+
+        :type workers: `int`
+        :param workers: the number of threads or processes that run the handler
+
+        :type queue_size: `int`
+        :param queue_size: the maximum number of messages waiting or running in the pool
+
+        :type processes: `boolean`
+        :param processes: if :const:`True` the handler runs in a pool of processes, so it must be picklable
+
+        If :meth:`set_workers()` is invoked with `workers` equal to 0, the handler runs again in the receiver thread.
+
+        .. note::
+            The workers must be set using :meth:`set_workers()` before :meth:`run()` is invoked.
+        """
+        if workers == 0:
+            self._workers = None
+        else:
+            self._workers = {'workers': workers, 'queue_size': queue_size, 'processes': processes}
+
+    def set_prefetch(self, prefetch_count=100, ack_batch_size=10, ack_interval=1.0):
+        """
+        Acknowledge the messages manually, after the handler has processed them, and limit to
+        :attr:`prefetch_count` the messages sent by the broker and not yet acknowledged. The acknowledgements are sent
+        in batches, when :attr:`ack_batch_size` messages have been processed or every :attr:`ack_interval` seconds.
+        The messages whose handler raises an exception are sent back to the queue.
+
+        :type prefetch_count: `int`
+        :param prefetch_count: the maximum number of messages not yet acknowledged
+
+        :type ack_batch_size: `int`
+        :param ack_batch_size: the number of processed messages acknowledged together
+
+        :type ack_interval: `float`
+        :param ack_interval: the maximum number of seconds a processed message waits for its acknowledgement
+
+        If :meth:`set_prefetch()` is invoked with `prefetch_count` equal to 0, the messages are acknowledged by the
+        broker when they are sent, as by default, unless the workers are set.
+
+        .. note::
+            The prefetch must be set using :meth:`set_prefetch()` before :meth:`run()` is invoked.
+        """
+        if prefetch_count == 0:
+            self._prefetch = None
+        else:
+            self._prefetch = {'prefetch_count': prefetch_count, 'ack_batch_size': ack_batch_size,
+                              'ack_interval': ack_interval}
+
+    def _reply(self, properties, result):
+        if self._queue['response'] is True:
+            self._channel.basic_publish('', routing_key=properties.reply_to, body=result,
+                                        properties=pika.BasicProperties(correlation_id=properties.correlation_id))
+
     def _handler_wrapper(self, channel, method, properties, body):
         if self.handler is None:
             raise MessengerErrorNoHandler()
         message_type = method.routing_key.split('.')[-1]
-        res = self.handler(body, message_type)
-        if self._queue['response'] is True:
-            channel.basic_publish('', routing_key=properties.reply_to, body=res)
+        acknowledger = self._acknowledger
+        if acknowledger is not None:
+            acknowledger.received(method.delivery_tag)
+
+        if self._pool is not None:
+            self._pool.submit(body, message_type, partial(self._completed, method.delivery_tag, properties))
+        elif acknowledger is None:
+            self._reply(properties, self.handler(body, message_type))
+        else:
+            try:
+                result = self.handler(body, message_type)
+            except Exception:
+                traceback.print_exc()
+                acknowledger.completed(method.delivery_tag, False)
+            else:
+                self._reply(properties, result)
+                acknowledger.completed(method.delivery_tag, True)
+
+    def _completed(self, delivery_tag, properties, success, result):
+        # called by the workers: the results are sent by the receiver thread, since the channel is not thread safe
+        self._completions.put((delivery_tag, properties, success, result))
+
+    def _process_completions(self):
+        while True:
+            try:
+                delivery_tag, properties, success, result = self._completions.get_nowait()
+            except Queue.Empty:
+                return
+            if success:
+                self._reply(properties, result)
+            if self._acknowledger is not None:
+                self._acknowledger.completed(delivery_tag, success)
+
+    def _consume(self):
+        return self._channel.basic_consume(self._handler_wrapper, queue=self._queue['name'],
+                                           no_ack=self._acknowledger is None)
+
+    def _get_prefetch(self):
+        # With the workers the messages are always acknowledged manually and the prefetch window is not larger than
+        # the pool, so the broker stops sending messages while the pool is full. The acknowledgements are sent before
+        # the window is exhausted
+        prefetch = self._prefetch
+        if self._workers is None:
+            return prefetch
+        queue_size = self._workers['queue_size']
+        if prefetch is None:
+            prefetch = {'prefetch_count': queue_size, 'ack_batch_size': 10, 'ack_interval': 1.0}
+        prefetch_count = min(prefetch['prefetch_count'], queue_size)
+        return {'prefetch_count': prefetch_count,
+                'ack_batch_size': min(prefetch['ack_batch_size'], max(1, prefetch_count // 2)),
+                'ack_interval': prefetch['ack_interval']}
+
+    def _start_consuming(self):
+        self._acknowledger = None
+        prefetch = self._get_prefetch()
+        if prefetch is not None:
+            self._channel.basic_qos(prefetch_count=prefetch['prefetch_count'])
+            self._acknowledger = _Acknowledger(self._channel, prefetch['ack_batch_size'], prefetch['ack_interval'])
+
+        self._running = True
+        self._consumer_tag = self._consume()
+        self._consume_loop_running = True
+        self._consume_loop()
+
+    def _consume_loop(self):
+        # The loop reads from the broker, sends the results of the workers and the acknowledgements until stop is
+        # invoked, from any thread
+        pool = None
+        if self._workers is not None:
+            pool = self._pool = WorkerPool(self.handler, **self._workers)
+            pool.start()
+        try:
+            while self._running:
+                self._connection.process_data_events()
+                self._process_completions()
+                if self._acknowledger is not None:
+                    self._acknowledger.flush_if_due()
+        finally:
+            self._pool = None
+            if pool is not None:
+                pool.stop()
+            try:
+                # the messages already processed are acknowledged, the others are sent again by the broker
+                self._process_completions()
+                if self._acknowledger is not None:
+                    self._acknowledger.flush()
+                self._connection.close()
+            except Exception:
+                pass
 
     def run(self):
         conn_param = pika.ConnectionParameters(
@@ -354,14 +762,23 @@ class AMQPReceiver(object):
                 queue=self._queue['name'],
                 routing_key="{}.*".format(self._queue['name']))
 
-            # channel.basic_qos(prefetch_count=1)
-            self._channel.basic_consume(self._handler_wrapper, queue=self._queue['name'], no_ack=True)
-
-            self._channel.start_consuming()
+            self._start_consuming()
         except AMQPConnectionError:
             raise MessengerErrorConnectionRefused()
+        finally:
+            self._running = False
+            self._consume_loop_running = False
 
     def stop(self):
+        """
+        Stop the receiver. It can be invoked from any thread: :meth:`run` returns after acknowledging the messages
+        already handled.
+        """
+        if self._consume_loop_running:
+            # the loop acknowledges the messages already processed and closes the connection
+            self._running = False
+            return
+        self._running = False
         try:
             self._channel.stop_consuming()
             self._connection.close()
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2015, CRS4
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import threading
+import time
+import traceback
+
+from ..exceptions import MessengerErrorTimeout
+
+
+class Future(object):
+    """
+    The result of an asynchronous operation of a messenger, e.g. the response to a message sent with
+    :meth:`AMQPMessenger.send_async <clay.messenger.AMQPMessenger.send_async>`. It has the same interface as
+    :class:`concurrent.futures.Future`, without cancellation.
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        """
+        Return :const:`True` if the operation is completed
+        """
+        return self._done
+
+    def result(self, timeout=None):
+        """
+        Return the result of the operation, waiting for it at most :attr:`timeout` seconds
+
+        :raises: :exc:`MessengerErrorTimeout <clay.exceptions.MessengerErrorTimeout>` if the operation is not completed
+            before the timeout, or the exception of the operation if it failed
+        """
+        self._wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """
+        Return the exception of the operation or :const:`None` if it succeeded, waiting for it at most
+        :attr:`timeout` seconds
+
+        :raises: :exc:`MessengerErrorTimeout <clay.exceptions.MessengerErrorTimeout>` if the operation is not completed
+            before the timeout
+        """
+        self._wait(timeout)
+        return self._exception
+
+    def add_done_callback(self, callback):
+        """
+        Call :attr:`callback` with the future when the operation is completed. If it is already completed, the
+        callback is called immediately
+        """
+        with self._cond:
+            if not self._done:
+                self._callbacks.append(callback)
+                return
+        self._call(callback)
+
+    def set_result(self, result):
+        """
+        Complete the operation with the result. It is used by the messengers
+
+        :return: :const:`False` if the operation was already completed
+        """
+        return self._complete(result, None)
+
+    def set_exception(self, exception):
+        """
+        Complete the operation with the exception. It is used by the messengers
+
+        :return: :const:`False` if the operation was already completed
+        """
+        return self._complete(None, exception)
+
+    def _complete(self, result, exception):
+        with self._cond:
+            if self._done:
+                return False
+            self._result, self._exception, self._done = result, exception, True
+            callbacks, self._callbacks = self._callbacks, []
+            self._cond.notify_all()
+        for callback in callbacks:
+            self._call(callback)
+        return True
+
+    def _call(self, callback):
+        try:
+            callback(self)
+        except Exception:
+            traceback.print_exc()
+
+    def _wait(self, timeout):
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while not self._done:
+                if deadline is None:
+                    self._cond.wait()
+                elif deadline > time.time():
+                    self._cond.wait(deadline - time.time())
+                else:
+                    raise MessengerErrorTimeout()
+
+# vim:tabstop=4:expandtab
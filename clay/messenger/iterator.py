@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2015, CRS4
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import sys
+import threading
+from collections import deque
+
+
+class MessageIterator(object):
+    """
+    Consume the messages of a receiver by iteration instead of with a handler. The receiver runs in a background
+    thread and the messages wait in a bounded queue: when :attr:`queue_size` messages are waiting, the receiver stops
+    reading from the broker until the iteration takes one. The iteration yields the tuples (message body, message
+    type) and ends after :meth:`stop` is invoked, or raises the error of the receiver if it fails.
+
+    The handler of the receiver is replaced and returns :const:`None`, so the iterator can't be used with a queue with
+    'response' :const:`True`. When it is used with the manual acknowledgements, the messages are acknowledged when they
+    are added to the queue.
+
+    If the receiver supports the workers, as :class:`AMQPReceiver <clay.messenger.AMQPReceiver>` and
+    :class:`MQTTReceiver <clay.messenger.MQTTReceiver>`, the messages are added to the queue by a single worker, so
+    the thread that reads from the broker never waits for the iteration: while the queue is full the worker waits
+    and, when :attr:`queue_size` more messages are pending, the receiver stops reading or the broker stops sending
+    as with a full :class:`WorkerPool <clay.messenger.workers.WorkerPool>`. The other receivers wait in the handler.
+
+    :type receiver: :class:`AMQPReceiver <clay.messenger.AMQPReceiver>`,
+        :class:`MQTTReceiver <clay.messenger.MQTTReceiver>` or :class:`KafkaReceiver <clay.messenger.KafkaReceiver>`
+    :param receiver: the receiver, with its application name and queue already set
+
+    :type queue_size: `int`
+    :param queue_size: the maximum number of messages waiting for the iteration
+    """
+
+    def __init__(self, receiver, queue_size=64):
+        self.receiver = receiver
+        self.queue_size = queue_size
+        self._messages = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+        self._ended = False
+        self._error = None
+
+    def start(self):
+        """
+        Start the receiver. It is invoked by the iteration if it is not invoked before
+        """
+        if self._thread is not None:
+            return
+        self.receiver.handler = self._put
+        if hasattr(self.receiver, 'set_workers'):
+            # a single worker keeps the order of the messages
+            self.receiver.set_workers(workers=1, queue_size=self.queue_size)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stop the receiver, waiting at most :attr:`timeout` seconds for it to stop. The messages already received are
+        still yielded by the iteration
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self.receiver.stop()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _put(self, body, message_type):
+        # the worker, or the receiver without workers, waits while the queue is full, unless the iterator is stopped
+        with self._cond:
+            while len(self._messages) >= self.queue_size and not self._stopped:
+                self._cond.wait()
+            if not self._stopped:
+                self._messages.append((body, message_type))
+                self._cond.notify_all()
+
+    def _run(self):
+        error = None
+        try:
+            self.receiver.run()
+        except Exception:
+            error = sys.exc_info()
+        with self._cond:
+            self._stopped = self._ended = True
+            self._error = error
+            self._cond.notify_all()
+
+    def __iter__(self):
+        self.start()
+        return self
+
+    def next(self):
+        with self._cond:
+            while not self._messages and not self._ended:
+                self._cond.wait()
+            if self._messages:
+                item = self._messages.popleft()
+                self._cond.notify_all()
+                return item
+            error, self._error = self._error, None
+        if error is not None:
+            raise error[0], error[1], error[2]
+        raise StopIteration()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop()
+
+# vim:tabstop=4:expandtab
@@ -1,16 +1,21 @@
-import Queue
+import re
+import threading
+import time
 
 from ..exceptions import MissingDependency
 try:
-    from kafka import client as KafkaClient
+    from kafka import KafkaProducer, KafkaConsumer
 except ImportError:
     raise MissingDependency("kafka")
 
-from kafka import producer as SimpleProducer
+from kafka.errors import NoBrokersAvailable
+from kafka.structs import OffsetAndMetadata
 
 # Clay library imports
 from . import Messenger
-from ..exceptions import MessengerError
+from .future import Future
+from ..exceptions import MessengerError, MessengerErrorConnectionRefused, MessengerErrorNoApplicationName, \
+    MessengerErrorNoHandler, MessengerErrorNoQueue
 
 
 class KafkaError(MessengerError):
@@ -21,22 +26,37 @@ class KafkaMessenger(Messenger):
     """
     This class implements a messenger specific for the Kafka broker.
 
+    The messenger creates a producer on the first send and keeps it for all the following messages. The messages are
+    sent asynchronously: the producer collects them in batches of at most :attr:`batch_size` bytes per partition,
+    waiting up to :attr:`linger_ms` milliseconds for a batch to fill. Use :meth:`flush` to wait for the delivery of
+    the messages sent and :meth:`close` when the messenger is not needed anymore.
+
     :type host: `str`
     :param host: the Kafka broker address
 
     :type port: `int`
     :param port: the Kafka server port
+
+    :type batch_size: `int`
+    :param batch_size: the maximum size in bytes of a batch of messages sent to a partition
+
+    :type linger_ms: `int`
+    :param linger_ms: the maximum time in milliseconds a message waits for its batch to fill before being sent
     """
 
-    def __init__(self, host='localhost', port=9092):
+    def __init__(self, host='localhost', port=9092, batch_size=16384, linger_ms=5):
+        super(KafkaMessenger, self).__init__()
         self.host = host
         self.port = port
+        self.batch_size = batch_size
+        self.linger_ms = linger_ms
         self._url = "{:s}:{:d}".format(self.host, self.port)
 
-        self._spooling_queue = Queue.Queue()
-
         self._queues = {}
 
+        self._producer = None
+        self._producer_lock = threading.Lock()
+
     def set_credentials(self, username, password):
         """
         .. warning::
@@ -55,17 +75,78 @@ class KafkaMessenger(Messenger):
         self._queues[queue_name] = {'durable': durable, 'response': response}
         return True
 
-    def send(self, message):
+    def send(self, message, callback=None):
         """
-        Send the message.
+        Send the message asynchronously. If the message cannot be delivered it is stored to be sent again.
 
         :type message: :class:`Message <clay.message.Message>`
         :param message: the message to send. It must be an object of the :class:`Message <clay.message.Message>` class
            or a subclass that implements the :meth:`serialize <clay.message.Message.serialize>` method.
+
+        :type callback: `callable`
+        :param callback: if present, a function called with the metadata of the record when the message is delivered
+
+        :returns: the future of the delivery or :const:`None` if the message could not be sent to the producer
+        """
+        return self._send(message, callback)
+
+    def send_async(self, message):
+        """
+        Send the message asynchronously, returning a future completed when the message is delivered.
+
+        :type message: :class:`Message <clay.message.Message>`
+        :param message: the message to send
+
+        :returns: a :class:`Future <clay.messenger.Future>` whose result is the metadata of the record. If the message
+           cannot be delivered it is stored to be sent again and the future fails with the error
+        """
+        future = Future()
+        result = self._send(message, future.set_result)
+        if result is None:
+            future.set_exception(KafkaError("The message could not be sent to the producer"))
+        else:
+            result.add_errback(future.set_exception)
+        return future
+
+    def flush(self, timeout=None):
+        """
+        Wait until all the messages sent are delivered or failed.
+
+        :type timeout: `float`
+        :param timeout: the maximum number of seconds to wait. If it is :const:`None` it waits indefinitely
         """
-        return self._send(message)
+        if self._producer is not None:
+            self._producer.flush(timeout)
 
-    def _send(self, message):
+    def close(self, timeout=None):
+        """
+        Deliver the messages sent, close the producer and stop sending the spooled messages. The messenger can still
+        be used: a new producer is created by the next send.
+
+        :type timeout: `float`
+        :param timeout: the maximum number of seconds to wait for the delivery. If it is :const:`None` it waits
+            indefinitely
+        """
+        self._close_spool()
+        with self._producer_lock:
+            producer, self._producer = self._producer, None
+        if producer is not None:
+            producer.close(timeout)
+
+    def _get_producer(self):
+        with self._producer_lock:
+            if self._producer is None:
+                self._producer = KafkaProducer(bootstrap_servers=self._url,
+                                               batch_size=self.batch_size,
+                                               linger_ms=self.linger_ms)
+            return self._producer
+
+    def _send_serialized(self, domain, message_type, body):
+        # the spooled messages are sent one at a time: the next one is sent only when this is delivered
+        routing_key = "{}-{}".format(domain, message_type)
+        self._get_producer().send(routing_key, body).get()
+
+    def _send(self, message, callback=None):
         result = None
 
         try:
@@ -73,19 +154,144 @@ class KafkaMessenger(Messenger):
         except KeyError:
             raise KafkaError("No queue specified for this message")
 
+        body = message.serialize()
         try:
             routing_key = "{}-{}".format(message.domain, message.message_type)
-            client = KafkaClient(self._url)
-            producer = SimpleProducer(client)
-            producer.send_messages(
-                routing_key,
-                message.serialize())
+            result = self._get_producer().send(routing_key, body)
         except Exception as ex:
-            self._spooling_queue.put(message)
-            print "No connection, queuing"
-            print "There are {0} messages in the queue".format(self._spooling_queue.qsize())
-            print ex
+            self._spool_message(message.domain, message.message_type, body, ex)
+        else:
+            result.add_errback(self._spool_message, message.domain, message.message_type, body)
+            if callback is not None:
+                result.add_callback(callback)
 
         return result
 
+
+class KafkaReceiver(object):
+    """
+    Class that implements a Kafka consumer. The receiver consumes all the topics of the queue specified in input,
+    i.e., the topics <queue>-<message_type> where the :class:`KafkaMessenger` sends the messages. The message types
+    are Avro names, which can't contain a '-', so the topics of a queue named <queue>-<suffix> are not consumed.
+
+    The receivers with the same application name belong to the same consumer group, so the partitions of the
+    topics are shared among them. The messages are fetched in batches of at most :attr:`max_records` and the
+    offsets are committed every :attr:`commit_every` messages or :attr:`commit_interval` seconds, and when the
+    receiver stops.
+
+    :type host: `str`
+    :param host: the Kafka broker address
+
+    :type port: `int`
+    :param port: the Kafka server port
+
+    :type max_records: `int`
+    :param max_records: the maximum number of messages fetched at once
+
+    :type commit_every: `int`
+    :param commit_every: the number of handled messages after which the offsets are committed
+
+    :type commit_interval: `float`
+    :param commit_interval: the number of seconds after which the offsets of the handled messages are committed
+    """
+    def __init__(self, host='localhost', port=9092, max_records=500, commit_every=1000, commit_interval=5.0):
+        self.host = host
+        self.port = port
+        self._url = "{:s}:{:d}".format(self.host, self.port)
+        self.max_records = max_records
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+
+        self.handler = None
+        self._app_name = None
+        self._queue = None
+        self._consumer = None
+        self._running = False
+
+    def _set_application_name(self, app_name):
+        self._app_name = app_name
+
+    def _get_application_name(self):
+        return self._app_name
+
+    application_name = property(_get_application_name, _set_application_name, doc="The Application Name property")
+
+    def set_credentials(self, username, password):
+        """
+        .. warning::
+            Kafka doesn't support authentication. This function is provided for interface completeness. It just does
+            nothing!
+        """
+        pass
+
+    def set_queue(self, queue_name, durable, response):
+        """
+        Set the queue whose messages the receiver will consume.
+
+        :type queue_name: `str`
+        :param queue_name: The name of the queue
+        :type durable: `boolean`
+        :param durable: It is ignored: Kafka topics are always durable
+
+        :type response: `boolean`
+        :param response: It is ignored: Kafka doesn't support responses
+        """
+        self._queue = {'name': queue_name, 'durable': durable, 'response': response}
+
+    def run(self):
+        if self._app_name is None:
+            raise MessengerErrorNoApplicationName()
+
+        if self._queue is None:
+            raise MessengerErrorNoQueue()
+
+        if self.handler is None:
+            raise MessengerErrorNoHandler()
+
+        try:
+            self._consumer = KafkaConsumer(bootstrap_servers=self._url,
+                                           group_id=self._app_name,
+                                           enable_auto_commit=False)
+        except NoBrokersAvailable:
+            raise MessengerErrorConnectionRefused()
+
+        prefix = "{}-".format(self._queue['name'])
+        self._consumer.subscribe(pattern="^{}[A-Za-z_][A-Za-z0-9_]*$".format(re.escape(prefix)))
+
+        # the offsets of the messages handled and not yet committed, by partition. Only the handled messages are
+        # committed: if a handler fails, its message and the following ones are received again
+        offsets = {}
+        uncommitted = 0
+        last_commit = time.time()
+        self._running = True
+        try:
+            while self._running:
+                batches = self._consumer.poll(timeout_ms=500, max_records=self.max_records)
+                for partition, records in batches.iteritems():
+                    for record in records:
+                        self.handler(record.value, record.topic[len(prefix):])
+                        offsets[partition] = OffsetAndMetadata(record.offset + 1, '')
+                        uncommitted += 1
+
+                if uncommitted > 0 and (uncommitted >= self.commit_every or
+                                        time.time() - last_commit >= self.commit_interval):
+                    self._consumer.commit_async(offsets)
+                    offsets = {}
+                    uncommitted = 0
+                    last_commit = time.time()
+        finally:
+            self._running = False
+            try:
+                if offsets:
+                    self._consumer.commit(offsets)
+                self._consumer.close(autocommit=False)
+            except Exception:
+                pass
+
+    def stop(self):
+        self._running = False
+
+    def __del__(self):
+        self.stop()
+
 # vim:tabstop=4:expandtab
\ No newline at end of file
@@ -0,0 +1,541 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2015, CRS4
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import Queue
+import errno
+import itertools
+import os
+import select
+import socket
+import struct
+import threading
+import traceback
+
+# Clay library imports
+from . import Messenger
+from .future import Future
+from .spool import encode_utf8
+from ..exceptions import MessengerError, MessengerErrorConnectionRefused, MessengerErrorNoApplicationName, \
+    MessengerErrorNoHandler, MessengerErrorNoQueue, MessengerErrorTimeout
+
+# A frame is its length followed by the data. A request is the request id (0 if no response is expected), the length
+# of the message type, the message type and the body; a reply is the request id, the status and the result
+_LENGTH = struct.Struct('!I')
+_REQUEST = struct.Struct('!QH')
+_REPLY = struct.Struct('!QB')
+_RESULT, _NO_RESULT, _ERROR = range(3)
+
+# The queues of the messengers and receivers of this process, by (application name, queue name)
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def _get_queue(app_name, queue_name, queue_size):
+    with _queues_lock:
+        try:
+            return _queues[(app_name, queue_name)]
+        except KeyError:
+            queue = _queues[(app_name, queue_name)] = Queue.Queue(queue_size)
+            return queue
+
+
+def _socket_path(directory, app_name, queue_name):
+    return os.path.join(directory, "{}.{}.sock".format(app_name, queue_name))
+
+
+def _send_frame(sock, header, *parts):
+    sock.sendall(''.join((_LENGTH.pack(len(header) + sum(len(part) for part in parts)), header) + parts))
+
+
+class _FrameReader(object):
+    # Reads the frames from a socket into a buffer reused for all the reads, as the _FrameDecoder of the socket
+    # messenger. The buffer grows when a frame doesn't fit in it
+    def __init__(self, sock, buffer_size=65536):
+        self.socket = sock
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._end = 0
+
+    def read(self):
+        # Return the frames completed by the data available, or None if the connection is closed
+        if self._end == len(self._buffer):
+            self._grow(2 * len(self._buffer))
+        received = self.socket.recv_into(self._view[self._end:])
+        if received == 0:
+            return None
+        self._end += received
+
+        frames = []
+        pos = 0
+        frame_size = 0
+        while self._end - pos >= _LENGTH.size:
+            length, = _LENGTH.unpack_from(self._buffer, pos)
+            frame_size = _LENGTH.size + length
+            end = pos + frame_size
+            if end > self._end:
+                break
+            frames.append(self._view[pos + _LENGTH.size:end].tobytes())
+            pos = end
+
+        # the partial frame is moved to the start of the buffer
+        if pos > 0:
+            self._buffer[:self._end - pos] = self._buffer[pos:self._end]
+            self._end -= pos
+        if frame_size > len(self._buffer):
+            self._grow(frame_size)
+        return frames
+
+    def _grow(self, size):
+        self._view = None
+        self._buffer.extend(bytearray(size - len(self._buffer)))
+        self._view = memoryview(self._buffer)
+
+
+class _Connection(object):
+    # The connection of a messenger to the socket of a receiver. The replies are read by a thread, that completes the
+    # futures of the requests
+    def __init__(self, path):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._socket.connect(path)
+        except socket.error:
+            self._socket.close()
+            raise MessengerErrorConnectionRefused()
+        self.closed = False
+        self._send_lock = threading.Lock()
+        self._futures = {}
+        self._futures_lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._reader = threading.Thread(target=self._read_replies)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def send(self, message_type, body, future=None):
+        message_type = encode_utf8(message_type)
+        request_id = 0
+        if future is not None:
+            with self._futures_lock:
+                if self.closed:
+                    raise MessengerErrorConnectionRefused()
+                request_id = next(self._ids)
+                self._futures[request_id] = future
+        try:
+            with self._send_lock:
+                _send_frame(self._socket, _REQUEST.pack(request_id, len(message_type)), message_type, body)
+        except socket.error:
+            with self._futures_lock:
+                self._futures.pop(request_id, None)
+            self.close()
+            raise MessengerErrorConnectionRefused()
+
+    def _read_replies(self):
+        reader = _FrameReader(self._socket)
+        try:
+            while True:
+                frames = reader.read()
+                if frames is None:
+                    return
+                for frame in frames:
+                    request_id, status = _REPLY.unpack_from(frame)
+                    with self._futures_lock:
+                        future = self._futures.pop(request_id, None)
+                    if future is None:
+                        continue
+                    if status == _ERROR:
+                        future.set_exception(MessengerError(frame[_REPLY.size:]))
+                    else:
+                        future.set_result(frame[_REPLY.size:] if status == _RESULT else None)
+        except socket.error:
+            pass
+        finally:
+            with self._futures_lock:
+                self.closed = True
+                futures, self._futures = self._futures, {}
+            for future in futures.itervalues():
+                future.set_exception(MessengerError("Connection closed before the response"))
+
+    def close(self):
+        self.closed = True
+        try:
+            # the shutdown wakes up the reader thread
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._socket.close()
+
+
+class LoopbackMessenger(Messenger):
+    """
+    This class implements a messenger that sends the messages to the :class:`LoopbackReceiver` of the same host,
+    without a broker. It has the same interface as :class:`AMQPMessenger <clay.messenger.AMQPMessenger>`, so it can
+    replace it when the receiver runs on the same host, or in the tests and the benchmarks.
+
+    If :attr:`directory` is :const:`None` the messages are put in a bounded queue of the process, shared with the
+    receivers of the same application and queue, and :meth:`send` waits at most :attr:`timeout` seconds while the
+    queue is full, then the message is stored to be sent again. Otherwise they are
+    sent to the Unix socket of the receiver in the directory, so the receiver can run in another process: the
+    messenger connects on the first send and keeps the connection open.
+
+    :type directory: `str`
+    :param directory: the directory of the Unix sockets of the receivers, or :const:`None` to send the messages to
+        the receivers of this process
+
+    :type queue_size: `int`
+    :param queue_size: the maximum number of messages waiting in a queue of the process. It is used by the first
+        messenger or receiver that uses the queue
+
+    :type timeout: `float`
+    :param timeout: the maximum number of seconds to wait for a place in a full queue of the process, and for the
+        response in :meth:`send`. If it is :const:`None` it waits indefinitely
+    """
+
+    def __init__(self, directory=None, queue_size=1024, timeout=30.0):
+        super(LoopbackMessenger, self).__init__()
+        self.directory = directory
+        self.queue_size = queue_size
+        self.timeout = timeout
+
+        self._app_name = None
+        self._queues = {}
+        self._connections = {}
+        self._connections_lock = threading.Lock()
+
+    def _set_application_name(self, app_name):
+        self._app_name = app_name
+
+    def _get_application_name(self):
+        return self._app_name
+
+    application_name = property(_get_application_name, _set_application_name, doc="The Application Name property")
+
+    def set_credentials(self, username, password):
+        """
+        .. warning::
+            The loopback messenger doesn't support authentication. This function is provided for interface
+            completeness. It just does nothing!
+        """
+        pass
+
+    def add_queue(self, name, durable, response):
+        """
+        Add a queue to the messenger
+
+        :type name: `str`
+        :param name: Name of the queue
+
+        :type durable: `boolean`
+        :param durable: It is ignored: the messages are not stored
+
+        :type response: `boolean`
+        :param response: Flag that specifies if messages sent to the queue should expect a response or not
+        """
+        self._queues[name] = {'durable': durable, 'response': response}
+        return True
+
+    def send(self, message):
+        """
+        Serializes and sends a message to the queue with the name corresponding to the :attr:`message.domain`.
+
+        :type message: :class:`Message <clay.message.Message>`
+        :param message: the message to serialize and send
+
+        :returns: the result of the handler if the queue 'response' is :const:`True`, :const:`None` if it is
+           :const:`False`
+
+        :raises: :exc:`MessengerError <clay.exceptions.MessengerError>` if the queue 'response' is :const:`True` and
+           the message can't be sent or the handler fails, :exc:`MessengerErrorTimeout
+           <clay.exceptions.MessengerErrorTimeout>` if the response is not received within :attr:`timeout` seconds
+        """
+        return self._send(message)
+
+    def send_async(self, message, timeout=None):
+        """
+        Serializes and sends a message without waiting for the response.
+
+        :type message: :class:`Message <clay.message.Message>`
+        :param message: the message to serialize and send
+
+        :type timeout: `float`
+        :param timeout: the maximum number of seconds to wait for the response. When it expires the future fails
+            with :exc:`MessengerErrorTimeout <clay.exceptions.MessengerErrorTimeout>`. If it is :const:`None` the
+            response is waited indefinitely
+
+        :returns: a :class:`Future <clay.messenger.Future>` of the response. If the queue has 'response'
+            :const:`False` the future is already completed with :const:`None`, or with the error if the message was
+            stored to be sent again
+        """
+        queue = self._check_queue(message)
+        if queue['response'] is True:
+            return self._request(message, timeout)
+
+        future = Future()
+        body = message.serialize()
+        try:
+            self._deliver(message.domain, message.message_type, body)
+        except MessengerError as ex:
+            self._spool_message(message.domain, message.message_type, body, ex)
+            future.set_exception(ex)
+        else:
+            future.set_result(None)
+        return future
+
+    def close(self):
+        """
+        Close the connections with the receivers and stop sending the spooled messages. The messenger can still be
+        used: new connections are opened by the next send.
+        """
+        self._close_spool()
+        with self._connections_lock:
+            connections, self._connections = self._connections, {}
+        for connection in connections.itervalues():
+            connection.close()
+
+    def _get_connection(self, domain):
+        with self._connections_lock:
+            connection = self._connections.get(domain)
+            if connection is None or connection.closed:
+                connection = self._connections[domain] = \
+                    _Connection(_socket_path(self.directory, self._app_name, domain))
+            return connection
+
+    def _deliver(self, domain, message_type, body, future=None):
+        if self.directory is None:
+            try:
+                _get_queue(self._app_name, domain, self.queue_size).put((message_type, body, future),
+                                                                        timeout=self.timeout)
+            except Queue.Full:
+                raise MessengerError("The queue is full")
+        else:
+            self._get_connection(domain).send(message_type, body, future)
+
+    def _send_serialized(self, domain, message_type, body):
+        self._deliver(domain, message_type, body)
+
+    def _check_queue(self, message):
+        try:
+            queue = self._queues[message.domain]
+        except KeyError:
+            raise MessengerErrorNoQueue()
+
+        if self._app_name is None:
+            raise MessengerErrorNoApplicationName()
+        return queue
+
+    def _request(self, message, timeout=None):
+        future = Future()
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, future.set_exception, (MessengerErrorTimeout(),))
+            timer.daemon = True
+            # the timer is cancelled when the response arrives, so that its thread ends
+            future.add_done_callback(lambda _: timer.cancel())
+            timer.start()
+        try:
+            self._deliver(message.domain, message.message_type, message.serialize(), future)
+        except Exception:
+            if timer is not None:
+                timer.cancel()
+            raise
+        return future
+
+    def _send(self, message):
+        result = None
+
+        queue = self._check_queue(message)
+        if queue['response'] is True:
+            return self._request(message).result(self.timeout)
+
+        body = message.serialize()
+        try:
+            self._deliver(message.domain, message.message_type, body)
+        except MessengerError as ex:
+            self._spool_message(message.domain, message.message_type, body, ex)
+
+        return result
+
+
+class LoopbackReceiver(object):
+    """
+    Class that implements a receiver of the messages sent by a :class:`LoopbackMessenger`. It has the same interface
+    as :class:`AMQPReceiver <clay.messenger.AMQPReceiver>`: the handler is called with the body and the type of every
+    message sent to the queue and its result is the response.
+
+    If :attr:`directory` is :const:`None` the receiver reads the messages sent by the messengers of the same process.
+    Otherwise it listens on a Unix socket in the directory, named after the application and the queue, and reads
+    the messages of all the connected messengers. The receiver stops when :meth:`stop` is invoked, from any thread.
+
+    If the handler raises an exception, the traceback is printed and the request fails with a
+    :exc:`MessengerError <clay.exceptions.MessengerError>`.
+
+    :type directory: `str`
+    :param directory: the directory of the Unix socket, or :const:`None` to read the messages of this process
+
+    :type queue_size: `int`
+    :param queue_size: the maximum number of messages waiting in the queue of the process. It is used by the first
+        messenger or receiver that uses the queue
+    """
+    def __init__(self, directory=None, queue_size=1024):
+        self.directory = directory
+        self.queue_size = queue_size
+        self.handler = None
+
+        self._app_name = None
+        self._queue = None
+        self._running = False
+
+    def _set_application_name(self, app_name):
+        self._app_name = app_name
+
+    def _get_application_name(self):
+        return self._app_name
+
+    application_name = property(_get_application_name, _set_application_name, doc="The Application Name property")
+
+    def set_credentials(self, username, password):
+        """
+        .. warning::
+            The loopback receiver doesn't support authentication. This function is provided for interface
+            completeness. It just does nothing!
+        """
+        pass
+
+    def set_queue(self, queue_name, durable, response):
+        """
+        Set the queue whose messages the receiver will consume.
+
+        :type queue_name: `str`
+        :param queue_name: The name of the queue
+
+        :type durable: `boolean`
+        :param durable: It is ignored: the messages are not stored
+
+        :type response: `boolean`
+        :param response: It is ignored: the result of the handler is sent to the messengers that wait for it
+        """
+        self._queue = {'name': queue_name, 'durable': durable, 'response': response}
+
+    def run(self):
+        if self._app_name is None:
+            raise MessengerErrorNoApplicationName()
+
+        if self._queue is None:
+            raise MessengerErrorNoQueue()
+
+        if self.handler is None:
+            raise MessengerErrorNoHandler()
+
+        self._running = True
+        try:
+            if self.directory is None:
+                self._run_queue()
+            else:
+                self._run_socket()
+        finally:
+            self._running = False
+
+    def stop(self):
+        self._running = False
+
+    def _handle(self, message_type, body):
+        try:
+            return True, self.handler(body, message_type)
+        except Exception as ex:
+            traceback.print_exc()
+            return False, ex
+
+    def _run_queue(self):
+        queue = _get_queue(self._app_name, self._queue['name'], self.queue_size)
+        while self._running:
+            try:
+                message_type, body, future = queue.get(timeout=0.1)
+            except Queue.Empty:
+                continue
+            success, result = self._handle(message_type, body)
+            if future is None:
+                continue
+            if success:
+                future.set_result(result)
+            else:
+                future.set_exception(MessengerError(str(result)))
+
+    def _handle_frame(self, sock, frame):
+        request_id, length = _REQUEST.unpack_from(frame)
+        message_type = frame[_REQUEST.size:_REQUEST.size + length]
+        success, result = self._handle(message_type, frame[_REQUEST.size + length:])
+        if request_id == 0:
+            return
+        if not success:
+            status, result = _ERROR, str(result)
+        elif result is None:
+            status, result = _NO_RESULT, ''
+        elif isinstance(result, basestring):
+            status, result = _RESULT, encode_utf8(result)
+        else:
+            # the result is sent as the body of a message, like with AMQP
+            status, result = _ERROR, "The handler returned a {} instead of a str".format(type(result).__name__)
+        try:
+            _send_frame(sock, _REPLY.pack(request_id, status), result)
+        except socket.error:
+            pass
+
+    def _run_socket(self):
+        path = _socket_path(self.directory, self._app_name, self._queue['name'])
+        try:
+            os.unlink(path)
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        readers = {}
+        try:
+            listener.bind(path)
+            listener.listen(16)
+            # the messages are handled one at a time: while the handler runs, the messengers wait
+            while self._running:
+                readable, _, _ = select.select([listener] + readers.keys(), [], [], 0.1)
+                for sock in readable:
+                    if sock is listener:
+                        connection, _ = listener.accept()
+                        readers[connection] = _FrameReader(connection)
+                        continue
+                    try:
+                        frames = readers[sock].read()
+                    except socket.error:
+                        frames = None
+                    if frames is None:
+                        del readers[sock]
+                        sock.close()
+                        continue
+                    for frame in frames:
+                        self._handle_frame(sock, frame)
+        finally:
+            for sock in readers:
+                sock.close()
+            listener.close()
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def __del__(self):
+        self.stop()
+
+# vim:tabstop=4:expandtab
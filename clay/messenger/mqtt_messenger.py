@@ -1,47 +1,84 @@
-import Queue
 import socket
 import ssl
+import threading
+import time
 
 from ..exceptions import MissingDependency
 
 try:
-    from paho.mqtt import publish as MQTTPublisher
+    from paho.mqtt import client as MQTTPClient
 except ImportError:
     raise MissingDependency("paho")
 
-from paho.mqtt import client as MQTTPClient
-
 # Clay library imports
 from . import Messenger
-from ..exceptions import MessengerErrorConnectionRefused, MessengerErrorNoApplicationName, \
+from .future import Future
+from .workers import WorkerPool
+from ..exceptions import MessengerError, MessengerErrorConnectionRefused, MessengerErrorNoApplicationName, \
     MessengerErrorNoHandler, MessengerErrorNoQueue
 
+#: The payload is the serialized message encoded in base64, as expected by the receivers of the previous versions
+PAYLOAD_BASE64 = 'base64'
+#: The payload is the serialized message, without any encoding
+PAYLOAD_BINARY = 'binary'
+
+_PAYLOAD_ENCODINGS = (PAYLOAD_BASE64, PAYLOAD_BINARY)
+
+
+def _check_payload_encoding(encoding):
+    if encoding not in _PAYLOAD_ENCODINGS:
+        raise ValueError("Unknown payload encoding {!r}".format(encoding))
+
 
 class MQTTMessenger(Messenger):
     """
     This class implements a messenger specific for the MQTT protocol (at the moment, only the MQTT plugin for the
     RabbitMQ broker is supported).
 
+    The messenger connects to the broker on the first send and keeps the connection open, running the MQTT network
+    loop in a background thread. The messages are published with QoS 1 and :meth:`send` returns without waiting for
+    the acknowledgement: at most :attr:`max_inflight` messages wait for the acknowledgement at the same time, the
+    others are queued by the client. If the connection is lost, the client reconnects and sends the messages not yet
+    acknowledged again. The messages still not acknowledged when the connection is closed are spooled.
+
     :type host: `string`
     :param host: the MQTT broker address (the RabbitMQ server host)
 
     :type port: `int`
     :param port: the MQTT broker port
+
+    :type max_inflight: `int`
+    :param max_inflight: the maximum number of messages waiting for the acknowledgement of the broker
+
+    :type payload_encoding: `str`
+    :param payload_encoding: the encoding of the payloads of the application, :const:`PAYLOAD_BASE64` or
+        :const:`PAYLOAD_BINARY`. It can be changed for a single queue with :meth:`set_payload_encoding`
     """
 
-    def __init__(self, host='localhost', port=1883):
+    def __init__(self, host='localhost', port=1883, max_inflight=20, payload_encoding=PAYLOAD_BASE64):
+        super(MQTTMessenger, self).__init__()
+        _check_payload_encoding(payload_encoding)
         self.host = host
         self.port = port
-
-        self._initialized = False
-
-        self._spooling_queue = Queue.Queue()
+        self.max_inflight = max_inflight
+        self.payload_encoding = payload_encoding
 
         self._app_name = None
         self._queues = {}
         self._credentials = None
         self._tls = None
 
+        self._client = None
+        self._client_lock = threading.Lock()
+        self._pending = 0
+        self._pending_cond = threading.Condition()
+        # the messages not yet acknowledged, by message id, as pairs of the spool entry and the future of
+        # send_async (or None). The broker can acknowledge a message before publish returns its id: while some
+        # messages are being published, the ids acknowledged and not yet tracked are kept in _unclaimed
+        self._inflight = {}
+        self._unclaimed = set()
+        self._registering = 0
+
     def _set_application_name(self, app_name):
         self._app_name = app_name
 
@@ -80,18 +117,195 @@ class MQTTMessenger(Messenger):
                 'tls_version': ssl.PROTOCOL_TLSv1,
                 'ciphers':     None
             }
+        self._reset_client()
 
     def set_credentials(self, username, password):
         self._credentials = {'username': username, 'password': password}
+        self._reset_client()
 
     def add_queue(self, queue_name, durable, response):
-        self._queues[queue_name] = {'durable': durable, 'response': response}
+        self._queues[queue_name] = {'durable': durable, 'response': response, 'payload_encoding': None}
         return True
 
+    def set_payload_encoding(self, encoding, queue_name=None):
+        """
+        Set the encoding of the payloads. MQTT payloads are binary, so with :const:`PAYLOAD_BINARY` the serialized
+        messages are sent as they are; :const:`PAYLOAD_BASE64` is kept for the receivers that expect base64 payloads.
+        The receivers of the queue must use the same encoding.
+
+        :type encoding: `str`
+        :param encoding: :const:`PAYLOAD_BASE64` or :const:`PAYLOAD_BINARY`
+
+        :type queue_name: `str`
+        :param queue_name: the queue that uses the encoding. If it is :const:`None` the encoding is used by all the
+            queues of the application without their own encoding. If it is not :const:`None` and the encoding is
+            :const:`None`, the queue uses again the encoding of the application
+
+        :raises: :exc:`ValueError` if the encoding is unknown, :exc:`MessengerErrorNoQueue
+            <clay.exceptions.MessengerErrorNoQueue>` if the queue is not added
+        """
+        if queue_name is None:
+            _check_payload_encoding(encoding)
+            self.payload_encoding = encoding
+            return
+        if encoding is not None:
+            _check_payload_encoding(encoding)
+        try:
+            self._queues[queue_name]['payload_encoding'] = encoding
+        except KeyError:
+            raise MessengerErrorNoQueue()
+
     def send(self, message):
         return self._send(message)
 
-    def _send(self, message):
+    def send_async(self, message):
+        """
+        Serializes and sends a message, returning a future completed when the broker acknowledges it. Many messages can
+        wait for the acknowledgement at the same time, without a thread each.
+
+        :type message: :class:`Message <clay.message.Message>`
+        :param message: the message to serialize and send
+
+        :returns: a :class:`Future <clay.messenger.Future>` whose result is :const:`None`. If the message cannot be
+           sent it is stored to be sent again and the future fails with the error. If the connection is closed before
+           the acknowledgement the message is stored to be sent again and the future fails with
+           :exc:`MessengerError <clay.exceptions.MessengerError>`
+
+        :raises: :exc:`MessengerErrorNoQueue <clay.exceptions.MessengerErrorNoQueue>` if the queue of the message is
+           not added
+        """
+        future = Future()
+        self._send(message, future)
+        return future
+
+    def close(self, timeout=None):
+        """
+        Wait for the acknowledgement of the messages sent, close the connection with the broker and stop sending the
+        spooled messages. The messages still not acknowledged are spooled. The messenger can still be used: a new
+        connection is opened by the next send.
+
+        :type timeout: `float`
+        :param timeout: the maximum number of seconds to wait for the acknowledgements. If it is :const:`None` it
+            waits indefinitely
+        """
+        # the flusher is stopped first, so that it doesn't open a new connection while the acknowledgements are awaited
+        with self._spool_lock:
+            self._stop_spool_flusher()
+        for entry in self._close_client(timeout):
+            self._spool.put(*entry)
+        self._close_spool()
+
+    def _reset_client(self):
+        # Closes the connection without waiting, so that the next send opens a new one with the current settings, and
+        # sends again the messages not acknowledged
+        for entry in self._close_client(0):
+            self._spool_message(*entry)
+
+    def _close_client(self, timeout=None):
+        # Closes the connection after waiting for the acknowledgements and returns the spool entries of the messages
+        # not acknowledged
+        with self._client_lock:
+            client, self._client = self._client, None
+        if client is None:
+            return []
+
+        deadline = None if timeout is None else time.time() + timeout
+        with self._pending_cond:
+            while self._pending > 0:
+                if deadline is None:
+                    self._pending_cond.wait()
+                elif deadline > time.time():
+                    self._pending_cond.wait(deadline - time.time())
+                else:
+                    break
+        try:
+            client.disconnect()
+            client.loop_stop()
+        except Exception:
+            pass
+        with self._pending_cond:
+            self._pending = 0
+            self._pending_cond.notify_all()
+            inflight, self._inflight = self._inflight, {}
+        entries = []
+        for mid in sorted(inflight):
+            entry, future = inflight[mid]
+            entries.append(entry)
+            if future is not None:
+                future.set_exception(MessengerError("Connection closed before the acknowledgement"))
+        return entries
+
+    def _release(self):
+        with self._pending_cond:
+            self._pending -= 1
+            if self._pending <= 0:
+                self._pending_cond.notify_all()
+
+    def _on_publish(self, client, userdata, mid):
+        with self._pending_cond:
+            entry, future = self._inflight.pop(mid, (None, None))
+            if entry is None and self._registering > 0:
+                self._unclaimed.add(mid)
+        self._release()
+        if future is not None:
+            future.set_result(None)
+
+    def _track(self, mid, entry, future):
+        with self._pending_cond:
+            self._registering -= 1
+            acknowledged = mid in self._unclaimed
+            if mid is not None and not acknowledged:
+                self._inflight[mid] = (entry, future)
+            self._unclaimed.discard(mid)
+            if self._registering == 0:
+                self._unclaimed.clear()
+        if acknowledged and future is not None:
+            future.set_result(None)
+
+    def _get_client(self):
+        with self._client_lock:
+            if self._client is None:
+                client = MQTTPClient.Client()
+                if self._credentials is not None:
+                    client.username_pw_set(self._credentials['username'], self._credentials['password'])
+                if self._tls is not None:
+                    client.tls_set(**self._tls)
+                client.max_inflight_messages_set(self.max_inflight)
+                client.on_publish = self._on_publish
+                client.connect(host=self.host, port=self.port)
+                client.loop_start()
+                self._client = client
+            return self._client
+
+    def _deliver(self, domain, message_type, body, future=None):
+        routing_key = "{}/{}/{}".format(self._app_name, domain, message_type)
+        queue = self._queues.get(domain)
+        if queue is not None and queue['payload_encoding'] is not None:
+            encoding = queue['payload_encoding']
+        else:
+            encoding = self.payload_encoding
+        payload = body if encoding == PAYLOAD_BINARY else body.encode('base64')
+        client = self._get_client()
+        with self._pending_cond:
+            self._pending += 1
+            self._registering += 1
+        mid = None
+        try:
+            rc, mid = client.publish(topic=routing_key, payload=payload, qos=1)
+            # when the connection is lost the client keeps the message and sends it after the reconnection
+            if rc not in (MQTTPClient.MQTT_ERR_SUCCESS, MQTTPClient.MQTT_ERR_NO_CONN):
+                raise MessengerError(MQTTPClient.error_string(rc))
+        except Exception:
+            mid = None
+            self._release()
+            raise
+        finally:
+            self._track(mid, (domain, message_type, body), future)
+
+    def _send_serialized(self, domain, message_type, body):
+        self._deliver(domain, message_type, body)
+
+    def _send(self, message, future=None):
         result = None
 
         try:
@@ -102,22 +316,13 @@ class MQTTMessenger(Messenger):
         if self._app_name is None:
             raise MessengerErrorNoApplicationName()
 
+        body = message.serialize()
         try:
-            routing_key = "{}/{}/{}".format(self._app_name, message.domain, message.message_type)
-            MQTTPublisher.single(
-                topic=routing_key,
-                payload=message.serialize().encode('base64'),
-                qos=1,
-                hostname=self.host,
-                port=self.port,
-                auth=self._credentials,
-                tls=self._tls
-            )
+            self._deliver(message.domain, message.message_type, body, future)
         except Exception as ex:
-            self._spooling_queue.put(message)
-            print "No connection, queuing"
-            print "There are {0} messages in the queue".format(self._spooling_queue.qsize())
-            print ex
+            self._spool_message(message.domain, message.message_type, body, ex)
+            if future is not None:
+                future.set_exception(ex)
 
         return result
 
@@ -133,10 +338,15 @@ class MQTTReceiver(object):
 
     :type port: `int`
     :param port: the RabbitMQ MQTT Plugin server port
+
+    :type payload_encoding: `str`
+    :param payload_encoding: the encoding of the payloads, :const:`PAYLOAD_BASE64` or :const:`PAYLOAD_BINARY`. It must
+        be the encoding used by the messengers for the queue
     """
-    def __init__(self, host='localhost', port=1883):
+    def __init__(self, host='localhost', port=1883, payload_encoding=PAYLOAD_BASE64):
         self._host = host
         self._port = port
+        self.payload_encoding = payload_encoding
         self.handler = None
 
         self._client = MQTTPClient.Client()
@@ -145,6 +355,12 @@ class MQTTReceiver(object):
         self._credentials = None
         self._tls = None
 
+        self._workers = None
+        self._pool = None
+        self._running = False
+        # checked after all the attributes are set, since __del__ uses them
+        _check_payload_encoding(payload_encoding)
+
     def _set_application_name(self, app_name):
         self._app_name = app_name
 
@@ -153,6 +369,46 @@ class MQTTReceiver(object):
 
     application_name = property(_get_application_name, _set_application_name, doc="The Application Name property")
 
+    def set_workers(self, workers=4, queue_size=64, processes=False):
+        """
+        Run the handler in a :class:`WorkerPool <clay.messenger.workers.WorkerPool>` instead of the thread that
+        reads from the broker, so that slow handlers don't block the connection. When :attr:`queue_size` messages
+        wait for the handler, the receiver stops reading from the broker until a handler completes, still sending the
+        keepalive. The receiver subscribes with QoS 1, so the broker stops sending when its window of messages not yet
+        acknowledged is full.
+
+        :type workers: `int`
+        :param workers: the number of threads or processes that run the handler
+
+        :type queue_size: `int`
+        :param queue_size: the maximum number of messages waiting or running in the pool
+
+        :type processes: `boolean`
+        :param processes: if :const:`True` the handler runs in a pool of processes, so it must be picklable
+
+        If :meth:`set_workers()` is invoked with `workers` equal to 0, the handler runs again in the receiver thread.
+
+        .. note::
+            The workers must be set using :meth:`set_workers()` before :meth:`run()` is invoked.
+        """
+        if workers == 0:
+            self._workers = None
+        else:
+            self._workers = {'workers': workers, 'queue_size': queue_size, 'processes': processes}
+
+    def set_payload_encoding(self, encoding):
+        """
+        Set the encoding of the payloads. With :const:`PAYLOAD_BINARY` the handler receives the payload as it is read
+        from the connection, without decoding or copying it.
+
+        :type encoding: `str`
+        :param encoding: :const:`PAYLOAD_BASE64` or :const:`PAYLOAD_BINARY`
+
+        :raises: :exc:`ValueError` if the encoding is unknown
+        """
+        _check_payload_encoding(encoding)
+        self.payload_encoding = encoding
+
     def set_queue(self, queue_name, durable, response):
         """
         Set the queue whose messages the broker will consume. If response is `True` the counterpart
@@ -207,7 +463,15 @@ class MQTTReceiver(object):
     def _handler_wrapper(self, client, userdata, message):
         if self.handler is None:
             raise MessengerErrorNoHandler()
-        self.handler(message.payload.decode('base64'), message.topic)
+        if self.payload_encoding == PAYLOAD_BINARY:
+            body = message.payload
+        else:
+            body = message.payload.decode('base64')
+        pool = self._pool
+        if pool is None:
+            self.handler(body, message.topic)
+        else:
+            pool.submit(body, message.topic)
 
     def run(self):
         if self._credentials is not None:
@@ -233,10 +497,49 @@ class MQTTReceiver(object):
         except socket.error as se:
             raise MessengerErrorConnectionRefused()
 
-        self._client.subscribe('/'.join([self._app_name, self._queue, '#']))
-        self._client.loop_forever()
+        topic = '/'.join([self._app_name, self._queue, '#'])
+        if self._workers is None:
+            self._client.subscribe(topic)
+            self._client.loop_forever()
+            return
+
+        # the subscription is renewed when the client reconnects
+        self._client.on_connect = lambda client, userdata, flags, rc: client.subscribe(topic, qos=1)
+        self._pool = WorkerPool(self.handler, **self._workers)
+        self._pool.start()
+        self._running = True
+        try:
+            self._loop(self._pool)
+        finally:
+            self._running = False
+            self._stop_pool()
+
+    def _loop(self, pool):
+        # The network loop used with the workers. The callbacks of the client never wait for the pool: while it is
+        # full the loop stops reading from the broker, but it still sends the keepalive and the acknowledgements
+        while self._running:
+            if pool.full:
+                pool.wait_available(0.1)
+                rc = self._client.loop_misc()
+                if rc == MQTTPClient.MQTT_ERR_SUCCESS and self._client.want_write():
+                    rc = self._client.loop_write()
+            else:
+                rc = self._client.loop(timeout=0.1)
+            if rc not in (MQTTPClient.MQTT_ERR_SUCCESS, MQTTPClient.MQTT_ERR_AGAIN) and self._running:
+                time.sleep(1)
+                try:
+                    self._client.reconnect()
+                except socket.error:
+                    pass
+
+    def _stop_pool(self):
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.stop()
 
     def stop(self):
+        # with the workers, run stops the pool when the loop ends
+        self._running = False
         try:
             self._client.loop_stop()
             self._client.disconnect()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2015, CRS4
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+class MessageRouter(object):
+    """
+    Handler for the receivers that dispatches the serialized messages to a different handler for every message type.
+    The type is read with :meth:`MessageFactory.peek <clay.factory.MessageFactory.peek>`, so the messages are routed
+    or discarded without decoding their payload. The handlers are called with the same arguments of the router and
+    the router returns their result, so it can be used also as the handler of a receiver with a response queue.
+
+    .. code:: python
+
+        router = MessageRouter(MessageFactory(AvroSerializer, CATALOG))
+        router.add_route("DEPOSIT", handle_deposit)
+        router.add_route("WITHDRAWAL", handle_withdrawal)
+        receiver.handler = router
+
+    :type factory: :class:`MessageFactory <clay.factory.MessageFactory>`
+    :param factory: the factory used to read the type of the messages
+
+    :type default: `callable`
+    :param default: the handler of the messages whose type has no route. If it is :const:`None` the messages are
+        discarded
+    """
+    def __init__(self, factory, default=None):
+        self.factory = factory
+        self.default = default
+        self._routes = {}
+
+    def add_route(self, message_type, handler):
+        """
+        Route the messages of the given type to the handler
+
+        :type message_type: `str`
+        :param message_type: the message type
+
+        :type handler: `callable`
+        :param handler: the function called with the serialized message and the other arguments of the receiver
+        """
+        self._routes[message_type] = handler
+
+    def remove_route(self, message_type):
+        """
+        Remove the route of the given type, if present
+
+        :type message_type: `str`
+        :param message_type: the message type
+        """
+        self._routes.pop(message_type, None)
+
+    def __call__(self, message, *args):
+        message_type = self.factory.peek(message)[1]
+        handler = self._routes.get(message_type, self.default)
+        if handler is None:
+            return None
+        return handler(message, *args)
+
+# vim:tabstop=4:expandtab
@@ -0,0 +1,479 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2015, CRS4
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import errno
+import os
+import select
+import socket
+import struct
+import threading
+import time
+
+# Clay library imports
+from . import Messenger
+from .spool import encode_utf8
+from ..exceptions import MessengerErrorConnectionRefused, MessengerErrorNoApplicationName, MessengerErrorNoHandler, \
+    MessengerErrorNoQueue
+
+# A frame is its length, the lengths of the queue name and of the message type, the queue name, the message type and
+# the serialized message
+_HEADER = struct.Struct('!IHH')
+_LENGTHS_SIZE = _HEADER.size - 4
+
+
+def _frame(domain, message_type, body):
+    domain, message_type = encode_utf8(domain), encode_utf8(message_type)
+    return (_HEADER.pack(_LENGTHS_SIZE + len(domain) + len(message_type) + len(body), len(domain), len(message_type)),
+            domain, message_type, body)
+
+
+def _socket(path):
+    if path is not None:
+        return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # the messages are already coalesced by the messenger
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+class _FrameDecoder(object):
+    # Reads the frames of a connection into a buffer reused for all the reads. The buffer grows when a frame doesn't
+    # fit in it
+    def __init__(self, sock, buffer_size):
+        self.socket = sock
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._end = 0
+
+    def read(self):
+        # Return the messages completed by the data available as tuples (queue name, message type, body), or None if
+        # the connection is closed
+        if self._end == len(self._buffer):
+            self._grow(2 * len(self._buffer))
+        received = self.socket.recv_into(self._view[self._end:])
+        if received == 0:
+            return None
+        self._end += received
+
+        messages = []
+        pos = 0
+        frame_size = 0
+        while self._end - pos >= _HEADER.size:
+            length, domain_length, type_length = _HEADER.unpack_from(self._buffer, pos)
+            frame_size = 4 + length
+            end = pos + frame_size
+            if end > self._end:
+                break
+            start = pos + _HEADER.size
+            type_start = start + domain_length
+            body_start = type_start + type_length
+            messages.append((self._view[start:type_start].tobytes(), self._view[type_start:body_start].tobytes(),
+                             self._view[body_start:end].tobytes()))
+            pos = end
+
+        # the partial frame is moved to the start of the buffer
+        if pos > 0:
+            self._buffer[:self._end - pos] = self._buffer[pos:self._end]
+            self._end -= pos
+        if frame_size > len(self._buffer):
+            self._grow(frame_size)
+        return messages
+
+    def _grow(self, size):
+        self._view = None
+        self._buffer.extend(bytearray(size - len(self._buffer)))
+        self._view = memoryview(self._buffer)
+
+
+class SocketMessenger(Messenger):
+    """
+    This class implements a messenger that sends the messages directly to a :class:`SocketReceiver`, over a TCP or
+    Unix socket, without a broker.
+
+    The messages are sent asynchronously by a writer thread: the messages sent while it writes are coalesced and
+    written with a single call, so a feed of many small messages needs few system calls. At most :attr:`max_pending`
+    bytes wait to be written, then :meth:`send` waits for the writer. Use :meth:`flush` to wait until the messages
+    sent are written and :meth:`close` when the messenger is not needed anymore. If the messages cannot be written
+    they are stored to be sent again.
+
+    :type host: `str`
+    :param host: the address of the receiver
+
+    :type port: `int`
+    :param port: the port of the receiver
+
+    :type path: `str`
+    :param path: the path of the Unix socket of the receiver. If it is not :const:`None`, :attr:`host` and
+        :attr:`port` are ignored
+
+    :type max_pending: `int`
+    :param max_pending: the maximum number of bytes waiting to be written
+    """
+
+    def __init__(self, host='localhost', port=7070, path=None, max_pending=4 * 2 ** 20):
+        super(SocketMessenger, self).__init__()
+        self.host = host
+        self.port = port
+        self.path = path
+        self.max_pending = max_pending
+
+        self._app_name = None
+        self._queues = {}
+
+        self._socket = None
+        self._write_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._pending = []
+        self._pending_size = 0
+        self._writing = False
+        self._writer = None
+        self._stopping = False
+
+    def _set_application_name(self, app_name):
+        self._app_name = app_name
+
+    def _get_application_name(self):
+        return self._app_name
+
+    application_name = property(_get_application_name, _set_application_name, doc="The Application Name property")
+
+    def set_credentials(self, username, password):
+        """
+        .. warning::
+            The socket messenger doesn't support authentication. This function is provided for interface
+            completeness. It just does nothing!
+        """
+        pass
+
+    def add_queue(self, queue_name, durable, response):
+        """
+        Add a queue to the messenger
+
+        :type queue_name: `str`
+        :param queue_name: Name of the queue
+
+        :type durable: `boolean`
+        :param durable: It is ignored: the messages are not stored by the receiver
+
+        :type response: `boolean`
+        :param response: It is ignored: the socket messenger doesn't support responses
+        """
+        self._queues[queue_name] = {'durable': durable, 'response': response}
+        return True
+
+    def send(self, message):
+        """
+        Serializes the message and queues it to be written, without waiting for the writer unless
+        :attr:`max_pending` bytes are waiting.
+
+        :type message: :class:`Message <clay.message.Message>`
+        :param message: the message to serialize and send
+
+        :returns: :const:`None`
+        """
+        return self._send(message)
+
+    def flush(self, timeout=None):
+        """
+        Wait until all the messages sent are written or stored to be sent again.
+
+        :type timeout: `float`
+        :param timeout: the maximum number of seconds to wait. If it is :const:`None` it waits indefinitely
+
+        :return: :const:`False` if the timeout expired before
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._pending or self._writing:
+                if deadline is None:
+                    self._cond.wait()
+                elif deadline > time.time():
+                    self._cond.wait(deadline - time.time())
+                else:
+                    return False
+        return True
+
+    def close(self, timeout=None):
+        """
+        Write the messages sent, close the connection and stop sending the spooled messages. The messenger can still
+        be used: a new connection is opened by the next send.
+
+        :type timeout: `float`
+        :param timeout: the maximum number of seconds to wait for the messages to be written. If it is
+            :const:`None` it waits indefinitely. When it expires, the messages not yet written are stored to be sent
+            again
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        self.flush(timeout)
+        with self._cond:
+            writer, self._writer = self._writer, None
+            self._stopping = True
+            self._cond.notify_all()
+        with self._spool_lock:
+            flusher, self._spool_flusher = self._spool_flusher, None
+        if flusher is not None:
+            flusher.stop()
+        threads = [thread for thread in (writer, flusher) if thread is not None]
+        for thread in threads:
+            thread.join(None if deadline is None else max(deadline - time.time(), 0))
+        if any(thread.is_alive() for thread in threads):
+            # a write is blocked by a receiver that doesn't read: the shutdown makes it fail and its messages spooled
+            self._shutdown_socket()
+            for thread in threads:
+                thread.join()
+        self._close_spool()
+        with self._write_lock:
+            self._close_socket()
+        with self._cond:
+            self._stopping = False
+
+    def _connect(self):
+        # must be called with the write lock
+        if self._socket is None:
+            sock = _socket(self.path)
+            try:
+                sock.connect(self.path if self.path is not None else (self.host, self.port))
+            except socket.error:
+                sock.close()
+                raise MessengerErrorConnectionRefused()
+            self._socket = sock
+        return self._socket
+
+    def _close_socket(self):
+        # must be called with the write lock
+        sock, self._socket = self._socket, None
+        if sock is not None:
+            sock.close()
+
+    def _shutdown_socket(self):
+        # called without the write lock, which is held by the blocked write
+        sock = self._socket
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def _write(self, data):
+        with self._write_lock:
+            try:
+                self._connect().sendall(data)
+            except socket.error:
+                self._close_socket()
+                raise MessengerErrorConnectionRefused()
+
+    def _run_writer(self):
+        try:
+            while True:
+                with self._cond:
+                    while not self._pending and not self._stopping:
+                        self._cond.wait()
+                    if not self._pending:
+                        return
+                    batch, self._pending = self._pending, []
+                    size, self._pending_size = self._pending_size, 0
+                    self._writing = True
+                    self._cond.notify_all()
+                try:
+                    self._write(''.join(part for message in batch for part in message))
+                except Exception as ex:
+                    # part of the batch could be written: the receiver must tolerate duplicates after a failure
+                    for _, domain, message_type, body in batch:
+                        self._spool_message(domain, message_type, body, ex)
+                finally:
+                    with self._cond:
+                        self._writing = False
+                        self._cond.notify_all()
+        finally:
+            # if the writer fails, the next send starts a new one
+            with self._cond:
+                if self._writer is threading.current_thread():
+                    self._writer = None
+                self._cond.notify_all()
+
+    def _send_serialized(self, domain, message_type, body):
+        # the spooled messages are written one at a time, so that the failures are reported to the spool. While the
+        # messenger is closing, the flusher started by the messages spooled by the writer doesn't connect again
+        if self._stopping:
+            raise MessengerErrorConnectionRefused()
+        self._write(''.join(_frame(domain, message_type, body)))
+
+    def _send(self, message):
+        result = None
+
+        try:
+            self._queues[message.domain]
+        except KeyError:
+            raise MessengerErrorNoQueue()
+
+        if self._app_name is None:
+            raise MessengerErrorNoApplicationName()
+
+        frame = _frame(message.domain, message.message_type, message.serialize())
+        size = sum(len(part) for part in frame)
+        with self._cond:
+            while self._pending_size > 0 and self._pending_size + size > self.max_pending:
+                self._cond.wait()
+            self._pending.append(frame)
+            self._pending_size += size
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._run_writer)
+                self._writer.daemon = True
+                self._writer.start()
+            self._cond.notify_all()
+
+        return result
+
+
+class SocketReceiver(object):
+    """
+    Class that implements a receiver of the messages sent by the :class:`SocketMessenger`. It listens on a TCP or Unix
+    socket and reads the messages of all the connected messengers. Every connection is read into a buffer reused for
+    all its messages, so the only copy of a message is the body given to the handler. The messages sent to other
+    queues are discarded. The receiver stops when :meth:`stop` is invoked, from any thread.
+
+    :type host: `str`
+    :param host: the address to listen on
+
+    :type port: `int`
+    :param port: the port to listen on
+
+    :type path: `str`
+    :param path: the path of the Unix socket to listen on. If it is not :const:`None`, :attr:`host` and :attr:`port`
+        are ignored
+
+    :type buffer_size: `int`
+    :param buffer_size: the initial size in bytes of the buffer of a connection
+    """
+    def __init__(self, host='localhost', port=7070, path=None, buffer_size=2 ** 16):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.buffer_size = buffer_size
+        self.handler = None
+
+        self._app_name = None
+        self._queue = None
+        self._running = False
+
+    def _set_application_name(self, app_name):
+        self._app_name = app_name
+
+    def _get_application_name(self):
+        return self._app_name
+
+    application_name = property(_get_application_name, _set_application_name, doc="The Application Name property")
+
+    def set_credentials(self, username, password):
+        """
+        .. warning::
+            The socket receiver doesn't support authentication. This function is provided for interface
+            completeness. It just does nothing!
+        """
+        pass
+
+    def set_queue(self, queue_name, durable, response):
+        """
+        Set the queue whose messages the receiver will consume.
+
+        :type queue_name: `str`
+        :param queue_name: The name of the queue
+
+        :type durable: `boolean`
+        :param durable: It is ignored: the messages are not stored
+
+        :type response: `boolean`
+        :param response: It is ignored: the socket receiver doesn't support responses
+        """
+        self._queue = {'name': queue_name, 'durable': durable, 'response': response}
+
+    def _listen(self):
+        listener = _socket(self.path)
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except OSError as ex:
+                if ex.errno != errno.ENOENT:
+                    listener.close()
+                    raise
+            address = self.path
+        else:
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            address = (self.host, self.port)
+        try:
+            listener.bind(address)
+            listener.listen(16)
+        except socket.error:
+            listener.close()
+            raise MessengerErrorConnectionRefused()
+        return listener
+
+    def run(self):
+        if self._app_name is None:
+            raise MessengerErrorNoApplicationName()
+
+        if self._queue is None:
+            raise MessengerErrorNoQueue()
+
+        if self.handler is None:
+            raise MessengerErrorNoHandler()
+
+        queue_name = encode_utf8(self._queue['name'])
+        listener = self._listen()
+        decoders = {}
+        self._running = True
+        try:
+            while self._running:
+                readable, _, _ = select.select([listener] + decoders.keys(), [], [], 0.1)
+                for sock in readable:
+                    if sock is listener:
+                        connection, _ = listener.accept()
+                        decoders[connection] = _FrameDecoder(connection, self.buffer_size)
+                        continue
+                    try:
+                        messages = decoders[sock].read()
+                    except socket.error:
+                        messages = None
+                    if messages is None:
+                        del decoders[sock]
+                        sock.close()
+                        continue
+                    for domain, message_type, body in messages:
+                        if domain == queue_name:
+                            self.handler(body, message_type)
+        finally:
+            self._running = False
+            for sock in decoders:
+                sock.close()
+            listener.close()
+            if self.path is not None:
+                try:
+                    os.unlink(self.path)
+                except OSError:
+                    pass
+
+    def stop(self):
+        self._running = False
+
+    def __del__(self):
+        self.stop()
+
+# vim:tabstop=4:expandtab
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2015, CRS4
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import struct
+import threading
+from collections import deque
+
+# Header of the records written on disk: length of the domain, of the message type and of the payload
+_RECORD_HEADER = struct.Struct(">HHI")
+_SEGMENT_SUFFIX = ".spool"
+
+
+def encode_utf8(text):
+    """
+    Return :attr:`text` encoded in UTF-8 if it is `unicode`, or :attr:`text` itself if it is already a `str`.
+    The domains and the message types of a catalog loaded from JSON are `unicode`, while they are sent and spooled
+    as bytes together with the serialized messages
+
+    :type text: `basestring`
+    :param text: the text to encode
+    :return: a `str`
+    """
+    return text.encode('utf-8') if isinstance(text, unicode) else text
+
+
+class Spool(object):
+    """
+    A bounded FIFO of serialized messages that could not be sent. Every entry is a tuple with the domain, the
+    message type and the serialized message.
+
+    The entries are kept in memory up to :attr:`max_memory` bytes. If a :attr:`directory` is specified, when the
+    memory is full the entries are moved to an append-only log on disk, made of segment files of at most
+    :attr:`segment_size` bytes, up to :attr:`max_disk` bytes. The entries that don't fit are dropped and counted in
+    :attr:`dropped`. :meth:`close` moves the entries in memory to disk, and a new :class:`Spool` created on the same
+    directory starts with the entries left there.
+
+    :type directory: `str`
+    :param directory: the directory of the log. If it is :const:`None`, the entries are only kept in memory
+
+    :type max_memory: `int`
+    :param max_memory: the maximum number of bytes of the entries kept in memory
+
+    :type max_disk: `int`
+    :param max_disk: the maximum number of bytes of the log on disk
+
+    :type segment_size: `int`
+    :param segment_size: the size in bytes after which a new segment file is started
+    """
+    def __init__(self, directory=None, max_memory=16 * 2 ** 20, max_disk=2 ** 30, segment_size=16 * 2 ** 20):
+        self.directory = directory
+        self.max_memory = max_memory
+        self.max_disk = max_disk
+        self.segment_size = segment_size
+        self.dropped = 0
+
+        self._cond = threading.Condition()
+        self._memory = deque()
+        self._memory_size = 0
+
+        # Segments files as [path, size] lists: the first one is read, the last one is written
+        self._segments = deque()
+        self._disk_size = 0
+        self._disk_count = 0
+        self._next_segment = 0
+        self._read_file = None
+        self._read_offset = 0
+        self._head = None
+        self._write_file = None
+
+        if directory is not None:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self._load_segments()
+
+    def __len__(self):
+        return len(self._memory) + self._disk_count
+
+    def put(self, domain, message_type, payload):
+        """
+        Add an entry to the spool. The domain and the message type are stored encoded in UTF-8
+
+        :return: :const:`True` if the entry has been stored, :const:`False` if it has been dropped
+        """
+        domain, message_type = encode_utf8(domain), encode_utf8(message_type)
+        entry = (domain, message_type, payload)
+        size = len(domain) + len(message_type) + len(payload)
+        with self._cond:
+            if self._memory_size + size > self.max_memory:
+                if self.directory is None or \
+                        self._disk_size + self._memory_size + size + _RECORD_HEADER.size * (len(self) + 1) > \
+                        self.max_disk:
+                    self.dropped += 1
+                    return False
+                self._spill()
+                if size > self.max_memory:
+                    self._write((entry,))
+                    self._cond.notify_all()
+                    return True
+            self._memory.append(entry)
+            self._memory_size += size
+            self._cond.notify_all()
+        return True
+
+    def peek(self):
+        """
+        Return the oldest entry without removing it, or :const:`None` if the spool is empty
+        """
+        with self._cond:
+            if self._disk_count > 0:
+                if self._head is None:
+                    self._head = self._read_head()
+                return self._head[0]
+            if self._memory:
+                return self._memory[0]
+            return None
+
+    def pop(self):
+        """
+        Remove and return the oldest entry, or return :const:`None` if the spool is empty
+        """
+        with self._cond:
+            if self._disk_count > 0:
+                entry = self.peek()
+                self._read_offset += self._head[1]
+                self._head = None
+                self._disk_count -= 1
+                if self._read_offset >= self._segments[0][1]:
+                    self._remove_head_segment()
+                return entry
+            if self._memory:
+                entry = self._memory.popleft()
+                self._memory_size -= len(entry[0]) + len(entry[1]) + len(entry[2])
+                return entry
+            return None
+
+    def wait(self, timeout=None):
+        """
+        Wait until the spool is not empty or the timeout expires
+
+        :return: :const:`True` if the spool is not empty
+        """
+        with self._cond:
+            if len(self) == 0:
+                self._cond.wait(timeout)
+            return len(self) > 0
+
+    def wake(self):
+        """
+        Wake up the threads waiting in :meth:`wait`
+        """
+        with self._cond:
+            self._cond.notify_all()
+
+    def close(self):
+        """
+        Move the entries in memory to disk, if the spool has a directory, and close the files.
+        The spool can still be used after it has been closed.
+        """
+        with self._cond:
+            if self.directory is not None:
+                self._spill()
+            for f in (self._read_file, self._write_file):
+                if f is not None:
+                    f.close()
+            self._read_file = self._write_file = None
+            self._head = None
+            if self._read_offset > 0:
+                self._compact_head_segment()
+
+    def _compact_head_segment(self):
+        # Rewrites the first segment without the entries already popped, so they are not loaded again
+        path, size = self._segments[0]
+        with open(path, "rb") as f:
+            f.seek(self._read_offset)
+            data = f.read()
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.rename(temp_path, path)
+        self._segments[0][1] = len(data)
+        self._disk_size -= self._read_offset
+        self._read_offset = 0
+
+    def _spill(self):
+        if self._memory:
+            self._write(self._memory)
+            self._memory.clear()
+            self._memory_size = 0
+
+    def _write(self, entries):
+        for domain, message_type, payload in entries:
+            # a segment is never reopened for writing once closed
+            if self._write_file is None or self._segments[-1][1] >= self.segment_size:
+                self._new_segment()
+            record = "".join((_RECORD_HEADER.pack(len(domain), len(message_type), len(payload)),
+                              domain, message_type, payload))
+            self._write_file.write(record)
+            self._segments[-1][1] += len(record)
+            self._disk_size += len(record)
+            self._disk_count += 1
+        self._write_file.flush()
+
+    def _new_segment(self):
+        if self._write_file is not None:
+            self._write_file.close()
+        path = os.path.join(self.directory, "%020d%s" % (self._next_segment, _SEGMENT_SUFFIX))
+        self._next_segment += 1
+        self._segments.append([path, 0])
+        self._write_file = open(path, "ab")
+
+    def _read_head(self):
+        # Returns the first unread record of the log and its length on disk
+        if self._read_file is None:
+            self._read_file = open(self._segments[0][0], "rb")
+        self._read_file.seek(self._read_offset)
+        domain_len, type_len, payload_len = _RECORD_HEADER.unpack(self._read_file.read(_RECORD_HEADER.size))
+        data = self._read_file.read(domain_len + type_len + payload_len)
+        entry = (data[:domain_len], data[domain_len:domain_len + type_len], data[domain_len + type_len:])
+        return entry, _RECORD_HEADER.size + len(data)
+
+    def _remove_head_segment(self):
+        path, size = self._segments.popleft()
+        if self._read_file is not None:
+            self._read_file.close()
+            self._read_file = None
+        if not self._segments and self._write_file is not None:
+            self._write_file.close()
+            self._write_file = None
+        os.remove(path)
+        self._disk_size -= size
+        self._read_offset = 0
+
+    def _load_segments(self):
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(_SEGMENT_SUFFIX))
+        for name in names:
+            path = os.path.join(self.directory, name)
+            size = 0
+            with open(path, "r+b") as f:
+                while True:
+                    header = f.read(_RECORD_HEADER.size)
+                    if len(header) < _RECORD_HEADER.size:
+                        break
+                    length = sum(_RECORD_HEADER.unpack(header))
+                    if len(f.read(length)) < length:
+                        break
+                    size += _RECORD_HEADER.size + length
+                    self._disk_count += 1
+                # drops the last record if it was not completely written
+                f.truncate(size)
+            if size == 0:
+                os.remove(path)
+            else:
+                self._segments.append([path, size])
+                self._disk_size += size
+        if names:
+            self._next_segment = int(names[-1][:-len(_SEGMENT_SUFFIX)]) + 1
+
+
+class SpoolFlusher(threading.Thread):
+    """
+    Thread that sends again the entries of a :class:`Spool`. When sending fails, it waits before retrying,
+    doubling the wait every time up to :attr:`max_backoff` seconds.
+
+    :type spool: :class:`Spool`
+    :param spool: the spool to flush
+
+    :type send: `callable`
+    :param send: the function called with the domain, the message type and the serialized message of every entry.
+        It must raise an exception if the message cannot be sent
+
+    :type min_backoff: `float`
+    :param min_backoff: the seconds to wait after the first failure
+
+    :type max_backoff: `float`
+    :param max_backoff: the maximum number of seconds to wait between two retries
+    """
+    def __init__(self, spool, send, min_backoff=0.5, max_backoff=60.0):
+        super(SpoolFlusher, self).__init__(name="SpoolFlusher")
+        self.daemon = True
+        self.spool = spool
+        self.send = send
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self._stopped = threading.Event()
+
+    def run(self):
+        backoff = self.min_backoff
+        while not self._stopped.is_set():
+            entry = self.spool.peek()
+            if entry is None:
+                self.spool.wait(1.0)
+                continue
+            try:
+                self.send(*entry)
+            except Exception:
+                self._stopped.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+            else:
+                self.spool.pop()
+                backoff = self.min_backoff
+
+    def stop(self):
+        self._stopped.set()
+        self.spool.wake()
+
+# vim:tabstop=4:expandtab
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2015, CRS4
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import Queue
+import cPickle as pickle
+import multiprocessing
+import threading
+import time
+import traceback
+from functools import partial
+
+
+def _call_handler(handler, body, message_type):
+    # Run the handler in a worker. It is a module function, so it can be sent to a process pool, and it returns the
+    # exception instead of raising it, so the pool always calls the callback
+    try:
+        return True, handler(body, message_type)
+    except Exception as ex:
+        traceback.print_exc()
+        return False, ex
+
+
+def _call_handler_in_process(handler, body, message_type):
+    # Run the handler in a worker process. Python 2.7 pools don't call the callback of the tasks whose outcome cannot be
+    # pickled, so it is checked here and replaced with an error
+    outcome = _call_handler(handler, body, message_type)
+    try:
+        pickle.dumps(outcome, pickle.HIGHEST_PROTOCOL)
+    except Exception as ex:
+        return False, ValueError("The outcome of the handler cannot be pickled: {}".format(ex))
+    return outcome
+
+
+class WorkerPool(object):
+    """
+    Pool of threads or processes that run the handler of a receiver, so that the network thread of the receiver is
+    not blocked by slow handlers. The deliveries submitted and not yet completed are at most :attr:`queue_size`:
+    when the pool is :attr:`full` the receiver stops consuming until a handler completes.
+
+    :type handler: `callable`
+    :param handler: the handler, called with the serialized message and the message type. With a process pool it
+        must be picklable (e.g., a module function) and it should return a picklable result: otherwise the callback
+        gets :const:`False` and a :exc:`ValueError`
+
+    :type workers: `int`
+    :param workers: the number of threads or processes
+
+    :type queue_size: `int`
+    :param queue_size: the maximum number of deliveries waiting or running in the pool
+
+    :type processes: `bool`
+    :param processes: if :const:`True` the handler runs in a pool of processes, otherwise in a pool of threads
+    """
+    def __init__(self, handler, workers=4, queue_size=64, processes=False):
+        if workers < 1 or queue_size < 1:
+            raise ValueError("The number of workers and the queue size must be positive")
+        self.handler = handler
+        self.workers = workers
+        self.queue_size = queue_size
+        self.processes = processes
+
+        self._pending = 0
+        self._pending_cond = threading.Condition()
+        self._tasks = None
+        self._threads = []
+        self._process_pool = None
+
+    def _get_full(self):
+        with self._pending_cond:
+            return self._pending >= self.queue_size
+
+    full = property(_get_full, doc="Whether the pool holds :attr:`queue_size` deliveries")
+
+    def __len__(self):
+        with self._pending_cond:
+            return self._pending
+
+    def start(self):
+        """
+        Start the workers
+
+        :raises: :exc:`ValueError` if the handler of a process pool cannot be pickled
+        """
+        if self.processes:
+            try:
+                pickle.dumps(self.handler, pickle.HIGHEST_PROTOCOL)
+            except Exception as ex:
+                raise ValueError("The handler of a process pool must be picklable: {}".format(ex))
+            self._process_pool = multiprocessing.Pool(self.workers)
+        else:
+            self._tasks = Queue.Queue()
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name="Worker-%d" % i)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, body, message_type, callback=None):
+        """
+        Run the handler on a delivery. The delivery is always accepted, since it has already been received: the
+        receiver must check :attr:`full` and stop consuming until a handler completes.
+
+        :param body: the serialized message
+        :param message_type: the message type
+        :param callback: the function called, in a worker or in a thread of the pool, when the handler completes.
+            Its arguments are :const:`True` and the result of the handler or :const:`False` and the exception
+            raised by the handler
+        """
+        with self._pending_cond:
+            self._pending += 1
+        done = partial(self._done, callback)
+        if self._process_pool is not None:
+            try:
+                self._process_pool.apply_async(_call_handler_in_process, (self.handler, body, message_type),
+                                               callback=done)
+            except Exception as ex:
+                done((False, ex))
+        else:
+            self._tasks.put((body, message_type, done))
+
+    def wait_available(self, timeout=None):
+        """
+        Wait until the pool is not :attr:`full`
+
+        :param timeout: the maximum number of seconds to wait
+        :return: :const:`True` if the pool is not full
+        """
+        return self._wait(lambda: self._pending < self.queue_size, timeout)
+
+    def join(self, timeout=None):
+        """
+        Wait until all the deliveries submitted are completed
+
+        :param timeout: the maximum number of seconds to wait
+        :return: :const:`True` if all the deliveries are completed
+        """
+        return self._wait(lambda: self._pending == 0, timeout)
+
+    def _wait(self, ready, timeout):
+        deadline = None if timeout is None else time.time() + timeout
+        with self._pending_cond:
+            while not ready():
+                if deadline is None:
+                    self._pending_cond.wait()
+                elif deadline > time.time():
+                    self._pending_cond.wait(deadline - time.time())
+                else:
+                    break
+            return ready()
+
+    def stop(self):
+        """
+        Stop the workers. The deliveries not yet started are discarded
+        """
+        if self._process_pool is not None:
+            self._process_pool.terminate()
+            self._process_pool = None
+        if self._tasks is not None:
+            try:
+                while True:
+                    self._tasks.get_nowait()
+            except Queue.Empty:
+                pass
+            for thread in self._threads:
+                self._tasks.put(None)
+            self._tasks = None
+            self._threads = []
+        with self._pending_cond:
+            self._pending = 0
+            self._pending_cond.notify_all()
+
+    def _done(self, callback, result):
+        try:
+            if callback is not None:
+                callback(*result)
+        finally:
+            with self._pending_cond:
+                self._pending = max(self._pending - 1, 0)
+                self._pending_cond.notify_all()
+
+    def _work(self):
+        tasks = self._tasks
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            body, message_type, done = task
+            done(_call_handler(self.handler, body, message_type))
+
+# vim:tabstop=4:expandtab
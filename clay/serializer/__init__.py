@@ -19,11 +19,11 @@
 # IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-import sys
-from collections import defaultdict
+import threading
+from collections import OrderedDict
 
-from .. import CustomLoader
-from ..exceptions import MissingDependency
+from .. import lazy_module
+from ..catalog import schema_fingerprint
 
 
 class Serializer(object):
@@ -35,12 +35,22 @@ class Serializer(object):
     :type message_type: `str`
     :param message_type: The message type of the message to serialize
 
-    :type schema_catalog:
+    :type schema_catalog: `dict` or :class:`Catalog <clay.catalog.Catalog>`
     :param schema_catalog: The catalog containing the schema of the message to serialize
     """
     def __init__(self, message_type, schema_catalog):
         pass
 
+    @staticmethod
+    def prepare_catalog(catalog):
+        """
+        Static or class method called when a :class:`MessageFactory <clay.factory.MessageFactory>` is created, to
+        prepare the serialization of all the schemas of the catalog in advance. The base implementation does nothing
+
+        :param catalog: The catalog of the factory
+        """
+        pass
+
     def serialize(self, datum):
         """
         Method where the serialization is performed. Sublclasses should implement this method
@@ -63,6 +73,139 @@ class Serializer(object):
         """
         pass
 
+    def serialize_many(self, data):
+        """
+        Serializes all the data in input. Subclasses can override this method to share the serialization setup
+        among the items
+
+        :type data: iterable of `dict`
+        :param data: The dictionaries to serialize
+        :rtype: `list`
+        :return: the list of the serialized data
+        """
+        return [self.serialize(datum) for datum in data]
+
+    @classmethod
+    def deserialize_many(cls, messages, catalog):
+        """
+        Deserializes all the messages in input. Subclasses can override this method to share the deserialization
+        setup among the items
+
+        :param messages: iterable of serialized messages
+        :param catalog: The catalog containing the messages schemas
+        :rtype: `list`
+        :return: the list of the results of :meth:`deserialize` for every message
+        """
+        return [cls.deserialize(message, catalog) for message in messages]
+
+    @classmethod
+    def deserialize_projection(cls, message, catalog, fields=None, predicate=None):
+        """
+        Deserializes only some fields of the message and only if it satisfies the predicate. Subclasses override
+        this method to skip the decoding of the other fields: the base implementation deserializes the whole
+        message and then selects the fields
+
+        :param message: The serialized message
+        :param catalog: The catalog containing the message schema
+
+        :type fields: iterable of `str`
+        :param fields: the names of the fields to return. If it is :const:`None` all the fields are returned
+
+        :type predicate: `dict`
+        :param predicate: a dictionary that maps the names of primitive fields to a value or to a function. The
+            message satisfies the predicate if, for every field, its value is equal to the given value or the
+            function called with the value returns :const:`True`
+
+        :return: a tuple with the payload, the id and the schema of the message. The payload is :const:`None` if
+            the message doesn't satisfy the predicate
+        """
+        payload, payload_id, payload_schema = cls.deserialize(message, catalog)
+        if predicate is not None:
+            for name, test in predicate.iteritems():
+                if not check_predicate(test, payload.get(name)):
+                    return None, payload_id, payload_schema
+        if fields is not None:
+            payload = dict((name, payload[name]) for name in fields if name in payload)
+        return payload, payload_id, payload_schema
+
+    @classmethod
+    def peek(cls, message, catalog):
+        """
+        Reads the id and the type of the message without decoding its payload, e.g., to route the message.
+        Subclasses override this method to read only the envelope: the base implementation deserializes the whole
+        message
+
+        :param message: The serialized message
+        :param catalog: The catalog containing the message schema
+        :return: a tuple with the id of the schema, the message type and the offset of the payload in the message,
+            or :const:`None` if the serializer cannot locate it
+        """
+        payload, payload_id, payload_schema = cls.deserialize(message, catalog)
+        return payload_id, payload_schema["name"], None
+
+    @classmethod
+    def deserialize_lazy(cls, message, catalog):
+        """
+        Deserializes the message deferring the decoding of the payload. Subclasses can override this method to decode
+        the fields separately, when they are accessed
+
+        :param message: The serialized message
+        :param catalog: The catalog containing the message schema
+        :return: a tuple with the :class:`LazyPayload`, the id and the schema of the message
+        """
+        payload, payload_id, payload_schema = cls.deserialize(message, catalog)
+        return LazyPayload(payload), payload_id, payload_schema
+
+
+def check_predicate(test, value):
+    """
+    Check the value of a field against the test of a predicate, as described in
+    :meth:`Serializer.deserialize_projection`
+
+    :param test: a function or a value
+    :param value: the value of the field
+    :rtype: `bool`
+    """
+    if callable(test):
+        return bool(test(value))
+    return value == test
+
+
+class LazyPayload(object):
+    """
+    The payload of a serialized message, decoded when it is needed. The base class decodes the whole payload on the
+    first access using :meth:`_decode`; subclasses can decode the single fields overriding :meth:`field`
+
+    :type payload: `dict`
+    :param payload: the decoded payload, if it is already available
+    """
+    def __init__(self, payload=None):
+        self._payload = payload
+
+    def _decode(self):
+        # Subclasses override this method to decode the whole payload
+        return self._payload
+
+    def field(self, name):
+        """
+        Return the value of a field of the payload
+
+        :type name: `str`
+        :param name: the name of the field
+        :raises: :exc:`KeyError` if the payload doesn't contain the field
+        """
+        return self.content()[name]
+
+    def content(self):
+        """
+        Return the whole decoded payload
+
+        :rtype: `dict`
+        """
+        if self._payload is None:
+            self._payload = self._decode()
+        return self._payload
+
 
 class DummySerializer(Serializer):
     def __init__(self, message_type):
@@ -73,9 +216,17 @@ class DummySerializer(Serializer):
 
 
 class Cache(object):
+    """
+    Base class of the caches of the objects built from the schemas (e.g., the compiled serializers). Every subclass
+    has a single instance, shared by all the threads. The objects are indexed by the fingerprint of their schema, so
+    schemas with the same name from different catalogs don't collide, and the least recently used ones are evicted
+    when the cache holds more than :attr:`max_size` objects.
+    """
 
     _inst = None
 
+    DEFAULT_MAX_SIZE = 256
+
     def __new__(cls, *args, **kwargs):
         if cls._inst is None:
             cls._inst = object.__new__(cls, *args, **kwargs)
@@ -83,35 +234,85 @@ class Cache(object):
 
     def __init__(self):
         if "_cache" not in vars(self):
-            self._cache = defaultdict(dict)
+            self._cache = OrderedDict()
+            self._lock = threading.Lock()
+            self._max_size = self.DEFAULT_MAX_SIZE
+            self.hits = self.misses = self.evictions = 0
 
+    def _set_max_size(self, max_size):
+        if max_size < 1:
+            raise ValueError("The cache size must be positive")
+        with self._lock:
+            self._max_size = max_size
+            self._evict()
 
-# Imports the other Serializers
-try:
-    from .pyavroc_serializer import AvroSerializer
-except MissingDependency:
-    try:
-        from .avro_serializer import AvroSerializer
-    except MissingDependency:
-        pass
+    def _get_max_size(self):
+        return self._max_size
+
+    max_size = property(_get_max_size, _set_max_size, doc="The maximum number of objects in the cache")
 
-try:
-    from .hl7_serializer import AbstractHL7Serializer
-except MissingDependency:
-    pass
+    def _evict(self):
+        while len(self._cache) > self._max_size:
+            self._cache.popitem(last=False)
+            self.evictions += 1
 
-try:
-    from .json_serializer import JSONSerializer
-except MissingDependency:
-    pass
+    def _lookup(self, key, build, *args):
+        # Return the object with the given key, building it with build(*args) if it is not in the cache. The
+        # object is built without holding the lock, since it may take long
+        with self._lock:
+            obj = self._cache.pop(key, None)
+            if obj is not None:
+                self._cache[key] = obj
+                self.hits += 1
+                return obj
+            self.misses += 1
+
+        obj = build(*args)
+        with self._lock:
+            obj = self._cache.setdefault(key, obj)
+            self._evict()
+        return obj
+
+    @staticmethod
+    def fingerprint(schema, fingerprint=None):
+        """
+        Return :attr:`fingerprint` or, if it is :const:`None`, compute the fingerprint of :attr:`schema`
 
+        :type schema: `dict`
+        :param schema: the schema
+        :type fingerprint: `str`
+        :param fingerprint: the fingerprint of the schema, if it is already known (e.g., from
+            :meth:`Catalog.fingerprint <clay.catalog.Catalog.fingerprint>`)
+        """
+        if fingerprint is None:
+            fingerprint = schema_fingerprint(schema)
+        return fingerprint
+
+    def stats(self):
+        """
+        Return the statistics of the cache
+
+        :rtype: `dict`
+        :return: a `dict` with the number of `hits`, `misses` and `evictions`, the current `size` and the `max_size`
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "size": len(self._cache), "max_size": self._max_size}
+
+    def clear(self):
+        """
+        Remove all the objects from the cache and reset the statistics
+        """
+        with self._lock:
+            self._cache.clear()
+            self.hits = self.misses = self.evictions = 0
 
-class _SerializerLoader(CustomLoader):
 
-    DEPENDENCIES = {
-        "clay.serializer.AvroSerializer": "avro",
-        "clay.serializer.AbstractHL7Serializer": "hl7apy",
-        "clay.serializer.JSONSerializer": "simplejson",
-    }
+# The other Serializers are imported on first access, so that their dependencies are loaded only when needed
+lazy_module(__name__, {
+    "AvroSerializer": ((".pyavroc_serializer", ".avro_serializer"), "avro"),
+    "AbstractHL7Serializer": ((".hl7_serializer",), "hl7apy"),
+    "JSONSerializer": ((".json_serializer",), "simplejson"),
+})
 
-sys.meta_path.append(_SerializerLoader())
\ No newline at end of file
+# vim:tabstop=4:expandtab
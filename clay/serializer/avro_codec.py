@@ -0,0 +1,521 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2015, CRS4
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Pure Python implementation of the Avro binary encoding, specialized for a schema.
+
+An :class:`AvroCodec` generates the Python source of the functions that encode and decode the data of its schema,
+with the fields of the records unrolled in their order and the type dispatch resolved when the codec is built, and
+compiles it. The encoding is the same of the reference `avro` library: also the validation of the data and the
+choice of the branch of the unions (the last one that validates the datum) follow it.
+"""
+
+import struct
+
+from ..exceptions import SchemaException
+
+PRIMITIVE_TYPES = ("null", "boolean", "int", "long", "float", "double", "bytes", "string")
+
+INT_MIN_VALUE = -(1 << 31)
+INT_MAX_VALUE = (1 << 31) - 1
+LONG_MIN_VALUE = -(1 << 63)
+LONG_MAX_VALUE = (1 << 63) - 1
+
+# Exceptions raised by the generated functions on invalid data
+_ENCODE_ERRORS = (TypeError, ValueError, AttributeError, KeyError, struct.error)
+_DECODE_ERRORS = (IndexError, ValueError, KeyError, struct.error)
+
+
+def _fail(expected, datum):
+    raise TypeError("%r is not a valid %s" % (datum, expected))
+
+
+def _write_varint(out, value):
+    # Writes a value already zigzag encoded
+    while value & ~0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_long(data, pos):
+    b = ord(data[pos])
+    value = b & 0x7F
+    shift = 7
+    while b & 0x80:
+        pos += 1
+        b = ord(data[pos])
+        value |= (b & 0x7F) << shift
+        shift += 7
+    return (value >> 1) ^ -(value & 1), pos + 1
+
+
+def _skip_long(data, pos):
+    while ord(data[pos]) & 0x80:
+        pos += 1
+    return pos + 1
+
+
+def _encoded_long(value):
+    out = bytearray()
+    _write_varint(out, (value << 1) ^ (value >> 63))
+    return str(out)
+
+
+def _validator(schema):
+    # Returns a function that checks if a datum is valid for a normalized schema, as avro.io.validate. It is used
+    # to choose the branch of the unions
+    if isinstance(schema, basestring):
+        return {
+            "null": lambda datum: datum is None,
+            "boolean": lambda datum: isinstance(datum, bool),
+            "string": lambda datum: isinstance(datum, basestring),
+            "bytes": lambda datum: isinstance(datum, str),
+            "int": lambda datum: isinstance(datum, (int, long)) and INT_MIN_VALUE <= datum <= INT_MAX_VALUE,
+            "long": lambda datum: isinstance(datum, (int, long)) and LONG_MIN_VALUE <= datum <= LONG_MAX_VALUE,
+            "float": lambda datum: isinstance(datum, (int, long, float)),
+            "double": lambda datum: isinstance(datum, (int, long, float)),
+        }[schema]
+    if isinstance(schema, list):
+        validators = [_validator(branch) for branch in schema]
+        return lambda datum: any(validate(datum) for validate in validators)
+
+    schema_type = schema["type"]
+    if schema_type == "fixed":
+        size = schema["size"]
+        return lambda datum: isinstance(datum, str) and len(datum) == size
+    if schema_type == "enum":
+        symbols = frozenset(schema["symbols"])
+        return lambda datum: datum in symbols
+    if schema_type == "array":
+        validate_item = _Lazy(schema["items"])
+        return lambda datum: isinstance(datum, list) and all(validate_item(item) for item in datum)
+    if schema_type == "map":
+        validate_value = _Lazy(schema["values"])
+        return lambda datum: isinstance(datum, dict) and \
+            all(isinstance(key, basestring) and validate_value(value) for key, value in datum.iteritems())
+    fields = [(field["name"], _Lazy(field["type"])) for field in schema["fields"]]
+    return lambda datum: isinstance(datum, dict) and all(validate(datum.get(name)) for name, validate in fields)
+
+
+class _Lazy(object):
+    # Validator built on the first call, so that recursive records don't recurse at build time
+    __slots__ = ("_schema", "_validate")
+
+    def __init__(self, schema):
+        self._schema = schema
+        self._validate = None
+
+    def __call__(self, datum):
+        if self._validate is None:
+            self._validate = _validator(self._schema)
+        return self._validate(datum)
+
+
+class _Compiler(object):
+    # Generates the source of the functions of a codec. The named records are compiled to functions
+    # _w<n>(datum, out) and _r<n>(data, pos), so they can be recursive
+
+    def __init__(self):
+        self.names = {}
+        self.records = []
+        self.sources = []
+        self.namespace = {
+            "_fail": _fail,
+            "_write_varint": _write_varint,
+            "_read_long": _read_long,
+            "_skip_long": _skip_long,
+            "_pack_float": struct.Struct("<f").pack,
+            "_pack_double": struct.Struct("<d").pack,
+            "_unpack_float": struct.Struct("<f").unpack_from,
+            "_unpack_double": struct.Struct("<d").unpack_from,
+            "_INT_MIN": INT_MIN_VALUE,
+            "_INT_MAX": INT_MAX_VALUE,
+            "_LONG_MIN": LONG_MIN_VALUE,
+            "_LONG_MAX": LONG_MAX_VALUE,
+        }
+        self._counter = 0
+
+    def variable(self, prefix="v"):
+        self._counter += 1
+        return "%s%d" % (prefix, self._counter)
+
+    def constant(self, value, prefix="_c"):
+        name = self.variable(prefix)
+        self.namespace[name] = value
+        return name
+
+    def normalize(self, schema, namespace=None):
+        # Returns the schema with the named references resolved: a primitive type name, a list for the unions or a
+        # dict for the complex types. The records are registered and compiled
+        if isinstance(schema, basestring):
+            if schema in PRIMITIVE_TYPES:
+                return str(schema)
+            for name in ("%s.%s" % (namespace, schema), schema):
+                if name in self.names:
+                    return self.names[name]
+            raise SchemaException("Unknown type '%s'" % schema)
+        if isinstance(schema, list):
+            return [self.normalize(branch, namespace) for branch in schema]
+
+        schema_type = schema["type"]
+        if schema_type in PRIMITIVE_TYPES:
+            return str(schema_type)
+        if schema_type in ("record", "error", "enum", "fixed"):
+            namespace = schema.get("namespace", namespace)
+            normalized = dict(schema)
+            if "name" in schema:
+                self.names[schema["name"]] = normalized
+                if namespace:
+                    self.names["%s.%s" % (namespace, schema["name"])] = normalized
+            if schema_type in ("record", "error"):
+                normalized["type"] = "record"
+                normalized["index"] = len(self.records)
+                self.records.append(normalized)
+                normalized["fields"] = [dict(field, type=self.normalize(field["type"], namespace))
+                                        for field in schema["fields"]]
+            return normalized
+        if schema_type == "array":
+            return {"type": "array", "items": self.normalize(schema["items"], namespace)}
+        if schema_type == "map":
+            return {"type": "map", "values": self.normalize(schema["values"], namespace)}
+        if isinstance(schema_type, (dict, list)) or schema_type in self.names:
+            return self.normalize(schema_type, namespace)
+        raise SchemaException("Unknown type '%s'" % schema_type)
+
+    def compile(self):
+        for record in self.records:
+            self.sources.append(self.record_writer(record))
+            self.sources.append(self.record_reader(record))
+
+    def record_writer(self, record):
+        lines = ["def _w%d(datum, out):" % record["index"],
+                 "    if not isinstance(datum, dict): _fail('record', datum)"]
+        for field in record["fields"]:
+            lines.append("    v = datum.get(%r)" % field["name"])
+            self.write(field["type"], "v", lines, "    ")
+        return "\n".join(lines)
+
+    def record_reader(self, record):
+        lines = ["def _r%d(data, pos):" % record["index"],
+                 "    datum = {}"]
+        for field in record["fields"]:
+            self.read(field["type"], "v", lines, "    ")
+            lines.append("    datum[%r] = v" % field["name"])
+        lines.append("    return datum, pos")
+        return "\n".join(lines)
+
+    def write_long(self, value, lines, indent):
+        # value must be a variable name: it is overwritten with its zigzag encoding
+        lines.append("%s%s = (%s << 1) ^ (%s >> 63)" % (indent, value, value, value))
+        lines.append("%sif %s < 128: out.append(%s)" % (indent, value, value))
+        lines.append("%selse: _write_varint(out, %s)" % (indent, value))
+
+    def write_length(self, expression, lines, indent):
+        n = self.variable("n")
+        lines.append("%s%s = len(%s) << 1" % (indent, n, expression))
+        lines.append("%sif %s < 128: out.append(%s)" % (indent, n, n))
+        lines.append("%selse: _write_varint(out, %s)" % (indent, n))
+
+    def write(self, schema, v, lines, indent):
+        # Appends to lines the code that writes to out the value of the variable v
+        if schema == "null":
+            lines.append("%sif %s is not None: _fail('null', %s)" % (indent, v, v))
+        elif schema == "boolean":
+            lines.append("%sif %s is True: out.append(1)" % (indent, v))
+            lines.append("%selif %s is False: out.append(0)" % (indent, v))
+            lines.append("%selse: _fail('boolean', %s)" % (indent, v))
+        elif schema in ("int", "long"):
+            bounds = "_INT" if schema == "int" else "_LONG"
+            lines.append("%sif not %s_MIN <= %s <= %s_MAX or isinstance(%s, float): _fail(%r, %s)" %
+                         (indent, bounds, v, bounds, v, schema, v))
+            self.write_long(v, lines, indent)
+        elif schema in ("float", "double"):
+            lines.append("%sout += _pack_%s(%s)" % (indent, schema, v))
+        elif schema == "bytes":
+            lines.append("%sif not isinstance(%s, str): _fail('bytes', %s)" % (indent, v, v))
+            self.write_length(v, lines, indent)
+            lines.append("%sout += %s" % (indent, v))
+        elif schema == "string":
+            lines.append("%sif isinstance(%s, unicode): %s = %s.encode('utf-8')" % (indent, v, v, v))
+            lines.append("%selif not isinstance(%s, str): _fail('string', %s)" % (indent, v, v))
+            self.write_length(v, lines, indent)
+            lines.append("%sout += %s" % (indent, v))
+        elif isinstance(schema, list):
+            self.write_union(schema, v, lines, indent)
+        elif schema["type"] == "record":
+            lines.append("%s_w%d(%s, out)" % (indent, schema["index"], v))
+        elif schema["type"] == "enum":
+            symbols = self.constant(dict((symbol, _encoded_long(index))
+                                         for index, symbol in enumerate(schema["symbols"])))
+            lines.append("%sout += %s[%s]" % (indent, symbols, v))
+        elif schema["type"] == "fixed":
+            lines.append("%sif not isinstance(%s, str) or len(%s) != %d: _fail('fixed', %s)" %
+                         (indent, v, v, schema["size"], v))
+            lines.append("%sout += %s" % (indent, v))
+        elif schema["type"] == "array":
+            item = self.variable()
+            lines.append("%sif not isinstance(%s, list): _fail('array', %s)" % (indent, v, v))
+            lines.append("%sif %s:" % (indent, v))
+            self.write_length(v, lines, indent + "    ")
+            lines.append("%s    for %s in %s:" % (indent, item, v))
+            self.write(schema["items"], item, lines, indent + "        ")
+            lines.append("%sout.append(0)" % indent)
+        elif schema["type"] == "map":
+            key, value = self.variable("k"), self.variable()
+            lines.append("%sif not isinstance(%s, dict): _fail('map', %s)" % (indent, v, v))
+            lines.append("%sif %s:" % (indent, v))
+            self.write_length(v, lines, indent + "    ")
+            lines.append("%s    for %s, %s in %s.items():" % (indent, key, value, v))
+            self.write("string", key, lines, indent + "        ")
+            self.write(schema["values"], value, lines, indent + "        ")
+            lines.append("%sout.append(0)" % indent)
+
+    def write_union(self, schema, v, lines, indent):
+        # As the avro library, the last branch that validates the datum is chosen
+        branches = list(enumerate(schema))
+        if len(schema) == 2 and "null" in schema:
+            null_index = schema.index("null")
+            index, branch = branches[1 - null_index]
+            lines.append("%sif %s is None: out.append(%d)" % (indent, v, null_index << 1))
+            lines.append("%selse:" % indent)
+            lines.append("%s    out.append(%d)" % (indent, index << 1))
+            self.write(branch, v, lines, indent + "    ")
+            return
+
+        keyword = "if"
+        for index, branch in reversed(branches):
+            validate = self.constant(_validator(branch), "_valid")
+            lines.append("%s%s %s(%s):" % (indent, keyword, validate, v))
+            lines.append("%s    out += %r" % (indent, _encoded_long(index)))
+            self.write(branch, v, lines, indent + "    ")
+            keyword = "elif"
+        lines.append("%selse: _fail('union', %s)" % (indent, v))
+
+    def read_length(self, n, lines, indent):
+        lines.append("%sb = ord(data[pos])" % indent)
+        lines.append("%sif b < 128: %s = (b >> 1) ^ -(b & 1); pos += 1" % (indent, n))
+        lines.append("%selse: %s, pos = _read_long(data, pos)" % (indent, n))
+
+    def read(self, schema, v, lines, indent):
+        # Appends to lines the code that reads a value at pos and stores it in the variable v
+        if schema == "null":
+            lines.append("%s%s = None" % (indent, v))
+        elif schema == "boolean":
+            lines.append("%s%s = data[pos] == '\\x01'; pos += 1" % (indent, v))
+        elif schema in ("int", "long"):
+            self.read_length(v, lines, indent)
+        elif schema == "float":
+            lines.append("%s%s = _unpack_float(data, pos)[0]; pos += 4" % (indent, v))
+        elif schema == "double":
+            lines.append("%s%s = _unpack_double(data, pos)[0]; pos += 8" % (indent, v))
+        elif schema in ("bytes", "string"):
+            n = self.variable("n")
+            self.read_length(n, lines, indent)
+            decode = ".decode('utf-8')" if schema == "string" else ""
+            lines.append("%s%s = data[pos:pos + %s]%s; pos += %s" % (indent, v, n, decode, n))
+        elif isinstance(schema, list):
+            index = self.variable("i")
+            if len(schema) <= 64:
+                # the index is encoded in a single byte, compared without decoding it
+                lines.append("%s%s = data[pos]; pos += 1" % (indent, index))
+                encoded = [repr(_encoded_long(i)) for i in range(len(schema))]
+            else:
+                self.read_length(index, lines, indent)
+                encoded = [str(i) for i in range(len(schema))]
+            keyword = "if"
+            for i, branch in enumerate(schema):
+                lines.append("%s%s %s == %s:" % (indent, keyword, index, encoded[i]))
+                self.read(branch, v, lines, indent + "    ")
+                keyword = "elif"
+            lines.append("%selse: raise ValueError('Invalid union index')" % indent)
+        elif schema["type"] == "record":
+            lines.append("%s%s, pos = _r%d(data, pos)" % (indent, v, schema["index"]))
+        elif schema["type"] == "enum":
+            index = self.variable("i")
+            symbols = self.constant(tuple(schema["symbols"]))
+            self.read_length(index, lines, indent)
+            lines.append("%s%s = %s[%s]" % (indent, v, symbols, index))
+        elif schema["type"] == "fixed":
+            lines.append("%s%s = data[pos:pos + %d]; pos += %d" % (indent, v, schema["size"], schema["size"]))
+        elif schema["type"] in ("array", "map"):
+            n, item = self.variable("n"), self.variable()
+            lines.append("%s%s = %s" % (indent, v, "[]" if schema["type"] == "array" else "{}"))
+            self.read_length(n, lines, indent)
+            lines.append("%swhile %s:" % (indent, n))
+            lines.append("%s    if %s < 0:" % (indent, n))
+            lines.append("%s        %s = -%s" % (indent, n, n))
+            lines.append("%s        pos = _skip_long(data, pos)" % indent)
+            lines.append("%s    for _ in xrange(%s):" % (indent, n))
+            if schema["type"] == "array":
+                self.read(schema["items"], item, lines, indent + "        ")
+                lines.append("%s        %s.append(%s)" % (indent, v, item))
+            else:
+                key = self.variable("k")
+                self.read("string", key, lines, indent + "        ")
+                self.read(schema["values"], item, lines, indent + "        ")
+                lines.append("%s        %s[%s] = %s" % (indent, v, key, item))
+            self.read_length(n, lines, indent + "    ")
+
+    def skip(self, schema, lines, indent):
+        # Appends to lines the code that moves pos after a value. The complex values are read and discarded
+        if schema == "null":
+            return
+        elif schema == "boolean":
+            lines.append("%spos += 1" % indent)
+        elif schema in ("int", "long"):
+            lines.append("%spos = _skip_long(data, pos)" % indent)
+        elif schema == "float":
+            lines.append("%spos += 4" % indent)
+        elif schema == "double":
+            lines.append("%spos += 8" % indent)
+        elif schema in ("bytes", "string"):
+            n = self.variable("n")
+            self.read_length(n, lines, indent)
+            lines.append("%spos += %s" % (indent, n))
+        elif not isinstance(schema, list) and schema["type"] == "fixed":
+            lines.append("%spos += %d" % (indent, schema["size"]))
+        else:
+            self.read(schema, self.variable("skipped"), lines, indent)
+
+
+class AvroCodec(object):
+    """
+    Encoder and decoder of the Avro binary encoding for a schema. The schema must be a record
+
+    :type schema: `dict`
+    :param schema: the Avro schema
+
+    :raises: :exc:`SchemaException <clay.exceptions.SchemaException>` if the schema is not valid
+    """
+    def __init__(self, schema):
+        compiler = _Compiler()
+        root = compiler.normalize(schema)
+        if not isinstance(root, dict) or root["type"] != "record":
+            raise SchemaException("The schema must be a record")
+        compiler.compile()
+
+        # a reader and a skipper for every field of the root record, to decode the fields separately
+        field_names = []
+        for index, field in enumerate(root["fields"]):
+            lines = ["def _f%d(data, pos):" % index]
+            compiler.read(field["type"], "v", lines, "    ")
+            lines.append("    return v, pos")
+            lines.append("def _s%d(data, pos):" % index)
+            compiler.skip(field["type"], lines, "    ")
+            lines.append("    return pos")
+            compiler.sources.append("\n".join(lines))
+            field_names.append(field["name"])
+
+        self.schema = schema
+        self.source = "\n\n".join(compiler.sources)
+        namespace = compiler.namespace
+        exec compile(self.source, "<avro codec %s>" % schema.get("name"), "exec") in namespace
+
+        self._write = namespace["_w%d" % root["index"]]
+        self._read = namespace["_r%d" % root["index"]]
+        self.fields = tuple((name, namespace["_f%d" % index], namespace["_s%d" % index])
+                            for index, name in enumerate(field_names))
+
+    def encode(self, datum):
+        """
+        Encode the datum
+
+        :type datum: `dict`
+        :param datum: the datum to encode
+        :rtype: `str`
+        :raises: :exc:`SchemaException <clay.exceptions.SchemaException>` if the datum is not valid for the schema
+        """
+        out = bytearray()
+        try:
+            self._write(datum, out)
+        except _ENCODE_ERRORS:
+            raise SchemaException(datum)
+        return str(out)
+
+    def decode(self, data, pos=0):
+        """
+        Decode the datum encoded in data
+
+        :param data: a `str` or a `buffer`
+        :param pos: the offset of the encoded datum in data
+        :rtype: `dict`
+        :raises: :exc:`SchemaException <clay.exceptions.SchemaException>` if the data is truncated or not valid
+        """
+        try:
+            datum, pos = self._read(data, pos)
+        except _DECODE_ERRORS:
+            raise SchemaException("The Avro data is not valid")
+        if pos > len(data):
+            raise SchemaException("The Avro data is truncated")
+        return datum
+
+    def decode_many(self, data, count, pos=0):
+        """
+        Decode count datums encoded one after the other in data
+
+        :param data: a `str` or a `buffer`
+        :param count: the number of datums
+        :param pos: the offset of the first datum in data
+        :return: a tuple with the `list` of the datums and the offset of the end of the last one
+        :raises: :exc:`SchemaException <clay.exceptions.SchemaException>` if the data is truncated or not valid
+        """
+        read = self._read
+        data_list = []
+        try:
+            for i in xrange(count):
+                datum, pos = read(data, pos)
+                data_list.append(datum)
+        except _DECODE_ERRORS:
+            raise SchemaException("The Avro data is not valid")
+        if pos > len(data):
+            raise SchemaException("The Avro data is truncated")
+        return data_list, pos
+
+    def read_field(self, index, data, pos):
+        """
+        Decode the field of the record with the given index, starting from pos
+
+        :return: a tuple with the value of the field and the offset of the next field
+        """
+        try:
+            value, end = self.fields[index][1](data, pos)
+        except _DECODE_ERRORS:
+            raise SchemaException("The Avro data is not valid")
+        if end > len(data):
+            raise SchemaException("The Avro data is truncated")
+        return value, end
+
+    def skip_field(self, index, data, pos):
+        """
+        Skip the field of the record with the given index, starting from pos
+
+        :return: the offset of the next field
+        """
+        try:
+            end = self.fields[index][2](data, pos)
+        except _DECODE_ERRORS:
+            raise SchemaException("The Avro data is not valid")
+        if end > len(data):
+            raise SchemaException("The Avro data is truncated")
+        return end
+
+# vim:tabstop=4:expandtab
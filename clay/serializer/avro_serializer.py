@@ -19,103 +19,155 @@
 # IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-from cStringIO import StringIO
+# Package Imports
+from . import Serializer, Cache, LazyPayload, check_predicate
+from .avro_codec import AvroCodec
+from .compression import catalog_compression
+from .envelope import encode_long, write_envelope, write_compressed_envelope, \
+    read_envelope, peek_envelope
+from .. import as_catalog
 
-from ..exceptions import MissingDependency
 
-# AVRO Imports
-try:
-    import avro.schema
-except ImportError:
-    raise MissingDependency("avro")
+class AvroCache(Cache):
 
-from avro.io import DatumWriter, DatumReader, BinaryEncoder, BinaryDecoder, AvroTypeException
+    def get(self, schema, fingerprint=None):
+        return self._lookup(self.fingerprint(schema, fingerprint), AvroCodec, schema)
 
-# Package Imports
-from . import Serializer, Cache
-from .. import schema_from_name
-from ..exceptions import SchemaException
 
-ENVELOPE_SCHEMA = {
-    "namespace": "CLAY",
-    "name": "ENVELOPE",
-    "type": "record",
-    "fields": [
-        {"name": "id", "type": "int"},
-        {"name": "payload", "type": "bytes"}
-    ]
-}
+def _payload_codec(catalog, payload_id):
+    payload_schema = catalog.schema_from_id(payload_id)
+    return payload_schema, AvroCache().get(payload_schema, catalog.fingerprint(payload_id))
 
 
-class AvroCache(Cache):
+class AvroLazyPayload(LazyPayload):
+    # Decodes the fields of the payload on access. The fields before the one requested are skipped and their
+    # offsets are kept, so every field is read directly from its position
+    def __init__(self, payload, codec):
+        super(AvroLazyPayload, self).__init__()
+        self._encoded = payload
+        self._codec = codec
+        self._indexes = dict((field[0], index) for index, field in enumerate(codec.fields))
+        self._offsets = [0]
 
-    SER = 0
-    DESER = 1
-
-    def get(self, obj_type, schema):
-        assert obj_type in (self.SER, self.DESER)
-        cache = self._cache[obj_type]
-        ser_name = schema["name"]
-        try:
-            obj = cache[ser_name]
-        except KeyError:
-            if obj_type == self.SER:
-                schema_obj = avro.schema.make_avsc_object(schema)
-                obj = DatumWriter(schema_obj)
-            else:
-                schema_obj = avro.schema.make_avsc_object(schema)
-                obj = DatumReader(schema_obj)
-            cache[ser_name] = obj
-        return obj
+    def _decode(self):
+        return self._codec.decode(self._encoded)
+
+    def field(self, name):
+        if self._payload is not None:
+            return self._payload[name]
 
+        index = self._indexes[name]
+        offsets = self._offsets
+        codec = self._codec
+        while len(offsets) <= index:
+            offsets.append(codec.skip_field(len(offsets) - 1, self._encoded, offsets[-1]))
 
-class CustomEncoder(BinaryEncoder):
-    # This encoder fix problems with utf8 characters
-    def write_utf8(self, datum):
-        try:
-            self.write_bytes(datum.encode("utf-8"))
-        except UnicodeDecodeError:
-            self.write_bytes(unicode(datum, "utf-8").encode("utf-8"))
+        value, end = codec.read_field(index, self._encoded, offsets[index])
+        if index + 1 == len(offsets):
+            offsets.append(end)
+        return value
 
 
 class AvroSerializer(Serializer):
     """
-    Class to serialize and deserialize messages using Avro
+    Class to serialize and deserialize messages using Avro. The data are encoded and decoded by an
+    :class:`AvroCodec <clay.serializer.avro_codec.AvroCodec>` compiled for every schema of the catalog
     """
 
     def __init__(self, message_type, schema_catalog):
-        schema_id, schema = schema_from_name(message_type, schema_catalog)
+        schema_catalog = as_catalog(schema_catalog)
+        schema_id, schema = schema_catalog.schema_from_name(message_type)
         self.payload_schema_id = schema_id
 
-        self._payload_writer = AvroCache().get(AvroCache.SER, schema)
-        self._envelope_writer = AvroCache().get(AvroCache.SER, ENVELOPE_SCHEMA)
+        self._payload_codec = AvroCache().get(schema, schema_catalog.fingerprint(schema_id))
+        self._envelope_header = encode_long(schema_id)
+        self._compression = catalog_compression(schema_catalog)
 
-    def serialize(self, datum):
-        payload_encoder = CustomEncoder(StringIO())
-        envelope_encoder = BinaryEncoder(StringIO())
+    @staticmethod
+    def prepare_catalog(catalog):
+        catalog = as_catalog(catalog)
+        for schema_id, schema in catalog.named.itervalues():
+            AvroCache().get(schema, catalog.fingerprint(schema_id))
 
-        try:
-            self._payload_writer.write(datum, payload_encoder)
-            envelope_message = {
-                "id": self.payload_schema_id,
-                "payload": payload_encoder.writer.getvalue()
-            }
-            self._envelope_writer.write(envelope_message, envelope_encoder)
-        except AvroTypeException:
-            raise SchemaException(datum)
+    def _write_envelope(self, payload):
+        if self._compression is None:
+            return write_envelope(self._envelope_header, payload)
+        return write_compressed_envelope(self.payload_schema_id, payload, self._compression)
 
-        return envelope_encoder.writer.getvalue()
+    def serialize(self, datum):
+        return self._write_envelope(self._payload_codec.encode(datum))
+
+    def serialize_many(self, data):
+        encode = self._payload_codec.encode
+        if self._compression is not None:
+            return [self._write_envelope(encode(datum)) for datum in data]
+        header = self._envelope_header
+        return [write_envelope(header, encode(datum)) for datum in data]
 
     @staticmethod
     def deserialize(message, catalog):
-        envelope_reader = AvroCache().get(AvroCache.DESER, ENVELOPE_SCHEMA)
-        envelope_decoder = BinaryDecoder(StringIO(message))
-        envelope = envelope_reader.read(envelope_decoder)
+        payload_id, payload = read_envelope(message)
+        payload_schema, payload_codec = _payload_codec(as_catalog(catalog), payload_id)
+        payload = payload_codec.decode(payload)
+
+        return payload, payload_id, payload_schema
+
+    @staticmethod
+    def deserialize_many(messages, catalog):
+        catalog = as_catalog(catalog)
+        codecs = {}
+
+        result = []
+        for message in messages:
+            payload_id, payload = read_envelope(message)
+            try:
+                payload_schema, payload_codec = codecs[payload_id]
+            except KeyError:
+                payload_schema, payload_codec = codecs[payload_id] = _payload_codec(catalog, payload_id)
+            result.append((payload_codec.decode(payload), payload_id, payload_schema))
+        return result
+
+    @staticmethod
+    def deserialize_projection(message, catalog, fields=None, predicate=None):
+        payload_id, payload = read_envelope(message)
+        payload_schema, payload_codec = _payload_codec(as_catalog(catalog), payload_id)
+
+        if predicate is None:
+            predicate = {}
+        if fields is None:
+            projection = set(field[0] for field in payload_codec.fields)
+        else:
+            projection = set(fields)
+        # the fields are decoded in the order they are written: the ones not needed are skipped, and the decoding
+        # stops when the predicate fails or when all the needed fields have been read
+        needed = len(projection | set(predicate))
+        projected = {}
+        pos = 0
+        for index, (name, read, skip) in enumerate(payload_codec.fields):
+            if needed == 0:
+                break
+            if name in projection or name in predicate:
+                value, pos = payload_codec.read_field(index, payload, pos)
+                if name in predicate and not check_predicate(predicate[name], value):
+                    return None, payload_id, payload_schema
+                if name in projection:
+                    projected[name] = value
+                needed -= 1
+            else:
+                pos = payload_codec.skip_field(index, payload, pos)
+
+        return projected, payload_id, payload_schema
+
+    @staticmethod
+    def peek(message, catalog):
+        payload_id, payload_offset, payload_length = peek_envelope(message)
+        return payload_id, as_catalog(catalog).schema_from_id(payload_id)["name"], payload_offset
+
+    @staticmethod
+    def deserialize_lazy(message, catalog):
+        payload_id, payload = read_envelope(message)
+        payload_schema, payload_codec = _payload_codec(as_catalog(catalog), payload_id)
 
-        payload_id = envelope["id"]
-        payload_schema = catalog[payload_id]
-        payload_reader = AvroCache().get(AvroCache.DESER, payload_schema)
-        payload_decoder = BinaryDecoder(StringIO(envelope["payload"]))
-        payload = payload_reader.read(payload_decoder)
+        return AvroLazyPayload(payload, payload_codec), payload_id, payload_schema
 
-        return payload, payload_id, payload_schema
\ No newline at end of file
+# vim:tabstop=4:expandtab
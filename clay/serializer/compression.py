@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2015, CRS4
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Compression of the payloads of the messages. The compression is configured in the catalog with the `compression`
+key, e.g.::
+
+    catalog = {
+        "name": "CATALOG",
+        "version": 1,
+        "compression": {"codec": "zlib", "threshold": 1024},
+        0: {...}
+    }
+
+Only the payloads of at least `threshold` bytes are compressed. The messages without compression can always be
+deserialized, so the compression can be enabled without updating the consumers first. Other codecs can be added
+with :func:`register_compression`.
+"""
+
+import zlib
+
+from .. import as_catalog
+from ..exceptions import SchemaException
+
+DEFAULT_THRESHOLD = 1024
+
+_CODECS_BY_NAME = {}
+_CODECS_BY_ID = {}
+
+
+def register_compression(name, codec_id, compress, decompress):
+    """
+    Register a compression codec
+
+    :type name: `str`
+    :param name: the name of the codec, used in the catalog and in the JSON messages
+    :type codec_id: `int`
+    :param codec_id: the number that identifies the codec in the Avro envelopes. It must be positive
+    :param compress: the function that compresses a `str`
+    :param decompress: the function that decompresses a `str` or a `buffer`
+    """
+    if codec_id <= 0:
+        raise ValueError("The codec id must be positive")
+    _CODECS_BY_NAME[name] = _CODECS_BY_ID[codec_id] = (name, codec_id, compress, decompress)
+
+
+def codec_from_name(name):
+    """
+    Return the codec with the given name, as a tuple with the name, the id, the compression and the decompression
+    functions
+    """
+    try:
+        return _CODECS_BY_NAME[name]
+    except KeyError:
+        raise SchemaException("Unknown compression codec '%s'" % name)
+
+
+def codec_from_id(codec_id):
+    """
+    Return the codec with the given id, as a tuple with the name, the id, the compression and the decompression
+    functions
+    """
+    try:
+        return _CODECS_BY_ID[codec_id]
+    except KeyError:
+        raise SchemaException("Unknown compression codec id '%s'" % codec_id)
+
+
+def decompress(codec, data):
+    """
+    Decompress the data with the codec returned by :func:`codec_from_name` or :func:`codec_from_id`
+
+    :raises: :exc:`SchemaException <clay.exceptions.SchemaException>` if the data is not valid
+    """
+    try:
+        return codec[3](data)
+    except Exception:
+        raise SchemaException("The payload cannot be decompressed with '%s'" % codec[0])
+
+
+class Compression(object):
+    """
+    The compression of the payloads with a codec
+
+    :type codec: `str`
+    :param codec: the name of the codec
+    :type threshold: `int`
+    :param threshold: the minimum size in bytes of the payloads to compress
+    """
+    def __init__(self, codec="zlib", threshold=DEFAULT_THRESHOLD):
+        self.codec, self.codec_id, self._compress, self._decompress = codec_from_name(codec)
+        self.threshold = threshold
+
+    def compress(self, payload):
+        """
+        Compress the payload if it's at least :attr:`threshold` bytes long and if the compression reduces its size
+
+        :return: the compressed payload or :const:`None` if it must be sent uncompressed
+        """
+        if len(payload) < self.threshold:
+            return None
+        compressed = self._compress(payload)
+        if len(compressed) >= len(payload):
+            return None
+        return compressed
+
+
+def catalog_compression(catalog):
+    """
+    Return the :class:`Compression` configured in the catalog or :const:`None` if the payloads must not be compressed
+    """
+    config = as_catalog(catalog).compression
+    if not config:
+        return None
+    return Compression(config.get("codec", "zlib"), config.get("threshold", DEFAULT_THRESHOLD))
+
+
+register_compression("zlib", 1, zlib.compress, zlib.decompress)
+
+# vim:tabstop=4:expandtab
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2015, CRS4
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Writer and reader of the Avro object container files, used to archive messages and to replay them.
+
+A container file holds the messages of a single type. It starts with a header with the schema and the compression
+codec and is followed by blocks of messages encoded with the Avro binary encoding. Every block ends with the sync
+marker of the file, so the reader can start from any position by searching the next marker: an archive can be split
+in byte ranges read by different processes. The files can be read by the other Avro tools too.
+"""
+
+import json
+import os
+import zlib
+
+from .avro_serializer import AvroCache
+from .envelope import encode_long, decode_long
+from ..exceptions import SchemaException
+
+MAGIC = "Obj\x01"
+SYNC_SIZE = 16
+DEFAULT_BLOCK_SIZE = 64000
+
+_METADATA_CODEC = "avro.codec"
+_METADATA_SCHEMA = "avro.schema"
+
+
+def _deflate(data):
+    # the Avro deflate codec is the raw deflate format, without the zlib header and checksum
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _inflate(data):
+    return zlib.decompress(data, -15)
+
+
+CODECS = {
+    "null": (str, str),
+    "deflate": (_deflate, _inflate)
+}
+
+
+def _encode_bytes(value):
+    return encode_long(len(value)) + value
+
+
+def _read_long(fileobj):
+    # Read an Avro long from the file, returning None at the end of the file
+    encoded = fileobj.read(1)
+    if not encoded:
+        return None
+    while ord(encoded[-1]) & 0x80:
+        b = fileobj.read(1)
+        if not b:
+            raise SchemaException("The container file is truncated")
+        encoded += b
+    return decode_long(encoded)[0]
+
+
+def _read_exactly(fileobj, size):
+    data = fileobj.read(size)
+    if len(data) != size:
+        raise SchemaException("The container file is truncated")
+    return data
+
+
+class ContainerWriter(object):
+    """
+    Writer of an Avro object container file. The messages are buffered and written in blocks of about
+    :attr:`block_size` bytes (before compression).
+
+    :type fileobj: `file`
+    :param fileobj: the file to write, opened in binary mode
+
+    :type schema: `dict`
+    :param schema: the schema of the messages
+
+    :type codec: `str`
+    :param codec: the compression codec of the blocks, `null` or `deflate`
+
+    :type block_size: `int`
+    :param block_size: the number of bytes after which the current block is written
+
+    :type metadata: `dict`
+    :param metadata: additional metadata to write in the header of the file
+    """
+
+    def __init__(self, fileobj, schema, codec="null", block_size=DEFAULT_BLOCK_SIZE, metadata=None):
+        try:
+            self._compress = CODECS[codec][0]
+        except KeyError:
+            raise SchemaException("Unknown codec '%s'" % codec)
+        self._fileobj = fileobj
+        self._codec = AvroCache().get(schema)
+        self.schema = schema
+        self.codec = codec
+        self.block_size = block_size
+        self.sync_marker = os.urandom(SYNC_SIZE)
+
+        self._block = []
+        self._block_bytes = 0
+
+        header_metadata = dict(metadata or {})
+        header_metadata[_METADATA_CODEC] = codec
+        header_metadata[_METADATA_SCHEMA] = json.dumps(schema)
+        header = [MAGIC, encode_long(len(header_metadata))]
+        for key, value in sorted(header_metadata.iteritems()):
+            header.append(_encode_bytes(key.encode("utf-8")))
+            header.append(_encode_bytes(value))
+        header.append(encode_long(0))
+        header.append(self.sync_marker)
+        fileobj.write("".join(header))
+
+    def append(self, datum):
+        """
+        Append a message to the file
+
+        :type datum: `dict`
+        :param datum: the content of the message, e.g., :attr:`Message.content <clay.message.Message.content>`
+        :raises: :exc:`SchemaException <clay.exceptions.SchemaException>` if the datum is not valid for the schema
+        """
+        encoded = self._codec.encode(datum)
+        self._block.append(encoded)
+        self._block_bytes += len(encoded)
+        if self._block_bytes >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered messages in a new block
+        """
+        if self._block:
+            data = self._compress("".join(self._block))
+            self._fileobj.write("".join((encode_long(len(self._block)), encode_long(len(data)), data,
+                                         self.sync_marker)))
+            self._block = []
+            self._block_bytes = 0
+        self._fileobj.flush()
+
+    def close(self):
+        """
+        Write the buffered messages and close the file
+        """
+        self.flush()
+        self._fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ContainerReader(object):
+    """
+    Streaming reader of an Avro object container file. Iterating over the reader returns the messages of the file,
+    as `dict`, reading a block at a time.
+
+    :type fileobj: `file`
+    :param fileobj: the file to read, opened in binary mode. It must be seekable to use :meth:`read_split`
+
+    :raises: :exc:`SchemaException <clay.exceptions.SchemaException>` if the file is not a valid container
+    """
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        if fileobj.read(len(MAGIC)) != MAGIC:
+            raise SchemaException("Not an Avro object container file")
+
+        self.metadata = {}
+        count = _read_long(fileobj)
+        while count:
+            if count < 0:
+                # a negative count is followed by the size in bytes of the entries
+                count = -count
+                _read_long(fileobj)
+            for i in xrange(count):
+                key = _read_exactly(fileobj, _read_long(fileobj)).decode("utf-8")
+                self.metadata[key] = _read_exactly(fileobj, _read_long(fileobj))
+            count = _read_long(fileobj)
+        self.sync_marker = _read_exactly(fileobj, SYNC_SIZE)
+
+        self.codec = self.metadata.get(_METADATA_CODEC, "null")
+        try:
+            self._decompress = CODECS[self.codec][1]
+        except KeyError:
+            raise SchemaException("Unknown codec '%s'" % self.codec)
+        try:
+            self.schema = json.loads(self.metadata[_METADATA_SCHEMA])
+        except (KeyError, ValueError):
+            raise SchemaException("The container file has no valid schema")
+        self._codec = AvroCache().get(self.schema)
+
+    def blocks(self):
+        """
+        Read the blocks from the current position of the file
+
+        :return: an iterator over the `list` of the messages of every block
+        """
+        while True:
+            count = _read_long(self._fileobj)
+            if count is None:
+                return
+            data = self._decompress(_read_exactly(self._fileobj, _read_long(self._fileobj)))
+            if _read_exactly(self._fileobj, SYNC_SIZE) != self.sync_marker:
+                raise SchemaException("The container file is corrupted: wrong sync marker")
+            data_list, end = self._codec.decode_many(data, count)
+            if end != len(data):
+                raise SchemaException("The container file is corrupted: wrong block size")
+            yield data_list
+
+    def __iter__(self):
+        for data_list in self.blocks():
+            for datum in data_list:
+                yield datum
+
+    def sync(self, position):
+        """
+        Move to the first block starting at or after position
+
+        :type position: `int`
+        :param position: the offset in the file
+        :return: the offset of the block or the size of the file, if no block starts after position
+        """
+        fileobj = self._fileobj
+        fileobj.seek(max(position - SYNC_SIZE, 0))
+        window = fileobj.read(SYNC_SIZE)
+        start = fileobj.tell() - len(window)
+        while True:
+            found = window.find(self.sync_marker)
+            if found >= 0:
+                fileobj.seek(start + found + SYNC_SIZE)
+                return start + found + SYNC_SIZE
+            chunk = fileobj.read(DEFAULT_BLOCK_SIZE)
+            if not chunk:
+                return fileobj.tell()
+            # the last bytes are kept, since a marker may span two chunks
+            start += len(window) - SYNC_SIZE + 1
+            window = window[-SYNC_SIZE + 1:] + chunk
+
+    def read_split(self, start, end):
+        """
+        Read the messages of the blocks starting in the byte range [start, end) of the file. Splitting the file
+        in ranges that cover it, every message is read exactly once.
+
+        :type start: `int`
+        :param start: the offset of the beginning of the range
+        :type end: `int`
+        :param end: the offset of the end of the range
+        :return: an iterator over the messages
+        """
+        position = self.sync(start)
+        while position < end:
+            block = next(self.blocks(), None)
+            if block is None:
+                return
+            for datum in block:
+                yield datum
+            position = self._fileobj.tell()
+
+# vim:tabstop=4:expandtab
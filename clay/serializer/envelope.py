@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2015, CRS4
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+The envelope wraps the Avro payload of a message together with the id of its schema in the catalog.
+It is written as the Avro binary encoding of a record with the :const:`ENVELOPE_SCHEMA` schema, i.e., the zigzag
+varint of the id followed by the zigzag varint of the payload length and by the payload bytes.
+
+When the payload is compressed, the id is written as ``-id - 1`` and it is followed by the id of the compression
+codec (see :mod:`clay.serializer.compression`), by the length of the compressed payload and by the compressed
+payload. Since the schema ids are not negative, the envelopes without compression are read as before.
+"""
+
+from .compression import codec_from_id, decompress
+from ..exceptions import SchemaException
+
+ENVELOPE_SCHEMA = {
+    "namespace": "CLAY",
+    "name": "ENVELOPE",
+    "type": "record",
+    "fields": [
+        {"name": "id", "type": "int"},
+        {"name": "payload", "type": "bytes"}
+    ]
+}
+
+
+def encode_long(value):
+    """
+    Return the Avro encoding of a long, i.e., its zigzag varint representation
+
+    :type value: `int`
+    :param value: the value to encode
+    :rtype: `str`
+    """
+    value = (value << 1) ^ (value >> 63)
+    encoded = bytearray()
+    while value & ~0x7F:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return str(encoded)
+
+
+def decode_long(data, pos=0):
+    """
+    Decode the Avro long starting at :attr:`pos`
+
+    :param data: a `str` or a `buffer`
+    :param pos: the offset of the first byte of the long
+    :return: a tuple with the decoded value and the offset of the first byte after it
+    """
+    try:
+        b = ord(data[pos])
+        value = b & 0x7F
+        shift = 7
+        while b & 0x80:
+            pos += 1
+            b = ord(data[pos])
+            value |= (b & 0x7F) << shift
+            shift += 7
+    except IndexError:
+        raise SchemaException("The envelope is truncated")
+    return (value >> 1) ^ -(value & 1), pos + 1
+
+
+def write_envelope(header, payload):
+    """
+    Return the envelope of the payload
+
+    :param header: the encoded schema id, as returned by :func:`encode_long`
+    :param payload: the encoded payload
+    :rtype: `str`
+    """
+    return "".join((header, encode_long(len(payload)), payload))
+
+
+def write_compressed_envelope(schema_id, payload, compression):
+    """
+    Return the envelope of the payload, compressed if the :class:`Compression <clay.serializer.compression.Compression>`
+    accepts it
+
+    :param schema_id: the id of the schema of the payload
+    :param payload: the encoded payload
+    :param compression: the :class:`Compression <clay.serializer.compression.Compression>`
+    :rtype: `str`
+    """
+    compressed = compression.compress(payload)
+    if compressed is None:
+        return write_envelope(encode_long(schema_id), payload)
+    return "".join((encode_long(-schema_id - 1), encode_long(compression.codec_id), encode_long(len(compressed)),
+                    compressed))
+
+
+def _read_header(message):
+    # Return the id of the schema, the id of the compression codec (None if the payload is not compressed), the offset
+    # of the payload and its length
+    payload_id, pos = decode_long(message)
+    codec_id = None
+    if payload_id < 0:
+        payload_id = -payload_id - 1
+        codec_id, pos = decode_long(message, pos)
+    length, pos = decode_long(message, pos)
+    if pos + length > len(message):
+        raise SchemaException("The envelope is truncated")
+    return payload_id, codec_id, pos, length
+
+
+def peek_envelope(message):
+    """
+    Read the header of the envelope of the message, without reading the payload
+
+    :param message: the serialized message
+    :return: a tuple with the id of the schema, the offset of the payload in the message and its length. The offset
+        and the length are :const:`None` if the payload is compressed
+    """
+    payload_id, codec_id, pos, length = _read_header(message)
+    if codec_id is not None:
+        return payload_id, None, None
+    return payload_id, pos, length
+
+
+def read_envelope(message):
+    """
+    Read the envelope of the message without copying the payload
+
+    :param message: the serialized message
+    :return: a tuple with the id of the schema and a `buffer` over the payload (the decompressed payload if it is
+        compressed)
+    """
+    payload_id, codec_id, pos, length = _read_header(message)
+    if codec_id is not None:
+        return payload_id, decompress(codec_from_id(codec_id), buffer(message, pos, length))
+    return payload_id, buffer(message, pos, length)
+
+# vim:tabstop=4:expandtab
@@ -19,6 +19,9 @@
 # IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import re
+from collections import OrderedDict
+
 from ..exceptions import MissingDependency
 try:
     import simplejson
@@ -27,7 +30,11 @@ except ImportError:
 
 # Package Imports
 from . import Serializer
-from .. import schema_from_name
+from .compression import catalog_compression, codec_from_name, decompress
+from .. import schema_from_name, as_catalog
+
+# The start of the messages written by JSONSerializer.serialize, up to the payload
+_ENVELOPE_START = re.compile(r'\s*\{\s*"id"\s*:\s*(-?\d+)\s*,\s*"payload"\s*:\s*')
 
 
 class JSONSerializer(Serializer):
@@ -35,16 +42,66 @@ class JSONSerializer(Serializer):
         super(JSONSerializer, self).__init__(message_type, schema_catalog)
         schema_id, schema = schema_from_name(message_type, schema_catalog)
         self.schema_id = schema_id
+        self._compression = catalog_compression(schema_catalog)
+
+    def _compress(self, datum, encode):
+        # The compressed payload is the base64 of the compressed JSON of the datum, and the envelope has the name of
+        # the codec in the compression field. The field precedes the payload, so peek doesn't match the envelope
+        # start of the uncompressed messages
+        compressed = self._compression.compress(encode(datum))
+        if compressed is None:
+            return {"id": self.schema_id, "payload": datum}
+        return OrderedDict((("id", self.schema_id), ("compression", self._compression.codec),
+                            ("payload", compressed.encode("base64"))))
 
     def serialize(self, datum):
-        data = {"id": self.schema_id, "payload": datum}
-        return simplejson.dumps(data)
+        if self._compression is not None:
+            return simplejson.dumps(self._compress(datum, simplejson.dumps))
+        return simplejson.dumps({"id": self.schema_id, "payload": datum})
+
+    def serialize_many(self, data):
+        encode = simplejson.JSONEncoder().encode
+        schema_id = self.schema_id
+        if self._compression is not None:
+            return [encode(self._compress(datum, encode)) for datum in data]
+        return [encode({"id": schema_id, "payload": datum}) for datum in data]
+
+    @staticmethod
+    def _payload(data):
+        # Return the payload of the decoded envelope, decompressing it if needed
+        codec = data.get("compression")
+        if codec is None:
+            return data["payload"]
+        return simplejson.loads(decompress(codec_from_name(codec), data["payload"].decode("base64")))
 
     @staticmethod
     def deserialize(message, catalog):
         data = simplejson.loads(message)
-        payload = data["payload"]
+        payload = JSONSerializer._payload(data)
         schema_id = data["id"]
-        schema = catalog[schema_id]
+        schema = as_catalog(catalog).schema_from_id(schema_id)
+
+        return payload, schema_id, schema
+
+    @staticmethod
+    def peek(message, catalog):
+        # The id is read with a regular expression when it precedes the payload, as in the messages serialized by
+        # this class. Otherwise the whole message is decoded and the offset of the payload is not available
+        match = _ENVELOPE_START.match(message)
+        if match is not None:
+            schema_id, payload_offset = int(match.group(1)), match.end()
+        else:
+            schema_id, payload_offset = simplejson.loads(message)["id"], None
+        return schema_id, as_catalog(catalog).schema_from_id(schema_id)["name"], payload_offset
+
+    @staticmethod
+    def deserialize_many(messages, catalog):
+        decode = simplejson.JSONDecoder().decode
+        catalog = as_catalog(catalog)
 
-        return payload, schema_id, schema
\ No newline at end of file
+        result = []
+        for message in messages:
+            data = decode(message)
+            schema_id = data["id"]
+            result.append((JSONSerializer._payload(data), schema_id, catalog.schema_from_id(schema_id)))
+        return result
@@ -30,39 +30,42 @@ except ImportError:
     raise MissingDependency("pyavroc")
 
 # Package Imports
-from . import Serializer, Cache
-from .. import schema_from_name
+from . import Serializer, Cache, LazyPayload
+from .compression import catalog_compression
+from .envelope import encode_long, write_envelope, write_compressed_envelope, \
+    read_envelope, peek_envelope
+from .. import as_catalog
 from ..exceptions import SchemaException
 
-ENVELOPE_SCHEMA = {
-    "namespace": "CLAY",
-    "name": "ENVELOPE",
-    "type": "record",
-    "fields": [
-        {"name": "id", "type": "int"},
-        {"name": "payload", "type": "bytes"}
-    ]
-}
-
 
 class PyAvrocCache(Cache):
 
     SER = 0
     DESER = 1
 
-    def get(self, obj_type, schema):
+    def get(self, obj_type, schema, fingerprint=None):
         assert obj_type in (self.SER, self.DESER)
-        cache = self._cache[obj_type]
-        ser_name = schema["name"]
-        try:
-            obj = cache[ser_name]
-        except KeyError:
-            if obj_type == self.SER:
-                obj = pyavroc.AvroSerializer(simplejson.dumps(schema))
-            else:
-                obj = pyavroc.AvroDeserializer(simplejson.dumps(schema))
-            self._cache[ser_name] = obj
-        return obj
+        if obj_type == self.SER:
+            build = pyavroc.AvroSerializer
+        else:
+            build = pyavroc.AvroDeserializer
+        return self._lookup((obj_type, self.fingerprint(schema, fingerprint)), build, simplejson.dumps(schema))
+
+
+def _payload_deserializer(catalog, payload_id):
+    payload_schema = catalog.schema_from_id(payload_id)
+    return payload_schema, PyAvrocCache().get(PyAvrocCache.DESER, payload_schema, catalog.fingerprint(payload_id))
+
+
+class PyAvrocLazyPayload(LazyPayload):
+    # pyavroc decodes only whole records: the payload is decoded on the first access to a field
+    def __init__(self, payload, payload_deser):
+        super(PyAvrocLazyPayload, self).__init__()
+        self._encoded = payload
+        self._payload_deser = payload_deser
+
+    def _decode(self):
+        return self._payload_deser.deserialize(self._encoded)
 
 
 class AvroSerializer(Serializer):
@@ -71,32 +74,72 @@ class AvroSerializer(Serializer):
     """
 
     def __init__(self, message_type, schema_catalog):
-        schema_id, schema = schema_from_name(message_type, schema_catalog)
+        schema_catalog = as_catalog(schema_catalog)
+        schema_id, schema = schema_catalog.schema_from_name(message_type)
         self.payload_schema_id = schema_id
 
-        self._payload_ser = PyAvrocCache().get(PyAvrocCache.SER, schema)
-        self._envelope_ser = PyAvrocCache().get(PyAvrocCache.SER, ENVELOPE_SCHEMA)
+        self._payload_ser = PyAvrocCache().get(PyAvrocCache.SER, schema, schema_catalog.fingerprint(schema_id))
+        self._envelope_header = encode_long(schema_id)
+        self._compression = catalog_compression(schema_catalog)
+
+    def _write_envelope(self, payload):
+        if self._compression is None:
+            return write_envelope(self._envelope_header, payload)
+        return write_compressed_envelope(self.payload_schema_id, payload, self._compression)
 
     def serialize(self, datum):
         try:
             payload = self._payload_ser.serialize(datum)
         except (IOError, TypeError) as e:
             raise SchemaException(datum)
-        obj = {"id": self.payload_schema_id, "payload": payload}
-        res = self._envelope_ser.serialize(obj)
-        return res
+        return self._write_envelope(payload)
+
+    def serialize_many(self, data):
+        serialize = self._payload_ser.serialize
+        write = self._write_envelope
+
+        result = []
+        for datum in data:
+            try:
+                payload = serialize(datum)
+            except (IOError, TypeError):
+                raise SchemaException(datum)
+            result.append(write(payload))
+        return result
 
     @staticmethod
     def deserialize(message, catalog):
-        envelope_deser = PyAvrocCache().get(PyAvrocCache.DESER, ENVELOPE_SCHEMA)
-        envelope = envelope_deser.deserialize(message)
+        payload_id, payload = read_envelope(message)
+        payload_schema, payload_deser = _payload_deserializer(as_catalog(catalog), payload_id)
+        payload = payload_deser.deserialize(payload)
 
-        payload_id = envelope["id"]
-        payload_schema = catalog[payload_id]
+        return payload, payload_id, payload_schema
 
-        payload_deser = PyAvrocCache().get(PyAvrocCache.DESER, payload_schema)
-        payload = payload_deser.deserialize(envelope["payload"])
+    @staticmethod
+    def deserialize_many(messages, catalog):
+        catalog = as_catalog(catalog)
+        deserializers = {}
+
+        result = []
+        for message in messages:
+            payload_id, payload = read_envelope(message)
+            try:
+                payload_schema, payload_deser = deserializers[payload_id]
+            except KeyError:
+                payload_schema, payload_deser = deserializers[payload_id] = _payload_deserializer(catalog, payload_id)
+            result.append((payload_deser.deserialize(payload), payload_id, payload_schema))
+        return result
 
-        return payload, payload_id, payload_schema
+    @staticmethod
+    def peek(message, catalog):
+        payload_id, payload_offset, payload_length = peek_envelope(message)
+        return payload_id, as_catalog(catalog).schema_from_id(payload_id)["name"], payload_offset
+
+    @staticmethod
+    def deserialize_lazy(message, catalog):
+        payload_id, payload = read_envelope(message)
+        payload_schema, payload_deser = _payload_deserializer(as_catalog(catalog), payload_id)
+
+        return PyAvrocLazyPayload(payload, payload_deser), payload_id, payload_schema
 
 # vim:tabstop=4:expandtab
\ No newline at end of file
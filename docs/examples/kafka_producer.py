@@ -27,4 +27,7 @@ m.amount = 100
 # send the message using the Messenger
 messenger.send(m)
 
+# the message is sent asynchronously: wait for its delivery before exiting
+messenger.close()
+
 # vim: ts=4 et
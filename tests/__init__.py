@@ -19,6 +19,8 @@
 # IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import json
+
 RABBIT_EXCHANGE = 'test_exchange'
 
 RABBIT_QUEUE = 'TESTS'
@@ -103,4 +105,11 @@ TEST_CATALOG = {
     1: TEST_COMPLEX_SCHEMA,
     2: TEST_WRONG_SCHEMA,
     3: TEST_COMPLEX_SCHEMA_WITH_NULL
-}
\ No newline at end of file
+}
+
+def json_catalog(catalog, name):
+    # The catalog as loaded from a JSON file, i.e., with unicode strings, renamed so that it gets its own factory
+    loaded = json.loads(json.dumps(catalog))
+    loaded = dict((int(key) if key.isdigit() else key, value) for key, value in loaded.iteritems())
+    loaded['name'] = name
+    return loaded
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2015, CRS4
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Benchmark of the Avro codec of :class:`AvroSerializer <clay.serializer.avro_serializer.AvroSerializer>` against the
+reference `avro` library, on the TEST_COMPLEX schema. Run it with::
+
+    python -m tests.benchmark_avro
+
+The target throughput of the codec is at least :const:`TARGET_SPEEDUP` times the one of the `avro` library, both
+for encoding and decoding: the benchmark exits with an error if it is not reached.
+"""
+
+import sys
+import timeit
+from cStringIO import StringIO
+
+import avro.schema
+from avro.io import DatumWriter, DatumReader, BinaryEncoder, BinaryDecoder
+
+from clay.serializer.avro_codec import AvroCodec
+
+from tests import TEST_COMPLEX_SCHEMA
+
+TARGET_SPEEDUP = 5.0
+NUMBER = 5000
+
+DATUM = {
+    "valid": True,
+    "id": 1111111,
+    "long_id": 10 ** 18,
+    "float_id": 1.232,
+    "double_id": 1e-60,
+    "name": u"aaa",
+    "record_field": {"field_1": u"ddd", "field_2": u"eee"},
+    "array_simple_field": [u"ccc"] * 10,
+    "array_complex_field": [{"field_1": u"bbb"}] * 10
+}
+
+
+def main():
+    schema = avro.schema.make_avsc_object(TEST_COMPLEX_SCHEMA)
+    writer, reader = DatumWriter(schema), DatumReader(schema)
+    codec = AvroCodec(TEST_COMPLEX_SCHEMA)
+    encoded = codec.encode(DATUM)
+
+    def avro_encode():
+        encoder = BinaryEncoder(StringIO())
+        writer.write(DATUM, encoder)
+        return encoder.writer.getvalue()
+
+    def avro_decode():
+        return reader.read(BinaryDecoder(StringIO(encoded)))
+
+    assert avro_encode() == encoded and avro_decode() == codec.decode(encoded)
+
+    results = []
+    for operation, avro_function, codec_function in (("encode", avro_encode, lambda: codec.encode(DATUM)),
+                                                     ("decode", avro_decode, lambda: codec.decode(encoded))):
+        avro_rate = NUMBER / min(timeit.repeat(avro_function, number=NUMBER, repeat=3))
+        codec_rate = NUMBER / min(timeit.repeat(codec_function, number=NUMBER, repeat=3))
+        speedup = codec_rate / avro_rate
+        results.append(speedup)
+        print "{0}: avro {1:.0f} msg/s, codec {2:.0f} msg/s, speedup {3:.1f}x".format(operation, avro_rate,
+                                                                                      codec_rate, speedup)
+    return 0 if min(results) >= TARGET_SPEEDUP else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
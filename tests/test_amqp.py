@@ -19,17 +19,20 @@
 # IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import threading
 import time
+from collections import deque
 from multiprocessing import Process
 from unittest import TestCase
 
 import pika
 
 from clay.messenger import AMQPMessenger, AMQPReceiver
+from clay.messenger.amqp_messenger import _Acknowledger
 from clay.factory import MessageFactory
 from clay.serializer import AvroSerializer, AbstractHL7Serializer
 from clay.exceptions import MessengerErrorConnectionRefused, MessengerErrorNoApplicationName, \
-    MessengerErrorNoHandler, MessengerErrorNoQueue
+    MessengerErrorNoHandler, MessengerErrorNoQueue, MessengerErrorTimeout
 
 from tests import TEST_CATALOG, RABBIT_QUEUE, RABBIT_EXCHANGE
 
@@ -120,14 +123,135 @@ class TestAMQP(TestCase):
         p.terminate()
         p.join()
 
+    def test_amqp_workers(self):
+        def handler(message_body, message_type):
+            time.sleep(0.1)
+            return message_body
+
+        broker = AMQPReceiver()
+        broker.application_name = RABBIT_EXCHANGE
+        broker.set_queue(RABBIT_QUEUE, False, True)
+        broker.set_workers(4, 2)
+        broker.handler = handler
+
+        p = Process(target=broker.run)
+        p.start()
+
+        time.sleep(1)
+
+        messenger = AMQPMessenger()
+        messenger.application_name = RABBIT_EXCHANGE
+        messenger.add_queue(RABBIT_QUEUE, False, True)
+
+        for i in range(5):
+            self.assertEqual(messenger.send(self.avro_message), self.avro_encoded)
+        p.terminate()
+        p.join()
+
+    def test_amqp_prefetch(self):
+        def handler(message_body, message_type):
+            if message_body != self.avro_encoded:
+                raise ValueError(message_body)
+            return message_body
+
+        broker = AMQPReceiver()
+        broker.application_name = RABBIT_EXCHANGE
+        broker.set_queue(RABBIT_QUEUE, False, True)
+        broker.set_prefetch(10, 5, 0.1)
+        broker.set_workers(2)
+        broker.handler = handler
+
+        p = Process(target=broker.run)
+        p.start()
+
+        time.sleep(1)
+
+        messenger = AMQPMessenger()
+        messenger.application_name = RABBIT_EXCHANGE
+        messenger.add_queue(RABBIT_QUEUE, False, True)
+
+        for i in range(12):
+            self.assertEqual(messenger.send(self.avro_message), self.avro_encoded)
+        p.terminate()
+        p.join()
+
+    def test_amqp_send_async(self):
+        def handler(message_body, message_type):
+            time.sleep(0.5)
+            return message_body
+
+        broker = AMQPReceiver()
+        broker.application_name = RABBIT_EXCHANGE
+        broker.set_queue(RABBIT_QUEUE, False, True)
+        broker.set_workers(8)
+        broker.handler = handler
+
+        p = Process(target=broker.run)
+        p.start()
+
+        time.sleep(1)
+
+        messenger = AMQPMessenger()
+        messenger.application_name = RABBIT_EXCHANGE
+        messenger.add_queue(RABBIT_QUEUE, False, True)
+
+        messages = []
+        for i in range(8):
+            message = self.avro_factory.create('TEST')
+            message.id = i
+            message.name = "aaa"
+            messages.append(message)
+
+        # the requests are processed concurrently and every future gets the response to its request
+        start = time.time()
+        futures = [messenger.send_async(message) for message in messages]
+        self.assertEqual([future.result(5) for future in futures], [message.serialize() for message in messages])
+        self.assertLess(time.time() - start, 2)
+
+        self.assertRaises(MessengerErrorTimeout, messenger.send_async(messages[0], 0.1).result)
+        messenger.close()
+        p.terminate()
+        p.join()
+
+    def test_amqp_persistent_connection(self):
+        broker = AMQPReceiver()
+        broker.application_name = RABBIT_EXCHANGE
+        broker.set_queue(RABBIT_QUEUE, False, False)
+        broker.handler = lambda message_body, message_type: None
+
+        p = Process(target=broker.run)
+        p.start()
+
+        time.sleep(1)
+
+        messenger = AMQPMessenger()
+        messenger.application_name = RABBIT_EXCHANGE
+        messenger.add_queue(RABBIT_QUEUE, False, False)
+
+        for _ in range(3):
+            self.assertIsNone(messenger.send(self.avro_message))
+        # the connection is kept open and reused
+        self.assertEqual(messenger._pool.qsize(), 1)
+        self.assertEqual(len(messenger._spool), 0)
+
+        messenger.close()
+        self.assertEqual(messenger._pool.qsize(), 0)
+        p.terminate()
+        p.join()
+
     def test_amqp_producer_server_down(self):
         messenger = AMQPMessenger('localhost', 20000)  # non existent rabbit server
+        self.addCleanup(messenger.close)
         messenger.application_name = RABBIT_EXCHANGE
         messenger.add_queue(RABBIT_QUEUE, False, False)
 
         result = messenger.send(self.avro_message)
         self.assertIsNone(result)
-        self.assertEqual(messenger._message_queue.qsize(), 1)
+        self.assertEqual(len(messenger._spool), 1)
+
+        future = messenger.send_async(self.avro_message)
+        self.assertIsNotNone(future.exception(0))
+        self.assertEqual(len(messenger._spool), 2)
 
     def test_amqp_producer_non_existent_queue(self):
         self._reset()
@@ -141,7 +265,7 @@ class TestAMQP(TestCase):
         messenger.add_queue(RABBIT_QUEUE, False, False)
         result = messenger.send(self.avro_message)
         self.assertIsNone(result)
-        self.assertEqual(messenger._message_queue.qsize(), 1)
+        self.assertEqual(len(messenger._spool), 1)
 
     def test_amqp_receiver_errors(self):
         broker = AMQPReceiver()
@@ -164,3 +288,122 @@ class TestAMQP(TestCase):
             broker.application_name = RABBIT_EXCHANGE
         with self.assertRaises(MessengerErrorConnectionRefused) as e:
             broker.run()
+
+
+class _Channel(object):
+    def __init__(self):
+        self.calls = []
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.calls.append(("ack", delivery_tag, multiple))
+
+    def basic_nack(self, delivery_tag, multiple=False, requeue=True):
+        self.calls.append(("nack", delivery_tag, requeue))
+
+
+class TestAcknowledger(TestCase):
+    def test_batches(self):
+        channel = _Channel()
+        acknowledger = _Acknowledger(channel, 3, 60)
+        for delivery_tag in range(1, 8):
+            acknowledger.received(delivery_tag)
+
+        # the deliveries complete out of order: 1 is still running, so nothing is acknowledged
+        for delivery_tag in (2, 3, 4):
+            acknowledger.completed(delivery_tag, True)
+        self.assertEqual(channel.calls, [])
+
+        acknowledger.completed(5, False)
+        acknowledger.completed(1, True)
+        self.assertEqual(channel.calls, [("nack", 5, True), ("ack", 4, True)])
+
+        acknowledger.completed(7, True)
+        acknowledger.completed(6, True)
+        acknowledger.flush_if_due()
+        self.assertEqual(len(channel.calls), 2)
+        acknowledger.flush()
+        self.assertEqual(channel.calls[-1], ("ack", 7, True))
+
+    def test_interval(self):
+        channel = _Channel()
+        acknowledger = _Acknowledger(channel, 100, 0.05)
+        acknowledger.received(1)
+        acknowledger.completed(1, True)
+        acknowledger.flush_if_due()
+        self.assertEqual(channel.calls, [])
+        time.sleep(0.1)
+        acknowledger.flush_if_due()
+        self.assertEqual(channel.calls, [("ack", 1, True)])
+
+
+class _Broker(object):
+    # The connection and the channel of a queue: the messages are delivered while the prefetch window has room
+    def __init__(self, messages):
+        self.messages = deque(messages)
+        self.prefetch_count = None
+        self.no_ack = None
+        self.callback = None
+        self.unacked = []
+        self.max_unacked = 0
+        self.acked = []
+        self._delivery_tag = 0
+
+    def basic_qos(self, prefetch_count):
+        self.prefetch_count = prefetch_count
+
+    def basic_consume(self, callback, queue, no_ack):
+        self.callback, self.no_ack = callback, no_ack
+        return "consumer"
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        acked = [tag for tag in self.unacked if tag <= delivery_tag] if multiple else [delivery_tag]
+        self.unacked = [tag for tag in self.unacked if tag not in acked]
+        self.acked.extend(acked)
+
+    def basic_nack(self, delivery_tag, multiple=False, requeue=True):
+        self.unacked.remove(delivery_tag)
+
+    def process_data_events(self):
+        while self.messages and (self.no_ack or len(self.unacked) < self.prefetch_count):
+            self._delivery_tag += 1
+            if not self.no_ack:
+                self.unacked.append(self._delivery_tag)
+                self.max_unacked = max(self.max_unacked, len(self.unacked))
+            method = pika.spec.Basic.Deliver(delivery_tag=self._delivery_tag, routing_key=RABBIT_QUEUE + ".TEST")
+            self.callback(self, method, pika.BasicProperties(), self.messages.popleft())
+        time.sleep(0.01)
+
+    def close(self):
+        pass
+
+
+class TestWorkersPrefetch(TestCase):
+    def test_full_pool(self):
+        bodies = ["message {}".format(i) for i in range(20)]
+        handled = []
+
+        def handler(message_body, message_type):
+            time.sleep(0.02)
+            handled.append(message_body)
+
+        broker = _Broker(bodies)
+        receiver = AMQPReceiver()
+        receiver.set_queue(RABBIT_QUEUE, False, False)
+        receiver.set_workers(2, queue_size=4)
+        receiver.handler = handler
+        receiver._connection = receiver._channel = broker
+
+        thread = threading.Thread(target=receiver._start_consuming)
+        thread.start()
+        deadline = time.time() + 10
+        while len(handled) < len(bodies) and time.time() < deadline:
+            time.sleep(0.01)
+        receiver.stop()
+        thread.join(10)
+
+        # the messages are acknowledged manually and the broker never sends more than the pool holds
+        self.assertFalse(broker.no_ack)
+        self.assertEqual(broker.prefetch_count, 4)
+        self.assertLessEqual(broker.max_unacked, 4)
+        self.assertEqual(sorted(handled), sorted(bodies))
+        self.assertEqual(sorted(broker.acked), range(1, 21))
@@ -19,21 +19,27 @@
 # IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-from unittest import TestCase
+import threading
+from copy import deepcopy
+from functools import partial
+from unittest import TestCase, skipIf
 
-from clay.exceptions import SchemaException
+from clay.exceptions import SchemaException, MissingDependency
 from clay.factory import MessageFactory
-from clay.serializer.avro_serializer import AvroSerializer
-from clay.serializer.pyavroc_serializer import AvroSerializer as PyAvrocSerializer
+from clay.serializer.avro_serializer import AvroSerializer, AvroCache
+try:
+    from clay.serializer.pyavroc_serializer import AvroSerializer as PyAvrocSerializer, PyAvrocCache
+except MissingDependency:
+    PyAvrocSerializer = PyAvrocCache = None
 
-from tests import TEST_CATALOG
+from tests import TEST_CATALOG, TEST_SCHEMA, TEST_COMPLEX_SCHEMA
 
 
 class TestAvroSerializer(TestCase):
+    serializer = AvroSerializer
+
     def setUp(self):
-        self.avro_factory = MessageFactory(AvroSerializer, TEST_CATALOG)
-        self.pyavroc_factory = MessageFactory(PyAvrocSerializer, TEST_CATALOG)
-        self.factories = (self.avro_factory, self.pyavroc_factory)
+        self.factory = factory = MessageFactory(self.serializer, TEST_CATALOG)
 
         self.simple_msg_content = {"id": 1111111, "name": u"aaa"}
         self.complex_msg_content = {
@@ -53,58 +59,203 @@ class TestAvroSerializer(TestCase):
             ]
         }
 
-        self.avro_simple = self.avro_factory.create("TEST")
-        self.pyavroc_simple = self.pyavroc_factory.create("TEST")
-
-        self.avro_simple.set_content(self.simple_msg_content)
-        self.pyavroc_simple.set_content(self.simple_msg_content)
+        self.simple = factory.create("TEST")
+        self.simple.set_content(self.simple_msg_content)
         self.simple_encoded = "\x00\x10\x8e\xd1\x87\x01\x06aaa"
 
-        self.avro_complex = self.avro_factory.create("TEST_COMPLEX")
-        self.pyavroc_complex = self.pyavroc_factory.create("TEST_COMPLEX")
-
-        self.avro_complex.set_content(self.complex_msg_content)
-        self.pyavroc_complex.set_content(self.complex_msg_content)
+        self.complex = factory.create("TEST_COMPLEX")
+        self.complex.set_content(self.complex_msg_content)
         self.complex_encoded = '\x02l\x01\x8e\xd1\x87\x01\x80\x80\xa0\xf6\xf4\xac\xdb\xe0\x1b-\xb2\x9d?&\xa6' \
                                '\xac\xaa\x04\xb6y3\x06aaa\x00\x02\x06bbb\x00\x00\x02\x06ccc\x00\x00\x06ddd\x00\x06eee'
 
     def test_retrieve(self):
-        for factory in self.factories:
-            m = factory.retrieve(self.complex_encoded)
-
-            self.assertEqual(m.valid, True)
-            self.assertEqual(m.id, 1111111)
-            self.assertEqual(m.long_id, 10**18)
-            self.assertEqual(round(m.float_id, 3), 1.232)  # TODO: Avro seems to have wrong behavior with float
-            self.assertEqual(m.double_id, 1e-60)
-            self.assertEqual(m.name, "aaa")
-            self.assertEqual(len(m.array_complex_field), 1)
-            self.assertEqual(m.array_complex_field[0].field_1, "bbb")
-            self.assertEqual(len(m.array_simple_field), 1)
-            self.assertEqual(m.array_simple_field[0], "ccc")
-            self.assertEqual(m.record_field.field_1, "ddd")
-            self.assertEqual(m.record_field.field_2, "eee")
+        m = self.factory.retrieve(self.complex_encoded)
 
-    def test_avro_serializer(self):
-        for m in (self.avro_simple, self.pyavroc_simple):
-            value = m.serialize()
-            self.assertEqual(value, self.simple_encoded)
+        self.assertEqual(m.valid, True)
+        self.assertEqual(m.id, 1111111)
+        self.assertEqual(m.long_id, 10**18)
+        self.assertEqual(round(m.float_id, 3), 1.232)  # TODO: Avro seems to have wrong behavior with float
+        self.assertEqual(m.double_id, 1e-60)
+        self.assertEqual(m.name, "aaa")
+        self.assertEqual(len(m.array_complex_field), 1)
+        self.assertEqual(m.array_complex_field[0].field_1, "bbb")
+        self.assertEqual(len(m.array_simple_field), 1)
+        self.assertEqual(m.array_simple_field[0], "ccc")
+        self.assertEqual(m.record_field.field_1, "ddd")
+        self.assertEqual(m.record_field.field_2, "eee")
+
+    def test_lazy_retrieve(self):
+        m = self.factory.retrieve(self.complex_encoded, lazy=True)
+        # the fields are read out of order
+        self.assertEqual(m.name, "aaa")
+        self.assertEqual(m.record_field.field_2, "eee")
+        self.assertEqual(m.id, 1111111)
+        self.assertEqual(m.array_simple_field[0], "ccc")
+        self.assertEqual(m, self.factory.retrieve(self.complex_encoded))
+
+        m = self.factory.retrieve(self.complex_encoded, lazy=True)
+        m.record_field.field_1 = u"fff"
+        m.id = 2
+        content = dict(self.complex_msg_content, id=2, record_field={"field_1": u"fff", "field_2": u"eee"})
+        self.assertEqual(m.content["record_field"], content["record_field"])
+        self.assertEqual(m.content["array_complex_field"], content["array_complex_field"])
+        self.assertEqual(m.id, 2)
+
+        messages = self.factory.retrieve_many([self.simple_encoded, self.complex_encoded], lazy=True)
+        self.assertEqual(messages[0].content, self.simple_msg_content)
+        self.assertEqual(messages[1].serialize(), self.complex_encoded)
+
+    def test_projection(self):
+        m = self.factory.retrieve(self.complex_encoded, fields=("id", "record_field"))
+        self.assertEqual(m.id, 1111111)
+        self.assertEqual(m.record_field.field_2, "eee")
+        self.assertIsNone(m.name)
+        self.assertIsNone(m.array_simple_field.content)
+
+        m = self.factory.retrieve(self.complex_encoded, fields=["name"], predicate={"id": 1111111})
+        self.assertEqual(m.name, "aaa")
+        self.assertIsNone(m.id)
+        self.assertIsNone(self.factory.retrieve(self.complex_encoded, predicate={"id": 1}))
+        self.assertIsNone(self.factory.retrieve(self.complex_encoded, predicate={"id": lambda v: v < 100}))
 
-        for m in (self.avro_complex, self.pyavroc_complex):
-            value = m.serialize()
-            self.assertEqual(value, self.complex_encoded)
+        messages = self.factory.retrieve_many([self.simple_encoded, self.complex_encoded, self.complex_encoded],
+                                         fields=["id"], predicate={"name": u"aaa", "id": lambda v: v > 1000})
+        self.assertEqual([m.message_type for m in messages], ["TEST", "TEST_COMPLEX", "TEST_COMPLEX"])
+        self.assertEqual(messages[0].content, {"id": 1111111, "name": None})
+
+    def test_peek(self):
+        self.assertEqual(self.factory.peek(self.simple_encoded), (0, "TEST", 2))
+        self.assertEqual(self.factory.peek(self.complex_encoded), (1, "TEST_COMPLEX", 2))
+        self.assertRaises(SchemaException, self.factory.peek, "\x00\x10")
+
+    def test_avro_serializer(self):
+        self.assertEqual(self.simple.serialize(), self.simple_encoded)
+        self.assertEqual(self.complex.serialize(), self.complex_encoded)
 
     def test_wrong_schema(self):
-        for m in (self.avro_complex, self.pyavroc_complex):
-            # setting wrong type for the value (it should be int)
-            m.id = "111111"
-            self.assertRaises(SchemaException, m.serialize)
+        # setting wrong type for the value (it should be int)
+        self.complex.id = "111111"
+        self.assertRaises(SchemaException, self.complex.serialize)
 
     def test_utf8_encoding(self):
         target = "\x00\x10\x02\x0ctest\xc3\xa0"
-        for factory in self.factories:
-            for s in u"testà", "testà":
-                m = factory.create("TEST")
-                m.id = 1
-                m.name = s
-                self.assertEqual(m.serialize(), target)
+        for s in u"testà", "testà":
+            m = self.factory.create("TEST")
+            m.id = 1
+            m.name = s
+            self.assertEqual(m.serialize(), target)
+
+    def test_batch(self):
+        serializer = self.factory.serializer("TEST", self.factory.catalog)
+        contents = [self.simple_msg_content, {"id": 1, "name": u"testà"}]
+        encoded = serializer.serialize_many(contents)
+        self.assertEqual(encoded, [self.simple_encoded, "\x00\x10\x02\x0ctest\xc3\xa0"])
+
+        messages = self.factory.retrieve_many(encoded + [self.complex_encoded])
+        self.assertEqual(len(messages), 3)
+        self.assertEqual(messages[0].content, self.simple_msg_content)
+        self.assertEqual(messages[1].name, u"testà")
+        self.assertEqual(messages[2].record_field.field_1, "ddd")
+
+        messages = self.factory.create_many("TEST", contents)
+        self.assertEqual([m.serialize() for m in messages], encoded)
+
+
+    def test_compression(self):
+        catalog = dict(TEST_CATALOG, name="TEST_COMPRESSED", compression={"codec": "zlib", "threshold": 100})
+        content = dict(self.complex_msg_content, array_simple_field=["ccc"] * 100)
+        factory = MessageFactory(self.serializer, catalog)
+        plain_factory = MessageFactory(self.serializer, TEST_CATALOG)
+
+        encoded = factory.create("TEST_COMPLEX", content).serialize()
+        plain_encoded = plain_factory.create("TEST_COMPLEX", content).serialize()
+        self.assertLess(len(encoded), len(plain_encoded))
+        # the float is decoded with single precision
+        content = plain_factory.retrieve(plain_encoded).content
+        self.assertEqual(factory.retrieve(encoded).content, content)
+        self.assertEqual(plain_factory.retrieve(encoded).content, content)
+        self.assertEqual(factory.retrieve(encoded, lazy=True).name, "aaa")
+        self.assertEqual(factory.retrieve(encoded, fields=["name"]).content["name"], "aaa")
+        self.assertEqual(factory.peek(encoded), (1, "TEST_COMPLEX", None))
+        self.assertEqual([m.content for m in factory.retrieve_many([encoded, self.simple_encoded])],
+                         [content, self.simple_msg_content])
+
+        # the messages below the threshold are not compressed
+        self.assertEqual(factory.create("TEST", self.simple_msg_content).serialize(), self.simple_encoded)
+        self.assertEqual(factory.serializer("TEST_COMPLEX", catalog).serialize_many([content]), [encoded])
+
+
+@skipIf(PyAvrocSerializer is None, "pyavroc is not installed")
+class TestPyAvrocSerializer(TestAvroSerializer):
+    serializer = PyAvrocSerializer
+
+
+class TestSchemaCache(TestCase):
+    def setUp(self):
+        self.cache = AvroCache()
+        self.get = self.cache.get
+
+    def tearDown(self):
+        self.cache.max_size = self.cache.DEFAULT_MAX_SIZE
+        self.cache.clear()
+
+    def test_hits(self):
+        self.cache.clear()
+        obj = self.get(TEST_SCHEMA)
+        self.assertIs(self.get(TEST_SCHEMA), obj)
+        self.assertIs(self.get(deepcopy(TEST_SCHEMA)), obj)
+        self.assertEqual(self.cache.stats(), {"hits": 2, "misses": 1, "evictions": 0, "size": 1,
+                                         "max_size": self.cache.DEFAULT_MAX_SIZE})
+
+    def test_same_name(self):
+        # schemas with the same name from different catalogs don't share the cached objects
+        other_schema = deepcopy(TEST_SCHEMA)
+        other_schema["fields"].append({"name": "other", "type": "int"})
+        self.cache.clear()
+        self.assertIsNot(self.get(TEST_SCHEMA), self.get(other_schema))
+        self.assertEqual(self.cache.stats()["misses"], 2)
+
+    def test_eviction(self):
+        other_schema = deepcopy(TEST_SCHEMA)
+        other_schema["name"] = "OTHER"
+        self.cache.clear()
+        self.cache.max_size = 2
+        self.get(TEST_SCHEMA)
+        self.get(TEST_COMPLEX_SCHEMA)
+        self.get(TEST_SCHEMA)
+        self.get(other_schema)
+        # TEST_COMPLEX is the least recently used
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+        self.get(TEST_SCHEMA)
+        self.get(TEST_COMPLEX_SCHEMA)
+        self.assertEqual(self.cache.stats(), {"hits": 2, "misses": 4, "evictions": 2, "size": 2, "max_size": 2})
+
+        self.cache.max_size = 1
+        self.assertEqual(self.cache.stats()["size"], 1)
+        self.assertRaises(ValueError, setattr, self.cache, "max_size", 0)
+        self.cache.max_size = self.cache.DEFAULT_MAX_SIZE
+
+    def test_threads(self):
+        self.cache.clear()
+        results = []
+
+        def lookup():
+            results.extend(self.get(TEST_SCHEMA) for i in range(100))
+
+        threads = [threading.Thread(target=lookup) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(set(map(id, results))), 1)
+        stats = self.cache.stats()
+        self.assertEqual(stats["hits"] + stats["misses"], 800)
+        self.assertEqual(stats["size"], 1)
+
+
+@skipIf(PyAvrocCache is None, "pyavroc is not installed")
+class TestPyAvrocSchemaCache(TestSchemaCache):
+    def setUp(self):
+        self.cache = PyAvrocCache()
+        self.get = partial(self.cache.get, PyAvrocCache.DESER)
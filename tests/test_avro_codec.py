@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2015, CRS4
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from cStringIO import StringIO
+from unittest import TestCase
+
+import avro.schema
+from avro.io import DatumWriter, DatumReader, BinaryEncoder, BinaryDecoder
+
+from clay.exceptions import SchemaException
+from clay.serializer.avro_codec import AvroCodec
+
+SCHEMA = {
+    "type": "record",
+    "name": "ALL",
+    "namespace": "TEST",
+    "fields": [
+        {"name": "null", "type": "null"},
+        {"name": "boolean", "type": "boolean"},
+        {"name": "int", "type": "int"},
+        {"name": "long", "type": "long"},
+        {"name": "float", "type": "float"},
+        {"name": "double", "type": "double"},
+        {"name": "bytes", "type": "bytes"},
+        {"name": "string", "type": "string"},
+        {"name": "enum", "type": {"type": "enum", "name": "ENUM", "symbols": ["A", "B", "C"]}},
+        {"name": "fixed", "type": {"type": "fixed", "name": "FIXED", "size": 3}},
+        {"name": "array", "type": {"type": "array", "items": {"type": "array", "items": "long"}}},
+        {"name": "map", "type": {"type": "map", "values": ["null", "ENUM", "string"]}},
+        {"name": "union", "type": ["int", "long", "string", "null", "FIXED"]},
+        {"name": "record", "type": {"type": "record", "name": "NODE", "fields": [
+            {"name": "value", "type": "int"},
+            {"name": "next", "type": ["null", "NODE"]}
+        ]}},
+        {"name": "optional", "type": ["null", "TEST.NODE"]}
+    ]
+}
+
+
+def _datum(**values):
+    datum = {
+        "null": None,
+        "boolean": True,
+        "int": -2 ** 31,
+        "long": 2 ** 63 - 1,
+        "float": 0.5,
+        "double": 1e300,
+        "bytes": "\x00\xff" * 100,
+        "string": u"\xe0\xe8\xec" * 50,
+        "enum": "B",
+        "fixed": "xyz",
+        "array": [range(-100, 100, 3), [], [1]],
+        "map": {"k1": None, "k2": "A", u"k\xe0": u"str"},
+        "union": 2 ** 40,
+        "record": {"value": 1, "next": {"value": 2, "next": None}},
+        "optional": None
+    }
+    datum.update(values)
+    return datum
+
+
+class TestAvroCodec(TestCase):
+    def setUp(self):
+        self.codec = AvroCodec(SCHEMA)
+        self.schema = avro.schema.make_avsc_object(SCHEMA)
+
+    def _avro_encode(self, datum):
+        encoder = BinaryEncoder(StringIO())
+        DatumWriter(self.schema).write(datum, encoder)
+        return encoder.writer.getvalue()
+
+    def _avro_decode(self, data):
+        return DatumReader(self.schema).read(BinaryDecoder(StringIO(data)))
+
+    def test_compatibility(self):
+        for values in ({}, {"union": u"s", "optional": {"value": 5, "next": None}}, {"union": None, "array": []},
+                       {"union": "abc", "string": u"", "boolean": False, "map": {}}):
+            datum = _datum(**values)
+            encoded = self.codec.encode(datum)
+            self.assertEqual(encoded, self._avro_encode(datum))
+            self.assertEqual(self.codec.decode(encoded), self._avro_decode(encoded))
+            self.assertEqual(self.codec.decode(buffer("xx" + encoded), 2), self._avro_decode(encoded))
+
+    def test_fields(self):
+        encoded = self.codec.encode(_datum())
+        decoded = self.codec.decode(encoded)
+        pos = 0
+        for index, (name, read, skip) in enumerate(self.codec.fields):
+            value, end = self.codec.read_field(index, encoded, pos)
+            self.assertEqual(self.codec.skip_field(index, encoded, pos), end)
+            self.assertEqual(value, decoded[name])
+            pos = end
+        self.assertEqual(pos, len(encoded))
+
+    def test_invalid_datum(self):
+        for name, value in (("int", 2 ** 31), ("int", "1"), ("boolean", 1), ("string", 1), ("enum", "Z"),
+                            ("fixed", "ab"), ("array", None), ("union", 1.5), ("bytes", u"x")):
+            self.assertRaises(SchemaException, self.codec.encode, _datum(**{name: value}))
+        datum = _datum()
+        del datum["int"]
+        self.assertRaises(SchemaException, self.codec.encode, datum)
+
+    def test_truncated_data(self):
+        encoded = self.codec.encode(_datum())
+        for cut in (1, 5, 20):
+            self.assertRaises(SchemaException, self.codec.decode, encoded[:-cut])
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2015, CRS4
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import pickle
+from unittest import TestCase
+
+from clay import add_catalog, as_catalog, schema_from_name
+from clay.catalog import Catalog, schema_fingerprint
+from clay.exceptions import SchemaException
+from clay.factory import MessageFactory
+from clay.serializer import JSONSerializer
+
+from tests import TEST_CATALOG, TEST_SCHEMA, TEST_COMPLEX_SCHEMA
+
+
+class TestCatalog(TestCase):
+    def setUp(self):
+        self.catalog = Catalog(TEST_CATALOG)
+
+    def test_lookup(self):
+        self.assertEqual(self.catalog.name, "TEST_CATALOG")
+        self.assertEqual(self.catalog[0], TEST_SCHEMA)
+        self.assertEqual(self.catalog.schema_from_name("TEST_COMPLEX"), (1, TEST_COMPLEX_SCHEMA))
+        self.assertEqual(self.catalog.schema_from_id(0), TEST_SCHEMA)
+        self.assertRaises(SchemaException, self.catalog.schema_from_name, "UNK")
+        self.assertRaises(SchemaException, self.catalog.schema_from_id, 100)
+
+    def test_fingerprint(self):
+        fingerprint = self.catalog.fingerprint(0)
+        self.assertEqual(fingerprint, schema_fingerprint(dict(TEST_SCHEMA)))
+        self.assertNotEqual(fingerprint, self.catalog.fingerprint(1))
+        self.assertEqual(self.catalog.schema_from_fingerprint(fingerprint), (0, TEST_SCHEMA))
+        self.assertRaises(SchemaException, self.catalog.schema_from_fingerprint, "unknown")
+
+    def test_immutable(self):
+        self.assertRaises(TypeError, self.catalog.__setitem__, 10, TEST_SCHEMA)
+        self.assertRaises(TypeError, self.catalog.__delitem__, 0)
+        self.assertRaises(TypeError, self.catalog.update, {10: TEST_SCHEMA})
+
+    def test_copy(self):
+        # the catalog keeps a copy of the schemas
+        self.assertIsNot(self.catalog[0], TEST_SCHEMA)
+        self.assertEqual(self.catalog.fingerprint(0), schema_fingerprint(TEST_SCHEMA))
+
+    def test_pickle(self):
+        catalog = pickle.loads(pickle.dumps(self.catalog, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(catalog, self.catalog)
+        self.assertEqual(catalog.schema_from_name("TEST"), (0, TEST_SCHEMA))
+
+    def test_as_catalog(self):
+        catalog = as_catalog(TEST_CATALOG)
+        self.assertIsInstance(catalog, Catalog)
+        self.assertIs(as_catalog(catalog), catalog)
+        registered = add_catalog(TEST_CATALOG)
+        self.assertIs(as_catalog(TEST_CATALOG), registered)
+        self.assertEqual(schema_from_name("TEST", TEST_CATALOG), (0, TEST_SCHEMA))
+
+        factory = MessageFactory(JSONSerializer, TEST_CATALOG)
+        self.assertIsInstance(factory.catalog, Catalog)
+
+    def test_as_catalog_changed(self):
+        source = dict(TEST_CATALOG, name="TEST_CHANGED_CATALOG")
+        registered = add_catalog(source)
+        source[4] = dict(TEST_SCHEMA, name="TEST_ADDED")
+        catalog = as_catalog(source)
+        self.assertIsNot(catalog, registered)
+        self.assertEqual(catalog.schema_from_name("TEST_ADDED"), (4, source[4]))
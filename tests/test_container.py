@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2015, CRS4
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import shutil
+import tempfile
+from cStringIO import StringIO
+from unittest import TestCase
+
+import avro.schema
+from avro.datafile import DataFileReader, DataFileWriter
+from avro.io import DatumReader, DatumWriter
+
+from clay.exceptions import SchemaException
+from clay.factory import MessageFactory
+from clay.serializer.avro_serializer import AvroSerializer
+from clay.serializer.container import ContainerWriter, ContainerReader
+
+from tests import TEST_CATALOG, TEST_COMPLEX_SCHEMA
+
+
+class TestContainer(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "archive.avro")
+        self.data = [{
+            "valid": i % 2 == 0,
+            "id": i,
+            "long_id": 10 ** 18 + i,
+            "float_id": 0.5,
+            "double_id": 1e-60,
+            "name": u"name %d" % i,
+            "record_field": {"field_1": u"ddd", "field_2": u"eee"},
+            "array_simple_field": [u"ccc"] * (i % 5),
+            "array_complex_field": [{"field_1": u"bbb"}]
+        } for i in range(500)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write(self, codec="null", block_size=1000):
+        with ContainerWriter(open(self.path, "wb"), TEST_COMPLEX_SCHEMA, codec, block_size) as writer:
+            for datum in self.data:
+                writer.append(datum)
+
+    def test_round_trip(self):
+        for codec in ("null", "deflate"):
+            self._write(codec)
+            reader = ContainerReader(open(self.path, "rb"))
+            self.assertEqual(reader.codec, codec)
+            self.assertEqual(reader.schema, TEST_COMPLEX_SCHEMA)
+            self.assertEqual(list(reader), self.data)
+            # the messages are written in more blocks
+            reader = ContainerReader(open(self.path, "rb"))
+            self.assertGreater(len(list(reader.blocks())), 10)
+
+    def test_avro_compatibility(self):
+        schema = avro.schema.make_avsc_object(TEST_COMPLEX_SCHEMA)
+        for codec in ("null", "deflate"):
+            self._write(codec)
+            self.assertEqual(list(DataFileReader(open(self.path, "rb"), DatumReader())), self.data)
+
+            writer = DataFileWriter(open(self.path, "wb"), DatumWriter(), schema, codec)
+            for datum in self.data:
+                writer.append(datum)
+            writer.close()
+            self.assertEqual(list(ContainerReader(open(self.path, "rb"))), self.data)
+
+    def test_split(self):
+        self._write("deflate")
+        size = os.path.getsize(self.path)
+        for splits in (1, 3, 7, 100):
+            bounds = [size * i // splits for i in range(splits + 1)]
+            data = []
+            for start, end in zip(bounds, bounds[1:]):
+                data.extend(ContainerReader(open(self.path, "rb")).read_split(start, end))
+            self.assertEqual(data, self.data)
+
+    def test_invalid_file(self):
+        self.assertRaises(SchemaException, ContainerReader, StringIO("not a container"))
+        self.assertRaises(SchemaException, ContainerWriter, StringIO(), TEST_COMPLEX_SCHEMA, "snappy")
+        self.assertRaises(SchemaException, ContainerWriter(StringIO(), TEST_COMPLEX_SCHEMA).append, {"id": 1})
+
+        self._write()
+        with open(self.path, "rb") as f:
+            data = f.read()
+        self.assertRaises(SchemaException, list, ContainerReader(StringIO(data[:-20])))
+        self.assertRaises(SchemaException, list, ContainerReader(StringIO(data[:-1] + "x")))
+
+    def test_factory(self):
+        factory = MessageFactory(AvroSerializer, TEST_CATALOG)
+        with factory.archive(open(self.path, "wb"), "TEST_COMPLEX", "deflate", 1000) as writer:
+            for datum in self.data:
+                writer.append(factory.create("TEST_COMPLEX", datum).content)
+
+        messages = list(factory.replay(open(self.path, "rb")))
+        self.assertEqual([m.content for m in messages], self.data)
+        self.assertEqual(messages[0].message_type, "TEST_COMPLEX")
+
+        size = os.path.getsize(self.path)
+        messages = list(factory.replay(open(self.path, "rb"), 0, size // 2)) + \
+            list(factory.replay(open(self.path, "rb"), size // 2))
+        self.assertEqual([m.content for m in messages], self.data)
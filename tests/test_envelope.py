@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2015, CRS4
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from cStringIO import StringIO
+from unittest import TestCase
+
+import avro.schema
+from avro.io import DatumWriter, BinaryEncoder
+
+from clay.exceptions import SchemaException
+from clay.serializer.compression import Compression
+from clay.serializer.envelope import ENVELOPE_SCHEMA, encode_long, decode_long, write_envelope, read_envelope, \
+    peek_envelope, write_compressed_envelope
+
+
+class TestEnvelope(TestCase):
+    def setUp(self):
+        self.writer = DatumWriter(avro.schema.make_avsc_object(ENVELOPE_SCHEMA))
+
+    def _avro_envelope(self, schema_id, payload):
+        encoder = BinaryEncoder(StringIO())
+        self.writer.write({"id": schema_id, "payload": payload}, encoder)
+        return encoder.writer.getvalue()
+
+    def test_long(self):
+        for value in (0, 1, -1, 63, -64, 64, 2 ** 31 - 1, -2 ** 31, 2 ** 62):
+            encoded = encode_long(value)
+            self.assertEqual(decode_long(encoded), (value, len(encoded)))
+            self.assertEqual(decode_long("xx" + encoded, 2), (value, len(encoded) + 2))
+
+    def test_wire_compatibility(self):
+        for schema_id in (0, 1, 100, 2 ** 20):
+            for payload in ("", "aaa", "x" * 200):
+                envelope = write_envelope(encode_long(schema_id), payload)
+                self.assertEqual(envelope, self._avro_envelope(schema_id, payload))
+                payload_id, payload_view = read_envelope(envelope)
+                self.assertEqual(payload_id, schema_id)
+                self.assertEqual(str(payload_view), payload)
+
+    def test_truncated(self):
+        envelope = write_envelope(encode_long(1), "aaa")
+        self.assertRaises(SchemaException, read_envelope, envelope[:-1])
+        self.assertRaises(SchemaException, read_envelope, "\x80")
+        self.assertRaises(SchemaException, peek_envelope, envelope[:-1])
+
+    def test_peek(self):
+        envelope = write_envelope(encode_long(1000), "x" * 200)
+        self.assertEqual(peek_envelope(envelope), (1000, 4, 200))
+
+    def test_compressed(self):
+        compression = Compression("zlib", 100)
+        payload = "x" * 200
+        envelope = write_compressed_envelope(1000, payload, compression)
+        self.assertLess(len(envelope), len(payload))
+        self.assertEqual(read_envelope(envelope), (1000, payload))
+        self.assertEqual(peek_envelope(envelope), (1000, None, None))
+        self.assertRaises(SchemaException, read_envelope, envelope[:-1])
+
+        # the payloads below the threshold and the ones that the compression doesn't reduce are not compressed
+        self.assertEqual(write_compressed_envelope(1000, "x" * 50, compression),
+                         write_envelope(encode_long(1000), "x" * 50))
+        payload = "".join(chr(i) for i in range(256))
+        self.assertEqual(write_compressed_envelope(1000, payload, compression),
+                         write_envelope(encode_long(1000), payload))
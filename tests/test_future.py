@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2015, CRS4
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import threading
+import time
+from unittest import TestCase
+
+from clay.exceptions import MessengerError, MessengerErrorTimeout
+from clay.messenger import Future
+
+
+class TestFuture(TestCase):
+    def test_result(self):
+        future = Future()
+        self.assertFalse(future.done())
+        threading.Timer(0.05, future.set_result, ("OK",)).start()
+        self.assertEqual(future.result(10), "OK")
+        self.assertTrue(future.done())
+        self.assertIsNone(future.exception())
+        self.assertFalse(future.set_result("KO"))
+        self.assertEqual(future.result(), "OK")
+
+    def test_exception(self):
+        future = Future()
+        self.assertTrue(future.set_exception(MessengerError()))
+        self.assertRaises(MessengerError, future.result)
+        self.assertIsInstance(future.exception(), MessengerError)
+
+    def test_timeout(self):
+        future = Future()
+        start = time.time()
+        self.assertRaises(MessengerErrorTimeout, future.result, 0.05)
+        self.assertGreaterEqual(time.time() - start, 0.05)
+        self.assertRaises(MessengerErrorTimeout, future.exception, 0)
+
+    def test_callbacks(self):
+        future = Future()
+        results = []
+        future.add_done_callback(lambda f: results.append(f.result()))
+        future.set_result("OK")
+        future.add_done_callback(lambda f: results.append(f.result()))
+        self.assertEqual(results, ["OK", "OK"])
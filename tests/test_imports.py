@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2015, CRS4
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import json
+import os
+import subprocess
+import sys
+from unittest import TestCase
+
+# Maximum time in seconds allowed to import the clay packages
+IMPORT_TIME_BUDGET = 0.1
+
+OPTIONAL_DEPENDENCIES = ("avro", "pyavroc", "simplejson", "hl7apy", "pika", "paho", "kafka")
+
+_IMPORT_SCRIPT = """
+import json, sys, time
+start = time.time()
+import clay.factory, clay.serializer, clay.messenger
+elapsed = time.time() - start
+print(json.dumps({"elapsed": elapsed, "modules": sorted(sys.modules)}))
+"""
+
+
+class TestImports(TestCase):
+    def _import_clay(self):
+        # the packages are imported in a new interpreter, so that the modules already imported by the other tests
+        # don't affect the result
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.check_output([sys.executable, "-c", _IMPORT_SCRIPT], cwd=root)
+        return json.loads(output)
+
+    def test_no_optional_dependencies(self):
+        modules = self._import_clay()["modules"]
+        loaded = [m for m in modules if m.split(".")[0] in OPTIONAL_DEPENDENCIES]
+        self.assertEqual(loaded, [])
+
+    def test_import_time_budget(self):
+        elapsed = min(self._import_clay()["elapsed"] for _ in range(3))
+        self.assertLess(elapsed, IMPORT_TIME_BUDGET)
+
+    def test_lazy_attributes(self):
+        import clay.messenger
+        import clay.serializer
+        from clay.serializer import JSONSerializer
+        from clay.serializer.json_serializer import JSONSerializer as _JSONSerializer
+
+        self.assertIs(JSONSerializer, _JSONSerializer)
+        self.assertIn("AvroSerializer", dir(clay.serializer))
+        self.assertIn("AMQPMessenger", dir(clay.messenger))
+        with self.assertRaises(AttributeError):
+            clay.messenger.UnknownMessenger
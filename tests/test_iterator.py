@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2015, CRS4
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import threading
+import time
+from unittest import TestCase
+
+from clay.exceptions import MessengerErrorConnectionRefused
+from clay.messenger import MessageIterator
+from clay.messenger.workers import WorkerPool
+
+
+class _Receiver(object):
+    # A receiver that calls the handler with the given messages, then waits to be stopped
+    def __init__(self, messages, error=None):
+        self.handler = None
+        self.messages = messages
+        self.error = error
+        self.handled = 0
+        self._running = False
+
+    def run(self):
+        self._running = True
+        for body, message_type in self.messages:
+            self.handler(body, message_type)
+            self.handled += 1
+        if self.error is not None:
+            raise self.error
+        while self._running:
+            time.sleep(0.01)
+
+    def stop(self):
+        self._running = False
+
+
+class _PooledReceiver(_Receiver):
+    # A receiver that runs the handler in a worker pool and, while the pool is full, stops reading but keeps running
+    def __init__(self, messages):
+        super(_PooledReceiver, self).__init__(messages)
+        self.workers = None
+        self.loops = 0
+
+    def set_workers(self, workers=4, queue_size=64, processes=False):
+        self.workers = {'workers': workers, 'queue_size': queue_size, 'processes': processes}
+
+    def run(self):
+        pool = WorkerPool(self.handler, **self.workers)
+        pool.start()
+        messages = list(self.messages)
+        self._running = True
+        try:
+            while self._running:
+                self.loops += 1
+                if messages and not pool.full:
+                    pool.submit(*messages.pop(0))
+                    self.handled += 1
+                else:
+                    time.sleep(0.01)
+        finally:
+            pool.stop()
+
+
+class TestMessageIterator(TestCase):
+    def test_iteration(self):
+        messages = [("body {}".format(i), "TEST") for i in range(10)]
+        iterator = MessageIterator(_Receiver(messages))
+        received = []
+        for message in iterator:
+            received.append(message)
+            if len(received) == len(messages):
+                iterator.stop()
+        self.assertEqual(received, messages)
+        # the iteration stays ended
+        self.assertEqual(list(iterator), [])
+
+    def test_bounded_queue(self):
+        receiver = _Receiver([("body", "TEST")] * 10)
+        iterator = MessageIterator(receiver, queue_size=3)
+        iterator.start()
+        time.sleep(0.1)
+        # the receiver waits for the iteration to take the messages
+        self.assertEqual(receiver.handled, 3)
+        self.assertEqual(next(iterator), ("body", "TEST"))
+        time.sleep(0.1)
+        self.assertEqual(receiver.handled, 4)
+
+        iterator.stop(10)
+        # the messages already received are still yielded
+        self.assertEqual(len(list(iterator)), 3)
+
+    def test_workers(self):
+        messages = [("body {}".format(i), "TEST") for i in range(10)]
+        receiver = _PooledReceiver(messages)
+        iterator = MessageIterator(receiver, queue_size=3)
+        iterator.start()
+        time.sleep(0.1)
+        # the worker waits for the iteration, the receiver stops reading when the pool is full but keeps running
+        self.assertEqual(receiver.workers['workers'], 1)
+        self.assertEqual(receiver.handled, 6)
+        loops = receiver.loops
+        time.sleep(0.1)
+        self.assertGreater(receiver.loops, loops)
+
+        self.assertEqual([next(iterator) for _ in range(10)], messages)
+        iterator.stop(10)
+
+    def test_stop_from_thread(self):
+        iterator = MessageIterator(_Receiver([]))
+        threading.Timer(0.05, iterator.stop).start()
+        self.assertEqual(list(iterator), [])
+
+    def test_receiver_error(self):
+        receiver = _Receiver([("body", "TEST")], MessengerErrorConnectionRefused())
+        with MessageIterator(receiver) as iterator:
+            self.assertEqual(next(iterator), ("body", "TEST"))
+            self.assertRaises(MessengerErrorConnectionRefused, next, iterator)
+            self.assertRaises(StopIteration, next, iterator)
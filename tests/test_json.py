@@ -21,6 +21,7 @@
 
 from unittest import TestCase
 
+from clay.exceptions import SchemaException
 from clay.factory import MessageFactory
 from clay.serializer import JSONSerializer
 
@@ -74,9 +75,71 @@ class TestJSON(TestCase):
         self.assertEqual(m.record_field.field_1, "ddd")
         self.assertEqual(m.record_field.field_2, "eee")
 
+    def test_lazy_retrieve(self):
+        m = self.factory.retrieve(self.complex_encoded, lazy=True)
+        self.assertEqual(m.record_field.field_2, "eee")
+        self.assertEqual(m.id, 1111111)
+        self.assertEqual(m, self.factory.retrieve(self.complex_encoded))
+
+        m = self.factory.retrieve(self.complex_encoded, lazy=True)
+        m.name = "bbb"
+        self.assertEqual(m.content, dict(self.complex_message.content, name="bbb"))
+
+    def test_projection(self):
+        m = self.factory.retrieve(self.complex_encoded, fields=["id"], predicate={"name": "aaa"})
+        self.assertEqual(m.id, 1111111)
+        self.assertIsNone(m.name)
+        self.assertIsNone(self.factory.retrieve(self.complex_encoded, predicate={"name": "bbb"}))
+        messages = self.factory.retrieve_many([self.simple_encoded, self.complex_encoded],
+                                              predicate={"name": "aaa", "valid": True})
+        self.assertEqual([m.message_type for m in messages], ["TEST_COMPLEX"])
+
+    def test_peek(self):
+        schema_id, message_type, offset = self.factory.peek(self.complex_encoded)
+        self.assertEqual((schema_id, message_type), (1, "TEST_COMPLEX"))
+        self.assertTrue(self.complex_encoded[offset:].startswith('{"record_field"'))
+        # the id is read also when it follows the payload
+        self.assertEqual(self.factory.peek('{"payload": {"id": 1, "name": "aaa"}, "id": 0}'), (0, "TEST", None))
+
     def test_serializer(self):
         value = self.simple_message.serialize()
         self.assertEqual(value, self.simple_encoded)
 
         value = self.complex_message.serialize()
         self.assertEqual(value, self.complex_encoded)
+
+    def test_batch(self):
+        serializer = JSONSerializer("TEST", self.factory.catalog)
+        contents = [self.simple_message.content, {"id": 2, "name": "bbb"}]
+        encoded = serializer.serialize_many(contents)
+        self.assertEqual(encoded, [serializer.serialize(c) for c in contents])
+
+        messages = self.factory.retrieve_many(encoded + [self.complex_encoded])
+        self.assertEqual([m.content for m in messages[:2]], contents)
+        self.assertEqual(messages[2], self.factory.retrieve(self.complex_encoded))
+
+        messages = self.factory.create_many("TEST", contents)
+        self.assertEqual([m.serialize() for m in messages], encoded)
+
+    def test_compression(self):
+        catalog = dict(TEST_CATALOG, name="TEST_COMPRESSED", compression={"codec": "zlib", "threshold": 100})
+        factory = MessageFactory(JSONSerializer, catalog)
+        content = self.complex_message.content
+        content["array_simple_field"] = ["ccc"] * 100
+
+        encoded = factory.create("TEST_COMPLEX", content).serialize()
+        self.assertIn('"compression": "zlib"', encoded)
+        self.assertLess(len(encoded), len(self.factory.create("TEST_COMPLEX", content).serialize()))
+        self.assertEqual(factory.retrieve(encoded).content, content)
+        self.assertEqual(factory.peek(encoded), (1, "TEST_COMPLEX", None))
+        self.assertEqual([m.content for m in factory.retrieve_many([encoded])], [content])
+
+        # the messages below the threshold are not compressed, and the ones without compression are still read
+        encoded = factory.create("TEST", {"id": 1111111, "name": u"aaa"}).serialize()
+        self.assertEqual(encoded, self.simple_encoded)
+        self.assertEqual(factory.retrieve(self.complex_encoded).content, self.complex_message.content)
+        self.assertEqual(self.factory.retrieve(factory.serializer("TEST_COMPLEX", catalog).serialize(content)).content,
+                         content)
+
+        catalog = dict(TEST_CATALOG, name="TEST_UNKNOWN_CODEC", compression={"codec": "unknown"})
+        self.assertRaises(SchemaException, MessageFactory(JSONSerializer, catalog).create, "TEST")
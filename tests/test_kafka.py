@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2015, CRS4
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import re
+from collections import namedtuple
+from unittest import TestCase
+
+import mock
+from kafka.errors import KafkaTimeoutError, NoBrokersAvailable
+from kafka.future import Future as KafkaFuture
+from kafka.structs import OffsetAndMetadata, TopicPartition
+
+from clay.exceptions import MessengerErrorConnectionRefused, MessengerErrorNoApplicationName, \
+    MessengerErrorNoHandler, MessengerErrorNoQueue
+from clay.factory import MessageFactory
+from clay.messenger import KafkaError, KafkaMessenger, KafkaReceiver
+from clay.serializer import AvroSerializer
+
+from tests import TEST_CATALOG, RABBIT_QUEUE, RABBIT_EXCHANGE
+
+_Record = namedtuple('_Record', ('topic', 'offset', 'value'))
+
+
+class TestKafkaMessenger(TestCase):
+    def setUp(self):
+        patcher = mock.patch('clay.messenger.kafka_messenger.KafkaProducer')
+        self.producer_class = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.producer = self.producer_class.return_value
+        self.futures = []
+
+        def send(topic, value):
+            future = KafkaFuture()
+            self.futures.append(future)
+            return future
+
+        self.producer.send.side_effect = send
+
+        self.message = MessageFactory(AvroSerializer, TEST_CATALOG).create('TEST')
+        self.message.id = 1111111
+        self.message.name = "aaa"
+        self.topic = "{}-TEST".format(RABBIT_QUEUE)
+
+        self.messenger = KafkaMessenger(batch_size=1024, linger_ms=10)
+        self.messenger.add_queue(RABBIT_QUEUE, False, False)
+
+    def tearDown(self):
+        self.messenger.close()
+
+    def test_persistent_producer(self):
+        results = [self.messenger.send(self.message) for _ in range(3)]
+        self.assertEqual(results, self.futures)
+        # one producer is created on the first send and reused
+        self.producer_class.assert_called_once_with(bootstrap_servers="localhost:9092", batch_size=1024,
+                                                    linger_ms=10)
+        self.assertEqual(self.producer.send.call_args_list,
+                         [mock.call(self.topic, self.message.serialize())] * 3)
+
+    def test_callback(self):
+        callback = mock.Mock()
+        future = self.messenger.send(self.message, callback)
+        future.success("metadata")
+        callback.assert_called_once_with("metadata")
+        self.assertEqual(len(self.messenger._spool), 0)
+
+    def test_failed_delivery(self):
+        future = self.messenger.send(self.message)
+        future.failure(KafkaTimeoutError())
+        # the message is stored to be sent again
+        self.assertEqual(self.messenger._spool.peek(), (RABBIT_QUEUE, 'TEST', self.message.serialize()))
+
+    def test_producer_error(self):
+        self.producer.send.side_effect = KafkaTimeoutError()
+        self.assertIsNone(self.messenger.send(self.message))
+        self.assertEqual(self.messenger._spool.peek(), (RABBIT_QUEUE, 'TEST', self.message.serialize()))
+
+    def test_send_async(self):
+        future = self.messenger.send_async(self.message)
+        self.futures[0].success("metadata")
+        self.assertEqual(future.result(0), "metadata")
+
+        future = self.messenger.send_async(self.message)
+        self.futures[1].failure(KafkaTimeoutError())
+        self.assertIsInstance(future.exception(0), KafkaTimeoutError)
+
+    def test_flush_close(self):
+        # without a producer there is nothing to flush
+        self.messenger.flush(1)
+        self.assertFalse(self.producer.flush.called)
+
+        self.messenger.send(self.message)
+        self.messenger.flush(1)
+        self.producer.flush.assert_called_once_with(1)
+
+        self.messenger.close(2)
+        self.producer.close.assert_called_once_with(2)
+        self.assertIsNone(self.messenger._producer)
+
+    def test_no_queue(self):
+        messenger = KafkaMessenger()
+        self.assertRaises(KafkaError, messenger.send, self.message)
+
+
+class TestKafkaReceiver(TestCase):
+    def setUp(self):
+        patcher = mock.patch('clay.messenger.kafka_messenger.KafkaConsumer')
+        self.consumer_class = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.consumer = self.consumer_class.return_value
+
+        self.topic = "{}-TEST".format(RABBIT_QUEUE)
+        self.partitions = [TopicPartition(self.topic, 0), TopicPartition(self.topic, 1)]
+        self.handled = []
+
+    def _receiver(self, batches, **kwargs):
+        receiver = KafkaReceiver(**kwargs)
+        receiver.application_name = RABBIT_EXCHANGE
+        receiver.set_queue(RABBIT_QUEUE, False, False)
+        receiver.handler = self._handler
+
+        batches = list(batches)
+
+        def poll(timeout_ms, max_records):
+            if not batches:
+                receiver.stop()
+                return {}
+            return batches.pop(0)
+
+        self.consumer.poll.side_effect = poll
+        return receiver
+
+    def _handler(self, message_body, message_type):
+        if message_body == "error":
+            raise ValueError(message_body)
+        self.handled.append((message_body, message_type))
+
+    def _records(self, offsets, values=None):
+        values = values or ["message {}".format(offset) for offset in offsets]
+        return [_Record(self.topic, offset, value) for offset, value in zip(offsets, values)]
+
+    def test_commit_on_stop(self):
+        receiver = self._receiver([{self.partitions[0]: self._records([10, 11]),
+                                    self.partitions[1]: self._records([5])}])
+        receiver.run()
+
+        self.assertEqual(sorted(self.handled), [("message 10", "TEST"), ("message 11", "TEST"), ("message 5", "TEST")])
+        self.assertEqual(self.consumer_class.call_args[1]['group_id'], RABBIT_EXCHANGE)
+        self.consumer.commit.assert_called_once_with({self.partitions[0]: OffsetAndMetadata(12, ''),
+                                                      self.partitions[1]: OffsetAndMetadata(6, '')})
+        self.consumer.close.assert_called_once_with(autocommit=False)
+
+    def test_subscription(self):
+        self._receiver([]).run()
+
+        pattern = re.compile(self.consumer.subscribe.call_args[1]['pattern'])
+        self.assertTrue(pattern.match(self.topic))
+        # the topics of the queues with the same prefix
+        self.assertFalse(pattern.match("{}-OTHER-TEST".format(RABBIT_QUEUE)))
+        self.assertFalse(pattern.match("{}TEST".format(RABBIT_QUEUE)))
+
+    def test_commit_every(self):
+        receiver = self._receiver([{self.partitions[0]: self._records([0, 1])},
+                                   {self.partitions[0]: self._records([2])}], commit_every=2)
+        receiver.run()
+
+        self.consumer.commit_async.assert_called_once_with({self.partitions[0]: OffsetAndMetadata(2, '')})
+        self.consumer.commit.assert_called_once_with({self.partitions[0]: OffsetAndMetadata(3, '')})
+
+    def test_handler_error(self):
+        receiver = self._receiver([{self.partitions[0]: self._records([0, 1, 2], ["aaa", "error", "bbb"])}])
+        self.assertRaises(ValueError, receiver.run)
+
+        # the failed message and the following ones are not committed, so they are received again
+        self.assertEqual(self.handled, [("aaa", "TEST")])
+        self.consumer.commit.assert_called_once_with({self.partitions[0]: OffsetAndMetadata(1, '')})
+        self.consumer.close.assert_called_once_with(autocommit=False)
+
+    def test_handler_error_first_message(self):
+        receiver = self._receiver([{self.partitions[0]: self._records([0], ["error"])}])
+        self.assertRaises(ValueError, receiver.run)
+        self.assertFalse(self.consumer.commit.called)
+
+    def test_errors(self):
+        receiver = KafkaReceiver()
+        self.assertRaises(MessengerErrorNoApplicationName, receiver.run)
+        receiver.application_name = RABBIT_EXCHANGE
+        self.assertRaises(MessengerErrorNoQueue, receiver.run)
+        receiver.set_queue(RABBIT_QUEUE, False, False)
+        self.assertRaises(MessengerErrorNoHandler, receiver.run)
+
+        receiver.handler = self._handler
+        self.consumer_class.side_effect = NoBrokersAvailable()
+        self.assertRaises(MessengerErrorConnectionRefused, receiver.run)
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2015, CRS4
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from multiprocessing import Process
+from unittest import TestCase
+
+from clay.exceptions import MessengerError, MessengerErrorNoApplicationName, MessengerErrorNoHandler, \
+    MessengerErrorNoQueue, MessengerErrorTimeout
+from clay.factory import MessageFactory
+from clay.messenger import LoopbackMessenger, LoopbackReceiver, MessageIterator
+from clay.messenger.loopback_messenger import _FrameReader, _LENGTH
+from clay.serializer import AvroSerializer
+
+from tests import TEST_CATALOG, RABBIT_QUEUE, RABBIT_EXCHANGE, json_catalog
+
+
+def _echo(message_body, message_type):
+    return message_body
+
+
+def _run_receiver(directory, response):
+    receiver = LoopbackReceiver(directory)
+    receiver.application_name = RABBIT_EXCHANGE
+    receiver.set_queue(RABBIT_QUEUE, False, response)
+    receiver.handler = _echo
+    receiver.run()
+
+
+class TestFrameReader(TestCase):
+    def test_split_frames(self):
+        frames = ['x' * size for size in (0, 10, 100, 1000)]
+        data = ''.join(_LENGTH.pack(len(frame)) + frame for frame in frames)
+        reader, writer = socket.socketpair()
+        # a small buffer, so that it must grow and the frames are split between the reads
+        frame_reader = _FrameReader(reader, 16)
+        received = []
+        for pos in range(0, len(data), 7):
+            writer.sendall(data[pos:pos + 7])
+            received.extend(frame_reader.read())
+        writer.close()
+        self.assertIsNone(frame_reader.read())
+        reader.close()
+        self.assertEqual(received, frames)
+
+
+class TestLoopback(TestCase):
+    def setUp(self):
+        self.avro_factory = MessageFactory(AvroSerializer, TEST_CATALOG)
+        self.messages = []
+        for i in range(10):
+            message = self.avro_factory.create('TEST')
+            message.id = i
+            message.name = "aaa"
+            self.messages.append(message)
+        self.directory = tempfile.mkdtemp()
+        self.receivers = []
+        self.messengers = []
+
+    def tearDown(self):
+        for messenger in self.messengers:
+            messenger.close()
+        for receiver in self.receivers:
+            receiver.stop()
+        shutil.rmtree(self.directory)
+
+    def _messenger(self, app_name, response, directory=None):
+        messenger = LoopbackMessenger(directory)
+        messenger.application_name = app_name
+        messenger.add_queue(RABBIT_QUEUE, False, response)
+        self.messengers.append(messenger)
+        return messenger
+
+    def _start_receiver(self, app_name, response, handler=_echo, directory=None):
+        receiver = LoopbackReceiver(directory)
+        receiver.application_name = app_name
+        receiver.set_queue(RABBIT_QUEUE, False, response)
+        receiver.handler = handler
+        thread = threading.Thread(target=receiver.run)
+        thread.daemon = True
+        thread.start()
+        self.receivers.append(receiver)
+        return receiver
+
+    def test_no_response(self):
+        received = []
+        self._start_receiver('no_response', False, lambda message_body, message_type:
+                             received.append((message_body, message_type)))
+        messenger = self._messenger('no_response', False)
+        for message in self.messages:
+            self.assertIsNone(messenger.send(message))
+
+        deadline = time.time() + 5
+        while len(received) < len(self.messages) and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(received, [(message.serialize(), 'TEST') for message in self.messages])
+
+    def test_response(self):
+        self._start_receiver('response', True)
+        messenger = self._messenger('response', True)
+        self.assertEqual(messenger.send(self.messages[0]), self.messages[0].serialize())
+
+        futures = [messenger.send_async(message) for message in self.messages]
+        self.assertEqual([future.result(5) for future in futures], [message.serialize() for message in self.messages])
+
+    def test_handler_error(self):
+        self._start_receiver('handler_error', True, lambda message_body, message_type: 1 / 0)
+        messenger = self._messenger('handler_error', True)
+        self.assertRaises(MessengerError, messenger.send, self.messages[0])
+
+    def test_timeout(self):
+        messenger = self._messenger('timeout', True)
+        self.assertRaises(MessengerErrorTimeout, messenger.send_async(self.messages[0], 0.1).result)
+
+    def test_send_timeout(self):
+        messenger = LoopbackMessenger(timeout=0.1)
+        messenger.application_name = 'send_timeout'
+        messenger.add_queue(RABBIT_QUEUE, False, True)
+        self.messengers.append(messenger)
+        # without a receiver the response is not waited indefinitely
+        self.assertRaises(MessengerErrorTimeout, messenger.send, self.messages[0])
+
+    def test_timeout_cancelled(self):
+        self._start_receiver('timeout_cancelled', True)
+        messenger = self._messenger('timeout_cancelled', True)
+        futures = [messenger.send_async(message, 60) for message in self.messages]
+        self.assertEqual([future.result(5) for future in futures], [message.serialize() for message in self.messages])
+        # the timers of the completed requests don't keep running
+        time.sleep(0.1)
+        self.assertFalse([thread for thread in threading.enumerate()
+                          if isinstance(thread, threading._Timer) and thread.is_alive()])
+
+    def test_queue_full(self):
+        messenger = LoopbackMessenger(queue_size=1, timeout=0.1)
+        messenger.application_name = 'queue_full'
+        messenger.add_queue(RABBIT_QUEUE, False, False)
+        self.messengers.append(messenger)
+        # without a receiver the message that doesn't fit in the queue is spooled
+        self.assertIsNone(messenger.send(self.messages[0]))
+        self.assertIsNone(messenger.send(self.messages[1]))
+        self.assertEqual(len(messenger._spool), 1)
+        self.assertIsNotNone(messenger.send_async(self.messages[2]).exception(0))
+        self.assertEqual(len(messenger._spool), 2)
+
+    def test_iterator(self):
+        receiver = LoopbackReceiver()
+        receiver.application_name = 'iterator'
+        receiver.set_queue(RABBIT_QUEUE, False, False)
+        messenger = self._messenger('iterator', False)
+        with MessageIterator(receiver) as messages:
+            for message in self.messages:
+                messenger.send(message)
+            for message in self.messages:
+                self.assertEqual(next(messages), (message.serialize(), 'TEST'))
+
+    def test_unix_socket(self):
+        p = Process(target=_run_receiver, args=(self.directory, True))
+        p.start()
+        time.sleep(0.5)
+
+        messenger = self._messenger(RABBIT_EXCHANGE, True, self.directory)
+        futures = [messenger.send_async(message) for message in self.messages]
+        self.assertEqual([future.result(5) for future in futures], [message.serialize() for message in self.messages])
+        self.assertEqual(messenger.send(self.messages[0]), self.messages[0].serialize())
+        # the same connection is used for all the messages
+        self.assertEqual(len(messenger._connections), 1)
+
+        p.terminate()
+        p.join()
+        # the requests waiting for the response fail when the receiver stops
+        self.assertRaises(MessengerError, messenger.send, self.messages[0])
+        messenger.close()
+
+    def test_unix_socket_unicode_names(self):
+        # the domain and the type of the messages of a catalog loaded from JSON are unicode
+        factory = MessageFactory(AvroSerializer, json_catalog(TEST_CATALOG, u'LOOPBACK_JSON_CATALOG'))
+        message = factory.create('TEST')
+        message.id = 1111111
+        message.name = "aaa"
+        self.assertIsInstance(message.message_type, unicode)
+
+        self._start_receiver(RABBIT_EXCHANGE, True, directory=self.directory)
+        time.sleep(0.2)
+        messenger = self._messenger(RABBIT_EXCHANGE, True, self.directory)
+        self.assertEqual(messenger.send(message), message.serialize())
+        messenger.close()
+
+    def test_unix_socket_invalid_result(self):
+        receiver = self._start_receiver(RABBIT_EXCHANGE, True, lambda message_body, message_type: 1,
+                                        self.directory)
+        time.sleep(0.2)
+        messenger = self._messenger(RABBIT_EXCHANGE, True, self.directory)
+        # the request fails and the receiver keeps running
+        self.assertRaises(MessengerError, messenger.send, self.messages[0])
+        self.assertRaises(MessengerError, messenger.send, self.messages[1])
+        self.assertTrue(receiver._running)
+        messenger.close()
+
+    def test_unix_socket_receiver_down(self):
+        messenger = self._messenger(RABBIT_EXCHANGE, False, self.directory)
+        self.assertIsNone(messenger.send(self.messages[0]))
+        self.assertEqual(len(messenger._spool), 1)
+        self.assertIsNotNone(messenger.send_async(self.messages[0]).exception(0))
+        self.assertEqual(len(messenger._spool), 2)
+        messenger.close()
+
+    def test_errors(self):
+        messenger = LoopbackMessenger()
+        with self.assertRaises(MessengerErrorNoQueue):
+            messenger.send(self.messages[0])
+        messenger.add_queue(RABBIT_QUEUE, False, False)
+        with self.assertRaises(MessengerErrorNoApplicationName):
+            messenger.send(self.messages[0])
+
+        receiver = LoopbackReceiver()
+        self.assertRaises(MessengerErrorNoApplicationName, receiver.run)
+        receiver.application_name = RABBIT_EXCHANGE
+        self.assertRaises(MessengerErrorNoQueue, receiver.run)
+        receiver.set_queue(RABBIT_QUEUE, False, False)
+        self.assertRaises(MessengerErrorNoHandler, receiver.run)
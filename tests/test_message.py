@@ -21,10 +21,11 @@
 
 from unittest import TestCase
 
+from clay.catalog import Catalog
 from clay.exceptions import InvalidMessage, SchemaException, InvalidContent
 from clay.factory import MessageFactory
 from clay.serializer import AvroSerializer
-from clay.message import _Record
+from clay.message import Message, _Record
 
 from tests import TEST_CATALOG, TEST_SCHEMA, TEST_COMPLEX_SCHEMA
 
@@ -293,3 +294,77 @@ class TestMessage(TestCase):
         self.assertNotEqual(m1.array_complex_field, m2.array_complex_field)
         self.assertNotEqual(m1.array_simple_field, m2.array_simple_field)
         self.assertNotEqual(m1.record_field, m2.record_field)
+
+    def test_compiled_classes(self):
+        m1 = self.factory.create("TEST_COMPLEX")
+        m2 = self.factory.create("TEST_COMPLEX")
+        self.assertIs(type(m1), type(m2))
+        self.assertIs(type(m1._struct), type(m2._struct))
+        self.assertIs(type(m1.record_field), type(m2.record_field))
+
+        # records store the fields in slots, without an instance dictionary
+        self.assertFalse(hasattr(m1._struct, "__dict__"))
+        self.assertFalse(hasattr(m1.record_field, "__dict__"))
+        self.assertRaises(AttributeError, setattr, m1.record_field, "unknown", 1)
+
+    def test_compiled_classes_catalog(self):
+        catalog = {"name": "TEST_COMPILED_CATALOG", 0: {
+            "namespace": "TESTS",
+            "name": "TEST_COMPILED",
+            "type": "record",
+            "fields": [{"name": "field_1", "type": "string"}]
+        }}
+        first = Catalog(catalog)
+        m = Message("TEST_COMPILED", first, AvroSerializer)
+        self.assertIs(type(Message("TEST_COMPILED", first, AvroSerializer)), type(m))
+
+        # the classes are kept by the catalog, that is not affected by the changes of the schemas
+        catalog[0]["fields"].append({"name": "field_2", "type": "int"})
+        self.assertEqual(Message("TEST_COMPILED", first, AvroSerializer).fields, ("field_1",))
+        self.assertEqual(Message("TEST_COMPILED", Catalog(catalog), AvroSerializer).fields, ("field_1", "field_2"))
+
+    def test_reserved_field_name(self):
+        schema = {
+            "namespace": "TESTS",
+            "name": "TEST_RESERVED",
+            "type": "record",
+            "fields": [{"name": "content", "type": "string"}]
+        }
+        factory = MessageFactory(AvroSerializer, {"name": "TEST_RESERVED_CATALOG", 0: schema})
+        self.assertRaises(SchemaException, factory.create, "TEST_RESERVED")
+
+    def test_serialization_cache(self):
+        content = {"valid": True, "id": 1, "long_id": 2, "float_id": 1.0, "double_id": 2.0, "name": "aaa",
+                   "record_field": {"field_1": "a", "field_2": "b"}, "array_simple_field": ["c"],
+                   "array_complex_field": []}
+        m = self.factory.create("TEST_COMPLEX", content)
+        serialized = m.serialize()
+        self.assertIs(m.serialize(), serialized)
+
+        # every change, also of nested records and arrays, invalidates the cache
+        changes = (
+            lambda: setattr(m, "id", 3),
+            lambda: setattr(m.record_field, "field_1", "d"),
+            lambda: m.array_simple_field.add("e"),
+            lambda: m.array_complex_field.add({"field_1": "f"}),
+            lambda: setattr(m.array_complex_field[0], "field_1", "g"),
+            lambda: m.array_simple_field.__delitem__(0),
+            lambda: m.set_content({"name": "bbb"}),
+        )
+        for change in changes:
+            change()
+            self.assertIsNone(m._serialized)
+            serialized = m.serialize()
+            self.assertEqual(self.factory.retrieve(serialized), m)
+
+    def test_retrieved_serialization(self):
+        content = {"valid": True, "id": 1, "long_id": 2, "float_id": 1.0, "double_id": 2.0, "name": "aaa",
+                   "record_field": {"field_1": "a", "field_2": "b"}}
+        m = self.factory.create("TEST_COMPLEX", content)
+        serialized = m.serialize()
+        for lazy in (False, True):
+            retrieved = self.factory.retrieve(serialized, lazy)
+            self.assertEqual(retrieved.record_field.field_1, "a")
+            self.assertIs(retrieved.serialize(), serialized)
+            retrieved.record_field.field_1 = "b"
+            self.assertNotEqual(retrieved.serialize(), serialized)
@@ -21,13 +21,16 @@
 
 from unittest import TestCase
 
+import threading
 import time
 from multiprocessing import Process
 
 from clay.factory import MessageFactory
 from clay.serializer import AvroSerializer
-from clay.messenger import MQTTMessenger, MQTTReceiver
-from clay.exceptions import MessengerErrorNoQueue, MessengerErrorConnectionRefused
+from clay.messenger import MessageIterator, MQTTMessenger, MQTTReceiver
+from clay.messenger.mqtt_messenger import PAYLOAD_BASE64, PAYLOAD_BINARY
+from clay.messenger.workers import WorkerPool
+from clay.exceptions import MessengerError, MessengerErrorNoQueue, MessengerErrorConnectionRefused
 
 from tests import TEST_CATALOG, RABBIT_QUEUE, RABBIT_EXCHANGE
 
@@ -84,12 +87,51 @@ class TestMQTT(TestCase):
 
     def test_mqtt_producer_server_down(self):
         messenger = MQTTMessenger('localhost', 20000)  # non existent rabbit server
+        self.addCleanup(messenger.close)
         messenger.application_name = RABBIT_EXCHANGE
         messenger.add_queue(RABBIT_QUEUE, False, False)
 
         result = messenger.send(self.avro_message)
         self.assertIsNone(result)
-        self.assertEqual(messenger._spooling_queue.qsize(), 1)
+        self.assertEqual(len(messenger._spool), 1)
+
+    def test_mqtt_send_async(self):
+        messenger = MQTTMessenger()
+        messenger.application_name = RABBIT_EXCHANGE
+        messenger.add_queue(RABBIT_QUEUE, False, False)
+
+        futures = [messenger.send_async(self.avro_message) for _ in range(100)]
+        for future in futures:
+            self.assertIsNone(future.result(5))
+        self.assertEqual(messenger._inflight, {})
+        messenger.close(timeout=1)
+
+    def test_mqtt_send_async_server_down(self):
+        messenger = MQTTMessenger('localhost', 20000)  # non existent rabbit server
+        self.addCleanup(messenger.close)
+        messenger.application_name = RABBIT_EXCHANGE
+        messenger.add_queue(RABBIT_QUEUE, False, False)
+
+        future = messenger.send_async(self.avro_message)
+        self.assertIsNotNone(future.exception(0))
+        self.assertEqual(len(messenger._spool), 1)
+
+    def test_mqtt_iterator(self):
+        broker = MQTTReceiver()
+        broker.application_name = RABBIT_EXCHANGE
+        broker.set_queue(RABBIT_QUEUE, False, False)
+
+        with MessageIterator(broker) as messages:
+            time.sleep(1)
+            messenger = MQTTMessenger()
+            messenger.application_name = RABBIT_EXCHANGE
+            messenger.add_queue(RABBIT_QUEUE, False, False)
+            for _ in range(3):
+                messenger.send(self.avro_message)
+            messenger.close(timeout=1)
+
+            for _ in range(3):
+                self.assertEqual(next(messages), (self.avro_encoded, self.avro_message.message_type))
 
     def test_mqtt_producer_non_existent_queue(self):
         self._reset()
@@ -104,7 +146,23 @@ class TestMQTT(TestCase):
         result = messenger.send(self.avro_message)
 
         self.assertIsNone(result)
-        self.assertEqual(messenger._spooling_queue.qsize(), 0)
+        self.assertEqual(len(messenger._spool), 0)
+
+    def test_mqtt_persistent_connection(self):
+        messenger = MQTTMessenger()
+        messenger.application_name = RABBIT_EXCHANGE
+        messenger.add_queue(RABBIT_QUEUE, False, False)
+
+        self.assertIsNone(messenger.send(self.avro_message))
+        client = messenger._client
+        for _ in range(3):
+            self.assertIsNone(messenger.send(self.avro_message))
+        # the same client is used for all the messages
+        self.assertIs(messenger._client, client)
+        self.assertEqual(len(messenger._spool), 0)
+
+        messenger.close(timeout=1)
+        self.assertIsNone(messenger._client)
 
     def test_mqtt_broker_server_down(self):
         def handler(message_body, message_type):
@@ -118,4 +176,199 @@ class TestMQTT(TestCase):
         broker.set_queue(RABBIT_QUEUE, False, True)
 
         with self.assertRaises(MessengerErrorConnectionRefused):
-            broker.run()
\ No newline at end of file
+            broker.run()
+
+
+class _Client(object):
+    # A client that records the payloads published
+    def __init__(self):
+        self.payloads = []
+
+    def publish(self, topic, payload, qos):
+        self.payloads.append(payload)
+        return 0, len(self.payloads)
+
+    def disconnect(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+
+class _Message(object):
+    def __init__(self, domain, message_type, body):
+        self.domain = domain
+        self.message_type = message_type
+        self.body = body
+
+    def serialize(self):
+        return self.body
+
+
+class _Flusher(object):
+    # A spool flusher that is never started
+    def stop(self):
+        pass
+
+    def join(self):
+        pass
+
+
+class _MQTTMessage(object):
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class TestPayloadEncoding(TestCase):
+    body = '\x00\x10\x8e\xd1\x87\x01\x06aaa'
+
+    def test_messenger(self):
+        messenger = MQTTMessenger()
+        messenger.application_name = RABBIT_EXCHANGE
+        messenger.add_queue('base64_queue', False, False)
+        messenger.add_queue('binary_queue', False, False)
+        messenger._client = client = _Client()
+
+        messenger._send_serialized('base64_queue', 'TEST', self.body)
+        messenger.set_payload_encoding(PAYLOAD_BINARY, 'binary_queue')
+        messenger._send_serialized('binary_queue', 'TEST', self.body)
+        messenger._send_serialized('base64_queue', 'TEST', self.body)
+        self.assertEqual(client.payloads, [self.body.encode('base64'), self.body, self.body.encode('base64')])
+
+        # the queue without its own encoding uses the one of the application
+        messenger.set_payload_encoding(PAYLOAD_BINARY)
+        messenger.set_payload_encoding(PAYLOAD_BASE64, 'binary_queue')
+        messenger._send_serialized('base64_queue', 'TEST', self.body)
+        messenger._send_serialized('binary_queue', 'TEST', self.body)
+        self.assertEqual(client.payloads[3:], [self.body, self.body.encode('base64')])
+
+        self.assertRaises(ValueError, messenger.set_payload_encoding, 'hex')
+        self.assertRaises(MessengerErrorNoQueue, messenger.set_payload_encoding, PAYLOAD_BINARY, 'no_queue')
+
+    def test_receiver(self):
+        received = []
+        receiver = MQTTReceiver()
+        receiver.handler = lambda message_body, message_type: received.append(message_body)
+
+        receiver._handler_wrapper(None, None, _MQTTMessage('topic', self.body.encode('base64')))
+        receiver.set_payload_encoding(PAYLOAD_BINARY)
+        payload = self.body
+        receiver._handler_wrapper(None, None, _MQTTMessage('topic', payload))
+        self.assertEqual(received, [self.body, self.body])
+        # the binary payload is passed to the handler without copying it
+        self.assertIs(received[1], payload)
+
+        self.assertRaises(ValueError, MQTTReceiver, payload_encoding='hex')
+
+
+class TestMQTTClose(TestCase):
+    body = '\x00\x10\x8e\xd1\x87\x01\x06aaa'
+
+    def _messenger(self):
+        messenger = MQTTMessenger(payload_encoding=PAYLOAD_BINARY)
+        messenger.application_name = RABBIT_EXCHANGE
+        messenger.add_queue(RABBIT_QUEUE, False, False)
+        messenger._client = _Client()
+        return messenger
+
+    def test_wait(self):
+        messenger = self._messenger()
+        for _ in range(3):
+            messenger._send_serialized(RABBIT_QUEUE, 'TEST', self.body)
+
+        def acknowledge():
+            for mid in range(1, 4):
+                time.sleep(0.1)
+                messenger._on_publish(None, None, mid)
+        thread = threading.Thread(target=acknowledge)
+        thread.start()
+        # without a timeout close waits for all the acknowledgements
+        messenger.close()
+        thread.join(10)
+        self.assertEqual(messenger._inflight, {})
+        self.assertEqual(len(messenger._spool), 0)
+
+    def test_unacknowledged(self):
+        messenger = self._messenger()
+        messenger._send_serialized(RABBIT_QUEUE, 'TEST_1', self.body)
+        future = messenger.send_async(_Message(RABBIT_QUEUE, 'TEST_2', self.body))
+        messenger._send_serialized(RABBIT_QUEUE, 'TEST_3', self.body)
+        messenger._on_publish(None, None, 1)
+
+        # the messages not acknowledged are spooled and the futures fail
+        messenger.close(timeout=0.1)
+        self.assertIsInstance(future.exception(0), MessengerError)
+        self.assertEqual([messenger._spool.pop() for _ in range(len(messenger._spool))],
+                         [(RABBIT_QUEUE, 'TEST_2', self.body), (RABBIT_QUEUE, 'TEST_3', self.body)])
+
+    def test_reset_client(self):
+        messenger = self._messenger()
+        messenger._send_serialized(RABBIT_QUEUE, 'TEST', self.body)
+        messenger._spool_flusher = _Flusher()
+        # changing the credentials drops the client, and its messages are sent again
+        messenger.set_credentials('user', 'password')
+        self.assertIsNone(messenger._client)
+        self.assertEqual(messenger._spool.pop(), (RABBIT_QUEUE, 'TEST', self.body))
+
+
+class _NetworkClient(object):
+    # A client whose network loop receives one message per call
+    def __init__(self, receiver, payloads):
+        self.receiver = receiver
+        self.payloads = list(payloads)
+        self.calls = []
+
+    def loop(self, timeout):
+        self.calls.append(("loop", self.receiver._pool.full))
+        if self.payloads:
+            self.receiver._handler_wrapper(self, None, _MQTTMessage('topic', self.payloads.pop(0)))
+        return 0
+
+    def loop_misc(self):
+        self.calls.append(("loop_misc", self.receiver._pool.full))
+        return 0
+
+    def want_write(self):
+        return False
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+
+class TestMQTTWorkers(TestCase):
+    def test_full_pool(self):
+        release = threading.Event()
+        handled = []
+
+        def handler(message_body, message_type):
+            release.wait(10)
+            handled.append(message_body)
+
+        receiver = MQTTReceiver(payload_encoding=PAYLOAD_BINARY)
+        receiver.handler = handler
+        receiver._client = client = _NetworkClient(receiver, ["message {}".format(i) for i in range(5)])
+        receiver._pool = WorkerPool(handler, workers=1, queue_size=2)
+        receiver._pool.start()
+        receiver._running = True
+        thread = threading.Thread(target=receiver._loop, args=(receiver._pool,))
+        thread.start()
+
+        # the callbacks don't wait for the pool: while it is full the loop only sends the keepalive
+        time.sleep(0.3)
+        self.assertEqual(len(handled), 0)
+        self.assertIn(("loop_misc", True), client.calls)
+        self.assertNotIn(("loop", True), client.calls)
+        self.assertEqual(len(client.payloads), 3)
+
+        release.set()
+        deadline = time.time() + 10
+        while len(handled) < 5 and time.time() < deadline:
+            time.sleep(0.01)
+        receiver.stop()
+        thread.join(10)
+        receiver._stop_pool()
+        self.assertEqual(handled, ["message {}".format(i) for i in range(5)])
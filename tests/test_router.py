@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2015, CRS4
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from unittest import TestCase
+
+from clay.factory import MessageFactory
+from clay.messenger import MessageRouter
+from clay.serializer import JSONSerializer
+
+from tests import TEST_CATALOG
+
+
+class TestMessageRouter(TestCase):
+    def setUp(self):
+        self.factory = MessageFactory(JSONSerializer, TEST_CATALOG)
+        self.simple_encoded = self.factory.create("TEST", {"id": 1, "name": "aaa"}).serialize()
+        self.complex_encoded = self.factory.create("TEST_COMPLEX", {"id": 2}).serialize()
+
+    def test_routes(self):
+        received = []
+        router = MessageRouter(self.factory)
+        router.add_route("TEST", lambda message, routing_key: received.append((message, routing_key)) or "ok")
+
+        self.assertEqual(router(self.simple_encoded, "TEST"), "ok")
+        self.assertIsNone(router(self.complex_encoded, "TEST_COMPLEX"))
+        self.assertEqual(received, [(self.simple_encoded, "TEST")])
+
+        router.remove_route("TEST")
+        self.assertIsNone(router(self.simple_encoded, "TEST"))
+        self.assertEqual(len(received), 1)
+
+    def test_default(self):
+        received = []
+        router = MessageRouter(self.factory, default=lambda message, routing_key: received.append(routing_key))
+        router(self.complex_encoded, "TEST_COMPLEX")
+        self.assertEqual(received, ["TEST_COMPLEX"])
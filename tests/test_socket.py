@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2015, CRS4
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+import mock
+
+from clay.exceptions import MessengerErrorNoApplicationName, MessengerErrorNoHandler, MessengerErrorNoQueue
+from clay.factory import MessageFactory
+from clay.messenger import SocketMessenger, SocketReceiver
+from clay.messenger.socket_messenger import _FrameDecoder, _frame
+from clay.serializer import AvroSerializer
+
+from tests import TEST_CATALOG, RABBIT_QUEUE, RABBIT_EXCHANGE, json_catalog
+
+
+class TestFrameDecoder(TestCase):
+    def test_split_frames(self):
+        frames = [_frame(RABBIT_QUEUE, 'TEST', 'x' * size) for size in (0, 10, 100, 1000)]
+        data = ''.join(part for frame in frames for part in frame)
+        reader, writer = socket.socketpair()
+        # a small buffer, so that it must grow and the frames are split between the reads
+        decoder = _FrameDecoder(reader, 16)
+        messages = []
+        for pos in range(0, len(data), 7):
+            writer.sendall(data[pos:pos + 7])
+            messages.extend(decoder.read())
+        writer.close()
+        self.assertIsNone(decoder.read())
+        reader.close()
+        self.assertEqual(messages, [(RABBIT_QUEUE, 'TEST', 'x' * size) for size in (0, 10, 100, 1000)])
+
+
+class TestSocket(TestCase):
+    def setUp(self):
+        self.avro_factory = MessageFactory(AvroSerializer, TEST_CATALOG)
+        self.messages = []
+        for i in range(1000):
+            message = self.avro_factory.create('TEST')
+            message.id = i
+            message.name = "aaa"
+            self.messages.append(message)
+        self.directory = tempfile.mkdtemp()
+        self.path = self.directory + '/receiver.sock'
+        self.messengers = []
+
+    def tearDown(self):
+        for messenger in self.messengers:
+            messenger.close(1)
+        shutil.rmtree(self.directory)
+
+    def _start_receiver(self, received, **kwargs):
+        receiver = SocketReceiver(**kwargs)
+        receiver.application_name = RABBIT_EXCHANGE
+        receiver.set_queue(RABBIT_QUEUE, False, False)
+        receiver.handler = lambda message_body, message_type: received.append((message_body, message_type))
+        thread = threading.Thread(target=receiver.run)
+        thread.daemon = True
+        thread.start()
+        time.sleep(0.2)
+        return receiver, thread
+
+    def _messenger(self, **kwargs):
+        messenger = SocketMessenger(**kwargs)
+        messenger.application_name = RABBIT_EXCHANGE
+        messenger.add_queue(RABBIT_QUEUE, False, False)
+        self.messengers.append(messenger)
+        return messenger
+
+    def _wait(self, received, count):
+        deadline = time.time() + 5
+        while len(received) < count and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_unix_socket(self):
+        received = []
+        receiver, thread = self._start_receiver(received, path=self.path)
+        messenger = self._messenger(path=self.path, max_pending=4096)
+        for message in self.messages:
+            self.assertIsNone(messenger.send(message))
+        self.assertTrue(messenger.flush(5))
+
+        self._wait(received, len(self.messages))
+        self.assertEqual(received, [(message.serialize(), 'TEST') for message in self.messages])
+        self.assertEqual(len(messenger._spool), 0)
+        messenger.close()
+        receiver.stop()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    def test_tcp(self):
+        received = []
+        receiver, thread = self._start_receiver(received, port=17070)
+        messenger = self._messenger(port=17070)
+        for message in self.messages[:10]:
+            messenger.send(message)
+        messenger.close()
+
+        self._wait(received, 10)
+        self.assertEqual(received, [(message.serialize(), 'TEST') for message in self.messages[:10]])
+        receiver.stop()
+        thread.join(5)
+
+    def test_unicode_names(self):
+        # the domain and the type of the messages of a catalog loaded from JSON are unicode
+        factory = MessageFactory(AvroSerializer, json_catalog(TEST_CATALOG, u'SOCKET_JSON_CATALOG'))
+        message = factory.create('TEST')
+        message.id = 1111111
+        message.name = "aaa"
+        self.assertIsInstance(message.domain, unicode)
+
+        received = []
+        receiver, thread = self._start_receiver(received, path=self.path)
+        messenger = self._messenger(path=self.path)
+        messenger.send(message)
+        self.assertTrue(messenger.flush(5))
+        self._wait(received, 1)
+        self.assertEqual(received, [(message.serialize(), 'TEST')])
+        self.assertEqual(len(messenger._spool), 0)
+        messenger.close()
+        receiver.stop()
+        thread.join(5)
+
+    def test_writer_error(self):
+        received = []
+        receiver, thread = self._start_receiver(received, path=self.path)
+        messenger = self._messenger(path=self.path)
+        errors = [ValueError("write failed")]
+
+        def write(data):
+            if errors:
+                raise errors.pop()
+            return mock.DEFAULT
+
+        messenger._write = mock.Mock(side_effect=write, wraps=messenger._write)
+
+        # the failed message is spooled and sent again, and the writer keeps running
+        messenger.send(self.messages[0])
+        self.assertTrue(messenger.flush(5))
+        messenger.send(self.messages[1])
+        self.assertTrue(messenger.flush(5))
+        self._wait(received, 2)
+        self.assertEqual(sorted(received), sorted((message.serialize(), 'TEST') for message in self.messages[:2]))
+        messenger.close()
+        receiver.stop()
+        thread.join(5)
+
+    def test_close_timeout(self):
+        # a receiver that accepts the connection and never reads
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.path)
+        listener.listen(1)
+        message = self.avro_factory.create('TEST')
+        message.id = 1
+        message.name = 'x' * 2 ** 22
+
+        messenger = self._messenger(path=self.path)
+        messenger.send(message)
+        self.assertFalse(messenger.flush(0.2))
+        start = time.time()
+        messenger.close(0.2)
+        # the blocked write is interrupted and the message is spooled
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(len(messenger._spool), 1)
+        listener.close()
+
+    def test_receiver_down(self):
+        messenger = self._messenger(path=self.path)
+        messenger.send(self.messages[0])
+        messenger.flush(5)
+        self.assertEqual(len(messenger._spool), 1)
+        messenger.close()
+
+    def test_errors(self):
+        messenger = SocketMessenger()
+        with self.assertRaises(MessengerErrorNoQueue):
+            messenger.send(self.messages[0])
+        messenger.add_queue(RABBIT_QUEUE, False, False)
+        with self.assertRaises(MessengerErrorNoApplicationName):
+            messenger.send(self.messages[0])
+
+        receiver = SocketReceiver()
+        self.assertRaises(MessengerErrorNoApplicationName, receiver.run)
+        receiver.application_name = RABBIT_EXCHANGE
+        self.assertRaises(MessengerErrorNoQueue, receiver.run)
+        receiver.set_queue(RABBIT_QUEUE, False, False)
+        self.assertRaises(MessengerErrorNoHandler, receiver.run)
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2015, CRS4
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from clay.factory import MessageFactory
+from clay.messenger import Messenger
+from clay.messenger.spool import Spool, SpoolFlusher
+from clay.serializer import AvroSerializer
+from tests import TEST_CATALOG, json_catalog
+
+
+class _SlowMessenger(Messenger):
+    # A messenger whose sends of the spooled messages wait to be released
+    def __init__(self):
+        super(_SlowMessenger, self).__init__()
+        self.sent = []
+        self.sending = threading.Event()
+        self.release = threading.Event()
+
+    def _send_serialized(self, domain, message_type, body):
+        self.sending.set()
+        self.release.wait(10)
+        self.sent.append(body)
+
+
+class TestSpool(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_memory(self):
+        spool = Spool(max_memory=20)
+        self.assertTrue(spool.put("DOMAIN", "TYPE", "x" * 10))
+        self.assertFalse(spool.put("DOMAIN", "TYPE", "x" * 10))
+        self.assertEqual(spool.dropped, 1)
+        self.assertEqual(len(spool), 1)
+        self.assertEqual(spool.pop(), ("DOMAIN", "TYPE", "x" * 10))
+        self.assertEqual(len(spool), 0)
+
+    def test_disk_order(self):
+        spool = Spool(self.directory, max_memory=30, segment_size=60)
+        for i in range(20):
+            spool.put("DOMAIN", "TYPE_%d" % i, "payload_%02d" % i)
+        self.assertEqual(len(spool), 20)
+        self.assertTrue(len(os.listdir(self.directory)) > 1)
+        self.assertEqual([spool.pop()[1] for _ in range(20)], ["TYPE_%d" % i for i in range(20)])
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_disk_limit(self):
+        spool = Spool(self.directory, max_memory=0, max_disk=100)
+        while spool.put("DOMAIN", "TYPE", "payload"):
+            pass
+        self.assertEqual(spool.dropped, 1)
+        self.assertTrue(spool._disk_size <= 100)
+
+    def test_reload(self):
+        spool = Spool(self.directory, max_memory=30, segment_size=60)
+        for i in range(10):
+            spool.put("DOMAIN", "TYPE_%d" % i, "payload_%02d" % i)
+        spool.pop()
+        spool.close()
+
+        spool = Spool(self.directory)
+        self.assertEqual(len(spool), 9)
+        self.assertEqual([spool.pop()[1] for _ in range(9)], ["TYPE_%d" % i for i in range(1, 10)])
+
+    def test_unicode_names(self):
+        # the domain and the type of the messages of a catalog loaded from JSON are unicode
+        factory = MessageFactory(AvroSerializer, json_catalog(TEST_CATALOG, u'SPOOL_JSON_CATALOG'))
+        message = factory.create('TEST')
+        message.id = 1111111
+        message.name = "aaa"
+        body = message.serialize()
+        self.assertIsInstance(message.message_type, unicode)
+
+        spool = Spool(self.directory, max_memory=10)
+        for _ in range(2):
+            self.assertTrue(spool.put(u"DOMAIN_\xe0", message.message_type, body))
+        spool.close()
+
+        spool = Spool(self.directory)
+        self.assertEqual(len(spool), 2)
+        for _ in range(2):
+            self.assertEqual(spool.pop(), ("DOMAIN_\xc3\xa0", "TEST", body))
+        self.assertIsNone(spool.pop())
+
+    def test_truncated_segment(self):
+        spool = Spool(self.directory, max_memory=0)
+        spool.put("DOMAIN", "TYPE_A", "payload")
+        spool.put("DOMAIN", "TYPE_B", "payload")
+        spool.close()
+        segment = os.path.join(self.directory, os.listdir(self.directory)[0])
+        with open(segment, "r+b") as f:
+            f.truncate(os.path.getsize(segment) - 1)
+
+        spool = Spool(self.directory)
+        self.assertEqual(len(spool), 1)
+        self.assertEqual(spool.pop(), ("DOMAIN", "TYPE_A", "payload"))
+
+    def test_flusher(self):
+        failures = [2]
+        sent = []
+
+        def send(domain, message_type, payload):
+            if failures[0] > 0:
+                failures[0] -= 1
+                raise IOError()
+            sent.append(message_type)
+
+        spool = Spool()
+        flusher = SpoolFlusher(spool, send, min_backoff=0.01)
+        flusher.start()
+        for i in range(5):
+            spool.put("DOMAIN", str(i), "payload")
+        deadline = time.time() + 5
+        while len(spool) > 0 and time.time() < deadline:
+            time.sleep(0.01)
+        flusher.stop()
+        flusher.join(1)
+
+        self.assertEqual(sent, [str(i) for i in range(5)])
+        self.assertEqual(len(spool), 0)
+        self.assertFalse(flusher.is_alive())
+
+    def test_set_spool_joins_flusher(self):
+        messenger = _SlowMessenger()
+        messenger._spool_message("DOMAIN", "TYPE", "aaa")
+        self.assertTrue(messenger.sending.wait(10))
+
+        # the new spool is set only when the old flusher has stopped
+        thread = threading.Thread(target=messenger.set_spool, args=(self.directory,))
+        thread.start()
+        time.sleep(0.1)
+        self.assertTrue(thread.is_alive())
+        messenger.release.set()
+        thread.join(10)
+
+        deadline = time.time() + 10
+        while len(messenger._spool) and time.time() < deadline:
+            time.sleep(0.01)
+        messenger._close_spool()
+        # the entry being sent is sent only once
+        self.assertEqual(messenger.sent, ["aaa"])
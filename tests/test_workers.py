@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2015, CRS4
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import threading
+import time
+from unittest import TestCase
+
+from clay.messenger.workers import WorkerPool
+
+
+def _upper(body, message_type):
+    if body == "error":
+        raise ValueError(body)
+    return body.upper()
+
+
+def _unpicklable_result(body, message_type):
+    return threading.Lock()
+
+
+class TestWorkerPool(TestCase):
+    def _run(self, pool):
+        results = []
+        completed = threading.Event()
+
+        def callback(success, result):
+            results.append((success, result))
+            if len(results) == 3:
+                completed.set()
+
+        pool.start()
+        try:
+            for body in ("aaa", "error", "bbb"):
+                pool.submit(body, "TEST", callback)
+            self.assertTrue(completed.wait(10))
+            self.assertTrue(pool.join(10))
+        finally:
+            pool.stop()
+        self.assertEqual(sorted(result for success, result in results if success), ["AAA", "BBB"])
+        self.assertEqual([type(result) for success, result in results if not success], [ValueError])
+
+    def test_threads(self):
+        self._run(WorkerPool(_upper, 2))
+
+    def test_processes(self):
+        self._run(WorkerPool(_upper, 2, processes=True))
+
+    def test_processes_unpicklable(self):
+        lock = threading.Lock()
+        pool = WorkerPool(lambda body, message_type: lock, processes=True)
+        self.assertRaises(ValueError, pool.start)
+
+        # the callback is called even if the result cannot be sent back
+        results = []
+        pool = WorkerPool(_unpicklable_result, 1, processes=True)
+        pool.start()
+        try:
+            pool.submit("aaa", "TEST", lambda success, result: results.append((success, result)))
+            self.assertTrue(pool.join(10))
+        finally:
+            pool.stop()
+        self.assertEqual(len(pool), 0)
+        self.assertEqual([(success, type(result)) for success, result in results], [(False, ValueError)])
+
+    def test_full(self):
+        release = threading.Event()
+        pool = WorkerPool(lambda body, message_type: release.wait(10), workers=1, queue_size=2)
+        pool.start()
+        try:
+            pool.submit("aaa", "TEST")
+            self.assertFalse(pool.full)
+            pool.submit("bbb", "TEST")
+            self.assertTrue(pool.full)
+            self.assertEqual(len(pool), 2)
+
+            start = time.time()
+            self.assertFalse(pool.wait_available(0.1))
+            self.assertGreaterEqual(time.time() - start, 0.1)
+
+            release.set()
+            self.assertTrue(pool.wait_available(10))
+            self.assertTrue(pool.join(10))
+            self.assertEqual(len(pool), 0)
+        finally:
+            pool.stop()
+
+    def test_stop_discards(self):
+        release = threading.Event()
+        handled = []
+
+        def handler(body, message_type):
+            release.wait(10)
+            handled.append(body)
+
+        pool = WorkerPool(handler, workers=1, queue_size=10)
+        pool.start()
+        for body in ("aaa", "bbb", "ccc"):
+            pool.submit(body, "TEST")
+        time.sleep(0.1)
+        # "aaa" is running, the others are discarded
+        pool.stop()
+        release.set()
+        time.sleep(0.1)
+        self.assertEqual(handled, ["aaa"])
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, WorkerPool, _upper, 0)
+        self.assertRaises(ValueError, WorkerPool, _upper, 1, 0)